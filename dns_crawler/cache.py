@@ -0,0 +1,125 @@
+# Copyright © 2019-2023 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+from .stats import increment
+
+
+class LRUCache:
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                expires, value = self.items[key]
+            except KeyError:
+                return default
+            if expires is not None and expires < monotonic():
+                del self.items[key]
+                return default
+            self.items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.size <= 0:
+            return
+        expires = monotonic() + self.ttl if self.ttl else None
+        with self.lock:
+            self.items[key] = (expires, value)
+            self.items.move_to_end(key)
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+
+# Local LRU in front of the Redis cache shared by all workers – hot keys (name servers and mail servers of big
+# hosting providers) are then served from memory without any Redis round trip or JSON parsing.
+# Values returned by get() are shared between jobs, so don't modify them.
+class SharedCache:
+    def __init__(self, redis, timeout, local_size):
+        self.redis = redis
+        self.timeout = timeout
+        self.local = LRUCache(local_size, ttl=timeout)
+
+    def get(self, key):
+        return self.get_many([key])[key]
+
+    # All keys not found in memory are fetched (and their TTL in Redis refreshed) in one round trip
+    def get_many(self, keys):
+        values = {}
+        remote = []
+        for key in keys:
+            value = self.local.get(key)
+            if value is not None:
+                values[key] = value
+            else:
+                remote.append(key)
+        local_hits = len(values)
+        if remote and self.redis is not None:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.mget(remote)
+            for key in remote:
+                pipe.expire(key, self.timeout)
+            for key, cached in zip(remote, pipe.execute()[0]):
+                if cached is not None:
+                    values[key] = json.loads(cached.decode("utf-8"))
+                    self.local.set(key, values[key])
+        increment("cache_local_hits", local_hits)
+        increment("cache_redis_hits", len(values) - local_hits)
+        increment("cache_misses", len(keys) - len(values))
+        return {key: values.get(key) for key in keys}
+
+    def prefetch(self, keys):
+        self.get_many(keys)
+
+    def set(self, key, value):
+        serialized = json.dumps(value)
+        # store a copy, the caller might still modify the original
+        self.local.set(key, json.loads(serialized))
+        if self.redis is not None:
+            self.redis.set(key, serialized, ex=self.timeout)
+
+
+# Cache view for a single job – keys the job will need are prefetched in one batch, so both hits and misses are then
+# answered without asking Redis again
+class JobCache:
+    def __init__(self, shared):
+        self.shared = shared
+        self.known = {}
+
+    def prefetch(self, keys):
+        keys = [key for key in dict.fromkeys(keys) if key not in self.known]
+        if keys:
+            self.known.update(self.shared.get_many(keys))
+
+    def get(self, key):
+        if key in self.known:
+            return self.known[key]
+        return self.shared.get(key)
+
+    def set(self, key, value):
+        self.known.pop(key, None)
+        self.shared.set(key, value)
@@ -0,0 +1,105 @@
+# Copyright © 2019-2023 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+from itertools import islice
+from os.path import basename
+from threading import local
+
+import zstandard
+
+from .redis_utils import DICTIONARY_KEY
+from .timestamp import timestamp
+
+DEFAULT_DICTIONARY_SIZE = 112640
+DICTIONARY_SAMPLES = 100000
+
+
+# Results are stored in Redis compressed with zstd, each thread gets its own compressor (they're not thread-safe)
+class ResultCompressor:
+    def __init__(self, level, dictionary=None):
+        self.level = level
+        self.dictionary = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+        if self.dictionary:
+            self.dictionary.precompute_compress(level=level)
+        self.local = local()
+
+    def compress(self, data):
+        compressor = getattr(self.local, "compressor", None)
+        if compressor is None:
+            compressor = zstandard.ZstdCompressor(level=self.level, dict_data=self.dictionary)
+            self.local.compressor = compressor
+        return compressor.compress(data)
+
+
+def get_result_compressor(config, redis):
+    if config["compression"]["algorithm"] != "zstd":
+        return None
+    dictionary = redis.get(DICTIONARY_KEY) if redis is not None else None
+    return ResultCompressor(config["compression"]["level"], dictionary)
+
+
+# The controller shares the dictionary with workers via Redis, so it doesn't need to be copied to every machine
+def save_dictionary(config, redis):
+    filename = config["compression"]["dictionary"]
+    if config["compression"]["algorithm"] != "zstd" or not filename:
+        return None
+    with open(filename, "rb") as f:
+        dictionary = f.read()
+    redis.set(DICTIONARY_KEY, dictionary)
+    return dictionary
+
+
+def get_result_decompressor(dictionary=None):
+    return zstandard.ZstdDecompressor(dict_data=zstandard.ZstdCompressionDict(dictionary) if dictionary else None)
+
+
+def print_help():
+    exe = basename(sys.argv[0])
+    sys.stderr.write(f"{exe} - trains a zstd dictionary for compressing results in Redis\n\n")
+    sys.stderr.write(f"Usage: {exe} <results> <dictionary> [size]\n")
+    sys.stderr.write("       results - results from an earlier crawl (one JSON per line), " +
+                     f"first {DICTIONARY_SAMPLES} are used\n")
+    sys.stderr.write("       dictionary - file to save the dictionary to\n")
+    sys.stderr.write(f"       size - dictionary size in bytes, {DEFAULT_DICTIONARY_SIZE} by default\n\n")
+    sys.stderr.write(f"Example: {exe} results.json results.dict\n")
+    sys.exit(1)
+
+
+def main():
+    if "-h" in sys.argv or "--help" in sys.argv or len(sys.argv) < 3:
+        print_help()
+
+    results_filename, dictionary_filename = sys.argv[1:3]
+    try:
+        size = int(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_DICTIONARY_SIZE
+    except ValueError:
+        sys.stderr.write(f"Dictionary size ('{sys.argv[3]}') is not an integer.\n\n")
+        print_help()
+
+    try:
+        with open(results_filename, "rb") as f:
+            samples = [line.rstrip(b"\n") for line in islice(f, DICTIONARY_SAMPLES)]
+    except FileNotFoundError:
+        sys.stderr.write(f"File '{results_filename}' does not exist.\n\n")
+        print_help()
+    sys.stderr.write(f"{timestamp()} Training a dictionary on {len(samples)} results…\n")
+    dictionary = zstandard.train_dictionary(size, samples)
+    with open(dictionary_filename, "wb") as f:
+        f.write(dictionary.as_bytes())
+    sys.stderr.write(f"{timestamp()} Dictionary saved to {dictionary_filename}.\n")
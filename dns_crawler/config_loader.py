@@ -20,6 +20,7 @@ import pickle
 import sys
 from os import getcwd, path
 from shutil import copy2
+from uuid import uuid4
 
 import yaml
 
@@ -27,6 +28,7 @@ from .ip_utils import is_valid_ip_address
 from .timestamp import timestamp
 
 default_config_filename = "config.yml"
+config_token_key = "crawler-config-token"
 
 defaults = {
     "geoip": {
@@ -50,7 +52,12 @@ defaults = {
             "hostname.bind"
         ],
         "check_www": True,
-        "fingerprint": False
+        "fingerprint": False,
+        "max_parallel_queries": 32,
+        "max_parallel_auth_probes": 16,
+        "udp_sockets": 4,
+        "tcp_connections": 64,
+        "tls": False
     },
     "timeouts": {
         "job": 80,
@@ -60,6 +67,41 @@ defaults = {
         "mail": 2,
         "cache": 3600
     },
+    "cache": {
+        "local_size": 10000,
+        "ns_addresses": "local",
+        "geoip_size": 100000
+    },
+    "queue": {
+        "max_jobs": None,
+        "batch_size": 1
+    },
+    "output": {
+        "format": "json",
+        "file": None,
+        "row_group_size": 10000,
+        "include_json": False,
+        "shards": 0,
+        "shard_compression": "zstd",
+        "shard_compression_level": 3,
+        "rotate_size": 1073741824,
+        "rotate_count": 0
+    },
+    "delta": {
+        "previous": None,
+        "save_index": None,
+        "unchanged": None,
+        "removed": None
+    },
+    "incremental": {
+        "index": None,
+        "probes": ["WEB"]
+    },
+    "compression": {
+        "algorithm": "zstd",
+        "level": 3,
+        "dictionary": None
+    },
     "mail": {
         "get_banners": False,
         "ports": [25, 465, 587],
@@ -85,10 +127,17 @@ defaults = {
         "ipv6": "2001:148f:ffff::1"
     },
     "save_worker_hostname": False,
-    "worker_niceness": 10
+    "worker_niceness": 10,
+    "worker_concurrency": 1,
+    "worker_fork": True
 }
 
 
+# Options holding file names, which are kept as they are even if they start with a digit (eg. `2023-06-01.parquet`)
+path_options = {"country", "isp", "asn", "file", "dictionary", "index", "previous", "save_index", "unchanged",
+                "removed"}
+
+
 def merge_dicts(source, destination):
     for key, value in source.items():
         if isinstance(value, dict):
@@ -96,7 +145,7 @@ def merge_dicts(source, destination):
             merge_dicts(value, node)
         else:
             if isinstance(value, str):
-                if is_valid_ip_address(value):
+                if is_valid_ip_address(value) or key in path_options:
                     destination[key] = value
                 elif value[0].isdigit():
                     destination[key] = float(value)
@@ -146,6 +195,17 @@ def load_config_from_file(filename=default_config_filename):
     return config
 
 
+def save_config(redis, key, config):
+    pipe = redis.pipeline()
+    pipe.set(key, pickle.dumps(config))
+    pipe.set(config_token_key, uuid4().hex)
+    pipe.execute()
+
+
+def get_config_token(redis):
+    return redis.get(config_token_key)
+
+
 def load_config(filename=default_config_filename, redis=None, hostname=None, save=False):
     if redis is not None:
         key_controller = "crawler-config"
@@ -163,7 +223,7 @@ def load_config(filename=default_config_filename, redis=None, hostname=None, sav
                 config_workers = load_config_from_file(filename)
                 config = merge_dicts(config_controller, config_workers)
                 if save:
-                    redis.set(key, pickle.dumps(config))
+                    save_config(redis, key, config)
                 return config
         else:
             key = key_controller
@@ -173,7 +233,7 @@ def load_config(filename=default_config_filename, redis=None, hostname=None, sav
             else:
                 config = load_config_from_file(filename)
                 if save:
-                    redis.set(key, pickle.dumps(config))
+                    save_config(redis, key, config)
                 return config
     else:
         return load_config_from_file(filename)
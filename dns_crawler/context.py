@@ -0,0 +1,118 @@
+# Copyright © 2019-2023 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
+from socket import gethostname
+from threading import BoundedSemaphore
+
+from .cache import SharedCache
+from .compression import get_result_compressor
+from .config_loader import default_config_filename, get_config_token, load_config
+from .dns_utils import get_local_resolver, init_record_cache
+from .geoip_utils import init_geoip
+from .hsts_utils import get_hsts_index
+from .incremental import get_previous_results
+from .ip_utils import get_source_addresses
+from .transport import get_stream_pool, get_udp_pool
+
+crawl_context = None
+
+
+# A job's view of an executor shared by all jobs of the worker – the job has at most `limit` tasks in it at once
+# (submit() waits for a slot), so a domain with a lot of name or mail servers can't take all the threads
+class JobExecutor:
+    def __init__(self, executor, limit):
+        self.executor = executor
+        self.slots = BoundedSemaphore(limit)
+
+    def submit(self, fn, *args, **kwargs):
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+
+# Things that don't change between jobs – loaded once per worker process and reloaded only when
+# the shared config in Redis changes
+class CrawlContext:
+    def __init__(self, redis=None, hostname=None):
+        self.redis = redis
+        self.hostname = hostname or gethostname()
+        self.load()
+
+    def load(self):
+        previous = copy(self) if hasattr(self, "config") else None
+        self.config_token = get_config_token(self.redis) if self.redis is not None else None
+        self.config = load_config(default_config_filename, redis=self.redis, hostname=self.hostname)
+        self.source_ipv4, self.source_ipv6 = get_source_addresses(self.config, redis=self.redis,
+                                                                  hostname=self.hostname)
+        self.geoip_dbs = init_geoip(self.config)
+        self.local_resolver = get_local_resolver(self.config)
+        get_hsts_index()
+        self.compressor = get_result_compressor(self.config, self.redis)
+        self.previous_results = get_previous_results(self.config)
+        get_udp_pool(self.config["dns"]["udp_sockets"])
+        get_stream_pool(self.config["dns"]["tcp_connections"],
+                        tls_servers=self.config["dns"]["resolvers"] if self.config["dns"]["tls"] else [])
+        # threads for the domains' DNS queries and auth server probes, shared by all jobs (each of them can use
+        # up to the configured number, see get_job_executors())
+        concurrency = max(self.config["worker_concurrency"], 1)
+        self.query_executor = ThreadPoolExecutor(self.config["dns"]["max_parallel_queries"] * concurrency)
+        self.probe_executor = ThreadPoolExecutor(self.config["dns"]["max_parallel_auth_probes"] * concurrency)
+        self.cache = SharedCache(self.redis, self.config["timeouts"]["cache"], self.config["cache"]["local_size"])
+        init_record_cache(self.cache, self.config["cache"]["local_size"], self.config["timeouts"]["cache"])
+        ns_address_cache = self.config["cache"]["ns_addresses"]
+        if ns_address_cache:
+            self.ns_address_cache = SharedCache(self.redis if ns_address_cache == "redis" else None,
+                                                self.config["timeouts"]["cache"], self.config["cache"]["local_size"])
+        else:
+            self.ns_address_cache = None
+        # the new context is in place, nothing uses the previous one's executors and GeoIP readers anymore
+        if previous is not None:
+            previous.close()
+
+    # (query executor, probe executor) for one job
+    def get_job_executors(self):
+        return (JobExecutor(self.query_executor, self.config["dns"]["max_parallel_queries"]),
+                JobExecutor(self.probe_executor, self.config["dns"]["max_parallel_auth_probes"]))
+
+    def close(self):
+        self.query_executor.shutdown(wait=False)
+        self.probe_executor.shutdown(wait=False)
+        self.geoip_dbs.close()
+
+    def is_outdated(self):
+        return self.redis is not None and get_config_token(self.redis) != self.config_token
+
+    def refresh(self):
+        if self.is_outdated():
+            self.load()
+
+
+def get_crawl_context(redis=None):
+    global crawl_context
+    if crawl_context is None or crawl_context.redis is not redis:
+        if crawl_context is not None:
+            crawl_context.close()
+        crawl_context = CrawlContext(redis)
+    return crawl_context
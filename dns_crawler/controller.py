@@ -16,23 +16,27 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import pickle
 import sys
+from itertools import islice
 from os.path import basename
-from time import sleep
+from time import monotonic
 
 from redis import Redis
 from redis.exceptions import ConnectionError, ExecAbortError, ResponseError
 from rq import Queue
-from rq.registry import FinishedJobRegistry
 
+from .compression import get_result_decompressor, save_dictionary
 from .config_loader import default_config_filename, load_config
-from .crawl import get_json_result
-from .redis_utils import get_redis_host
+from .crawl import push_results
+from .delta import get_delta_sink
+from .output import OutputError, get_output_sink
+from .redis_utils import FEEDING_KEY, RESULTS_GROUP, RESULTS_STREAM, get_redis_host
+from .stats import get_stats
 from .timestamp import timestamp
 
 POLL_INTERVAL = 5
 INPUT_CHUNK_SIZE = 10000
+RESULTS_BATCH_SIZE = 1000
 
 
 class ControllerNotRunning(Exception):
@@ -52,12 +56,24 @@ def print_help():
     sys.exit(1)
 
 
-def create_jobs(domains, function, redis, queue, timeout):
+def print_stats(redis):
+    stats = get_stats(redis)
+    if stats:
+        sys.stderr.write(f"{timestamp()} Stats: {', '.join(f'{name}: {value}' for name, value in stats.items())}\n")
+
+
+def create_jobs(domains, function, redis, queue, timeout, batch_size):
     pipe = redis.pipeline()
     jobs = []
-    for domain in domains:
-        jobs.append(Queue.prepare_data(function, (domain,), job_id=domain,
-                                       description=domain, timeout=timeout, result_ttl=-1))
+    for start in range(0, len(domains), batch_size):
+        batch = domains[start:start + batch_size]
+        if len(batch) == 1:
+            job_id = description = batch[0]
+        else:
+            job_id = None
+            description = f"{batch[0]} (+{len(batch) - 1} more)"
+        jobs.append(Queue.prepare_data(function, (batch,), job_id=job_id, description=description,
+                                       timeout=timeout * len(batch), result_ttl=0))
     queue.enqueue_many(jobs, pipeline=pipe)
     try:
         pipe.execute()
@@ -72,7 +88,25 @@ def create_jobs(domains, function, redis, queue, timeout):
             sys.stderr.write("Try increasing the `maxmemory` config option in redis.conf.\n")
         redis.flushdb()
         sys.exit(1)
-    return len(jobs)
+    return len(domains)
+
+
+# Tops up the queue to max_jobs from the input, returns the number of queued domains and whether there's more input left
+def feed_queue(input_file, redis, queue, max_jobs, timeout, batch_size):
+    created_count = 0
+    while True:
+        count = min((max_jobs - queue.count) * batch_size, INPUT_CHUNK_SIZE)
+        if count <= 0:
+            return created_count, True
+        read_domains = [line.rstrip() for line in islice(input_file, count)]
+        if read_domains:
+            created_count = created_count + create_jobs(read_domains, push_results, queue=queue,
+                                                        redis=redis, timeout=timeout, batch_size=batch_size)
+        if len(read_domains) < count:
+            input_file.close()
+            redis.delete(FEEDING_KEY)
+            sys.stderr.write(f"{timestamp()} All domains from the input are in the queue.\n")
+            return created_count, False
 
 
 def main():
@@ -88,7 +122,18 @@ def main():
 
     redis.flushdb()
     config = load_config(default_config_filename, redis, save=True)
-    finished_registry = FinishedJobRegistry(connection=redis)
+    try:
+        decompressor = get_result_decompressor(save_dictionary(config, redis))
+    except FileNotFoundError:
+        sys.stderr.write(f"{timestamp()} Compression dictionary '{config['compression']['dictionary']}' " +
+                         "does not exist.\n")
+        sys.exit(1)
+    try:
+        output = get_delta_sink(get_output_sink(config), config)
+    except (OutputError, OSError) as e:
+        sys.stderr.write(f"{timestamp()} {e}\n")
+        sys.exit(1)
+    redis.xgroup_create(RESULTS_STREAM, RESULTS_GROUP, id="0", mkstream=True)
 
     try:
         filename = sys.argv[1]
@@ -98,61 +143,81 @@ def main():
     try:
         sys.stderr.write(f"{timestamp()} Reading domains from {filename}.\n")
         input_file = open(filename, "r", encoding="utf-8")
-        sys.stderr.write(
-            f"{timestamp()} Creating job queue…\n")
-        redis.set("locked", 1)
         queue = Queue(connection=redis)
+        timeout = config["timeouts"]["job"]
+        max_jobs = config["queue"]["max_jobs"]
+        batch_size = config["queue"]["batch_size"]
         domain_count = 0
-        read_domains = []
-        for line in input_file:
-            read_domains.append(line.rstrip())
-            if len(read_domains) == INPUT_CHUNK_SIZE:
-                domain_count = domain_count + create_jobs(read_domains, get_json_result, queue=queue,
-                                                          redis=redis, timeout=config["timeouts"]["job"])
-                sys.stderr.write(f"{timestamp()} {domain_count}\n")
-                read_domains = []
-        domain_count = domain_count + create_jobs(read_domains, get_json_result, queue=queue,
-                                                  redis=redis, timeout=config["timeouts"]["job"])
-        sys.stderr.write(f"{timestamp()} {domain_count}\n")
-        input_file.close()
-
         finished_count = 0
-        sys.stderr.write(f"{timestamp()} Created {domain_count} jobs. Unlocking queue and waiting for workers…\n")
-
-        redis.set("locked", 0)
-
-        while finished_count < domain_count:
-            finished_domains = finished_registry.get_job_ids()
-            if len(finished_domains) > 0:
-                pipe = redis.pipeline()
-                hashes = []
-                for domain in finished_domains:
-                    hash = f"rq:job:{domain}"
-                    hashes.append(hash)
-                    pipe.hget(hash, "result")
-                results = pipe.execute()
+        failed_count = 0
+        feeding = bool(max_jobs)
+        if feeding:
+            sys.stderr.write(f"{timestamp()} Feeding the job queue, keeping at most {max_jobs} jobs in it…\n")
+            redis.set(FEEDING_KEY, 1)
+            domain_count, feeding = feed_queue(input_file, redis, queue, max_jobs, timeout, batch_size)
+        else:
+            sys.stderr.write(
+                f"{timestamp()} Creating job queue…\n")
+            redis.set("locked", 1)
+            read_domains = []
+            for line in input_file:
+                read_domains.append(line.rstrip())
+                if len(read_domains) == INPUT_CHUNK_SIZE:
+                    domain_count = domain_count + create_jobs(read_domains, push_results, queue=queue,
+                                                              redis=redis, timeout=timeout, batch_size=batch_size)
+                    sys.stderr.write(f"{timestamp()} {domain_count}\n")
+                    read_domains = []
+            domain_count = domain_count + create_jobs(read_domains, push_results, queue=queue,
+                                                      redis=redis, timeout=timeout, batch_size=batch_size)
+            sys.stderr.write(f"{timestamp()} {domain_count}\n")
+            input_file.close()
+
+            sys.stderr.write(f"{timestamp()} Created jobs for {domain_count} domains. "
+                             "Unlocking queue and waiting for workers…\n")
+
+            redis.set("locked", 0)
+
+        # workers push results into a stream, they are read in batches (blocking until there are some) and then
+        # acknowledged & deleted, so there's no polling and each result is handled just once
+        last_progress = monotonic()
+        # results are passed to the output as they came, without decoding them
+        while feeding or finished_count < domain_count:
+            streams = redis.xreadgroup(RESULTS_GROUP, "controller", {RESULTS_STREAM: ">"},
+                                       count=RESULTS_BATCH_SIZE, block=POLL_INTERVAL * 1000)
+            if streams:
+                ids = []
+                for entry_id, fields in streams[0][1]:
+                    if b"result_zstd" in fields:
+                        output.write(decompressor.decompress(fields[b"result_zstd"]))
+                    elif b"result" in fields:
+                        output.write(fields[b"result"])
+                    else:
+                        failed_count = failed_count + 1
+                        sys.stderr.write(f"{timestamp()} {fields[b'domain'].decode('utf-8')} failed: "
+                                         f"{fields[b'error'].decode('utf-8')}\n")
+                    ids.append(entry_id)
                 pipe = redis.pipeline()
-                count = 0
-                for index, result in enumerate(results):
-                    if result:
-                        count = count + 1
-                        try:
-                            print(pickle.loads(result))
-                        except pickle.UnpicklingError:
-                            sys.stderr.write(f"{timestamp()} UnpicklingError: {hashes[index]}\n")
-                            continue
-                        else:
-                            pipe.delete(hashes[index])
+                pipe.xack(RESULTS_STREAM, RESULTS_GROUP, *ids)
+                pipe.xdel(RESULTS_STREAM, *ids)
                 pipe.execute()
-                finished_count = finished_count + count
-            sys.stderr.write(f"{timestamp()} {finished_count}/{domain_count}\n")
-            sleep(POLL_INTERVAL)
+                finished_count = finished_count + len(ids)
+            if feeding:
+                created_count, feeding = feed_queue(input_file, redis, queue, max_jobs, timeout, batch_size)
+                domain_count = domain_count + created_count
+            if monotonic() - last_progress >= POLL_INTERVAL or finished_count == domain_count:
+                sys.stderr.write(f"{timestamp()} {finished_count}/{domain_count}\n")
+                last_progress = monotonic()
+        if failed_count > 0:
+            sys.stderr.write(f"{timestamp()} {failed_count} domains failed.\n")
+        output.close()
+        print_stats(redis)
         queue.delete(delete_jobs=True)
         sys.exit(0)
 
     except KeyboardInterrupt:
         created_count = queue.count
         sys.stderr.write(f"{timestamp()} Cancelled. Deleting {created_count} jobs…\n")
+        output.close()
         redis.flushdb()
         sys.stderr.write(f"{timestamp()} All jobs deleted, exiting.\n")
         sys.exit(1)
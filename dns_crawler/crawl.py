@@ -22,49 +22,81 @@ import dns.resolver
 
 from copy import deepcopy
 from datetime import datetime
-from socket import gethostname
+from threading import Lock
+from time import time
 
-from rq import get_current_connection
+from rq import get_current_connection, get_current_job
+from rq.timeouts import BaseTimeoutException
 
-from .config_loader import default_config_filename, load_config
-from .dns_utils import (annotate_dns_algorithm, check_dnssec,
-                        get_local_resolver, get_ns_info, get_record,
-                        get_record_parser, get_txt, parse_dmarc, parse_spf,
-                        parse_tlsa, get_dkim)
-from .geoip_utils import annotate_geoip, init_geoip
+from .cache import JobCache
+from .context import get_crawl_context
+from .dns_utils import (QueryMemo, check_dnssec, get_ns_cache_key, get_ns_host_cache_key, get_ns_info,
+                        get_record, get_record_parser, get_records, get_txt,
+                        parse_dmarc, parse_spf, parse_tlsa)
+from .geoip_utils import annotate_geoip_many
 from .hsts_utils import get_hsts_status
-from .ip_utils import get_source_addresses
-from .mail_utils import get_mx_info
+from .incremental import get_zone_state
+from .mail_utils import get_mail_host_cache_key, get_mx_hosts, get_mx_info
+from .redis_utils import RESULTS_STREAM
+from .stats import flush_stats, increment
 from .web_utils import get_webserver_info
 
 
-def get_dns_local(domain, config, local_resolver, geoip_dbs):
+def get_dns_local(domain, config, local_resolver, geoip_dbs, executor, memo=None):
+    check_www = config["dns"]["check_www"]
+    dkim_selectors = config["dns"]["dkim_selectors"]
+    queries = [
+        (domain, "TXT"),
+        (domain, "NS"),
+        (domain, "MX"),
+        (domain, "A"),
+        (domain, "AAAA"),
+        ("_443._tcp." + domain, "TLSA"),
+        ("_dmarc." + domain, "TXT"),
+        ("_openid." + domain, "TXT"),
+        ("_mta-sts." + domain, "TXT"),
+        (domain, "DS"),
+        (domain, "DNSKEY"),
+        (domain, "SOA")
+    ]
+    if check_www:
+        queries += [("www." + domain, "A"), ("www." + domain, "AAAA"), ("_443._tcp.www." + domain, "TLSA")]
+    queries += [(selector + "._domainkey." + domain, "TXT") for selector in dkim_selectors]
+    queries += [(domain, record) for record in config["dns"]["additional"]]
+
+    dnssec = executor.submit(check_dnssec, domain, local_resolver)
+    records = get_records(queries, local_resolver, executor, memo=memo)
+
     result = {}
-    txt = get_record(domain, "TXT", local_resolver)
-    result["NS_AUTH"] = get_record(domain, "NS", local_resolver)
-    result["MAIL"] = get_record(domain, "MX", local_resolver)
-    result["WEB4"] = annotate_geoip(get_record(domain, "A", local_resolver), geoip_dbs)
-    if config["dns"]["check_www"]:
-        result["WEB4_www"] = annotate_geoip(get_record("www." + domain, "A", local_resolver), geoip_dbs)
-    result["WEB6"] = annotate_geoip(get_record(domain, "AAAA", local_resolver), geoip_dbs)
-    if config["dns"]["check_www"]:
-        result["WEB6_www"] = annotate_geoip(get_record("www." + domain, "AAAA", local_resolver), geoip_dbs)
-    result["WEB_TLSA"] = parse_tlsa(get_record("_443._tcp." + domain, "TLSA", local_resolver))
-    if config["dns"]["check_www"]:
-        result["WEB_TLSA_www"] = parse_tlsa(get_record("_443._tcp.www." + domain, "TLSA", local_resolver))
+    txt = records[(domain, "TXT")]
+    result["NS_AUTH"] = records[(domain, "NS")]
+    result["MAIL"] = records[(domain, "MX")]
+    web_hosts = [domain, "www." + domain] if check_www else [domain]
+    annotate_geoip_many([records[(host, record)] for host in web_hosts for record in ("A", "AAAA")], geoip_dbs)
+    result["WEB4"] = records[(domain, "A")]
+    if check_www:
+        result["WEB4_www"] = records[("www." + domain, "A")]
+    result["WEB6"] = records[(domain, "AAAA")]
+    if check_www:
+        result["WEB6_www"] = records[("www." + domain, "AAAA")]
+    result["WEB_TLSA"] = parse_tlsa(records[("_443._tcp." + domain, "TLSA")])
+    if check_www:
+        result["WEB_TLSA_www"] = parse_tlsa(records[("_443._tcp.www." + domain, "TLSA")])
     result["TXT"] = txt
     if txt:
         result["TXT_SPF"] = parse_spf(get_txt(re.compile('^"?v=spf'), deepcopy(txt)), domain)
-    result["TXT_DMARC"] = parse_dmarc(get_record("_dmarc." + domain, "TXT", local_resolver), domain)
-    result["TXT_openid"] = get_record("_openid." + domain, "TXT", local_resolver)
-    result["TXT_MTA_STS"] = get_record("_mta-sts." + domain, "TXT", local_resolver)
-    result["TXT_DKIM"] = get_dkim(domain, config["dns"]["dkim_selectors"], local_resolver)
-    result["DS"] = annotate_dns_algorithm(get_record(domain, "DS", local_resolver), 1)
-    result["DNSKEY"] = annotate_dns_algorithm(get_record(domain, "DNSKEY", local_resolver), 2)
-    result["DNSSEC"] = check_dnssec(domain, local_resolver)
+    result["TXT_DMARC"] = parse_dmarc(records[("_dmarc." + domain, "TXT")], domain)
+    result["TXT_openid"] = records[("_openid." + domain, "TXT")]
+    result["TXT_MTA_STS"] = records[("_mta-sts." + domain, "TXT")]
+    result["TXT_DKIM"] = {selector: records[(selector + "._domainkey." + domain, "TXT")]
+                          for selector in dkim_selectors}
+    result["DS"] = records[(domain, "DS")]
+    result["DNSKEY"] = records[(domain, "DNSKEY")]
+    result["SOA"] = records[(domain, "SOA")]
+    result["DNSSEC"] = dnssec.result()
     additional = {}
     for record in config["dns"]["additional"]:
-        values = get_record(domain, record, local_resolver)
+        values = records[(domain, record)]
         parser = get_record_parser(record)
         if parser is not None:
             additional[record] = parser(values, domain)
@@ -73,69 +105,98 @@ def get_dns_local(domain, config, local_resolver, geoip_dbs):
     return dict(result, **additional)
 
 
-def get_dns_auth(domain, nameservers, redis, config, local_resolver, geoip_dbs):
-    source_ipv4, source_ipv6 = get_source_addresses(redis=redis, config=config)
+def get_auth_server_info(ip, domain, chaosrecords, geoip_dbs, timeout, fingerprint_enabled, cache):
+    ns_info = get_ns_info(ip, domain, chaosrecords, geoip_dbs, timeout, fingerprint_enabled, cache)
+    ns_resolver = dns.resolver.Resolver(configure=False)
+    ns_resolver.nameservers = [ip["value"]]
+    try:
+        glue = get_record(domain, "NS", ns_resolver)
+    except (EOFError,
+            OSError,
+            TimeoutError,
+            dns.exception.Timeout,
+            dns.query.BadResponse,
+            dns.exception.FormError,
+            ConnectionRefusedError) as e:
+        glue = {"error": str(e)}
+    # ns_info can come from the cache and be shared with other domains, so the glue goes into a copy
+    return dict(ns_info, glue=glue)
+
+
+def get_ns_addresses(nameservers, local_resolver, executor, memo=None, address_cache=None):
+    ns_names = {item.get("value") for records in nameservers if records for item in records if item.get("value")}
+    addresses = {}
+    if address_cache is not None:
+        cached = address_cache.get_many([get_ns_host_cache_key(ns) for ns in ns_names])
+        for ns in ns_names:
+            entry = cached[get_ns_host_cache_key(ns)]
+            if entry is not None and entry["expires"] > time():
+                addresses[(ns, "A")] = entry["A"]
+                addresses[(ns, "AAAA")] = entry["AAAA"]
+        increment("ns_address_cache_hits", len(addresses) // 2)
+    queries = [(ns, record) for ns in ns_names if (ns, "A") not in addresses for record in ("A", "AAAA")]
+    if not queries:
+        return addresses
+    resolved = get_records(queries, local_resolver, executor, memo=memo, with_ttl=True)
+    for query, (ips, _) in resolved.items():
+        addresses[query] = ips
+    if address_cache is not None:
+        for ns in {ns for ns, _ in queries}:
+            ttls = [resolved[(ns, record)][1] for record in ("A", "AAAA")]
+            # kept for as long as the records' TTL allows, not cached if the resolver didn't answer
+            if None not in ttls and min(ttls) > 0:
+                address_cache.set(get_ns_host_cache_key(ns), {
+                    "A": addresses[(ns, "A")],
+                    "AAAA": addresses[(ns, "AAAA")],
+                    "expires": time() + min(ttls)
+                })
+    return addresses
+
+
+# The parent zone's name servers are the same for most domains in a crawl, so they (and their addresses) are resolved
+# once and shared through the cache; only the glue is queried for each domain
+def get_parent_ns(zone, local_resolver, cache, executor, memo=None, address_cache=None):
+    cache_key = f"cache-zone-{zone}"
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached["ns"], {(ns, record): ips for ns, record, ips in cached["addresses"]}
+    nameservers = get_record(zone, "NS", local_resolver, memo=memo)
+    addresses = get_ns_addresses([nameservers], local_resolver, executor, memo=memo, address_cache=address_cache)
+    if nameservers:
+        cache.set(cache_key, {
+            "ns": nameservers,
+            "addresses": [[ns, record, ips] for (ns, record), ips in addresses.items()]
+        })
+    return nameservers, addresses
+
+
+def get_dns_auth(domain, nameservers, ns_addresses, cache, config, geoip_dbs, source_ipv4, source_ipv6, executor):
     timeout = config["timeouts"]["dns"]
-    cache_timeout = config["timeouts"]["cache"]
     chaosrecords = config["dns"]["auth_chaos_txt"]
     fingerprint_enabled = config["dns"]["fingerprint"]
     if not nameservers or len(nameservers) < 1:
         return None
+    ns_names = [item.get("value") for item in nameservers if item.get("value")]
+    families = [("A", "ipv4", source_ipv4), ("AAAA", "ipv6", source_ipv6)]
+    probes = {}
+    for ns in ns_names:
+        for record, family, source_ip in families:
+            ips = ns_addresses[(ns, record)]
+            if ips is None or source_ip is None:
+                continue
+            probes[(ns, family)] = [executor.submit(get_auth_server_info, ip, domain, chaosrecords, geoip_dbs,
+                                                    timeout, fingerprint_enabled, cache)
+                                    for ip in ips if "value" in ip and ip["value"] is not None]
     results = []
-    for item in nameservers:
-        ns = item["value"]
-        if not ns:
-            continue
-        a = get_record(ns, "A", local_resolver)
-        aaaa = get_record(ns, "AAAA", local_resolver)
-        ipv4_results = []
-        ipv6_results = []
-        ns_resolver = dns.resolver.Resolver(configure=False)
-        if a is not None and source_ipv4 is not None:
-            for ipv4 in a:
-                if "value" not in ipv4 or ipv4["value"] is None:
-                    continue
-                ns_resolver.nameservers = [ipv4["value"]]
-                ns_info = get_ns_info(ipv4, domain, chaosrecords, geoip_dbs, timeout,
-                                      cache_timeout, fingerprint_enabled, redis)
-                try:
-                    ns_info["glue"] = get_record(domain, "NS", ns_resolver)
-                except (EOFError,
-                        OSError,
-                        TimeoutError,
-                        dns.exception.Timeout,
-                        dns.query.BadResponse,
-                        dns.exception.FormError,
-                        ConnectionRefusedError) as e:
-                    ns_info["glue"] = {"error": str(e)}
-                if ns_info:
-                    ipv4_results.append(ns_info)
-        if aaaa is not None and source_ipv6 is not None:
-            for ipv6 in aaaa:
-                if "value" not in ipv6 or ipv6["value"] is None:
-                    continue
-                ns_resolver.nameservers = [ipv6["value"]]
-                ns_info = get_ns_info(ipv6, domain, chaosrecords, geoip_dbs, timeout,
-                                      cache_timeout, fingerprint_enabled, redis)
-                try:
-                    ns_info["glue"] = get_record(domain, "NS", ns_resolver)
-                except (EOFError,
-                        OSError,
-                        TimeoutError,
-                        dns.exception.Timeout,
-                        dns.query.BadResponse,
-                        dns.exception.FormError,
-                        ConnectionRefusedError) as e:
-                    ns_info["glue"] = {"error": str(e)}
-                if ns_info:
-                    ipv6_results.append(ns_info)
+    for ns in ns_names:
         result = {
             "ns": ns,
         }
-        if len(ipv4_results) > 0:
-            result["ipv4"] = ipv4_results
-        if len(ipv6_results) > 0:
-            result["ipv6"] = ipv6_results
+        for _, family, _ in families:
+            family_results = [probe.result() for probe in probes.get((ns, family), [])]
+            family_results = [ns_info for ns_info in family_results if ns_info]
+            if len(family_results) > 0:
+                result[family] = family_results
         results.append(result)
     return results
 
@@ -170,41 +231,104 @@ def get_web_status(domain, dns, config, source_ipv4, source_ipv6, geoip_dbs, pat
     return result
 
 
-def process_domain(domain):
-    redis = get_current_connection()
-    hostname = gethostname()
-    config = load_config(default_config_filename, redis=redis, hostname=hostname)
-    source_ipv4, source_ipv6 = get_source_addresses(redis=redis, config=config)
-    geoip_dbs = init_geoip(config)
-    local_resolver = get_local_resolver(config)
-    parent_zone = str(dns.name.from_text(domain).parent())
-    parent_ns = get_record(parent_zone, "NS", local_resolver)
-    parent_ns_info = get_dns_auth(domain, parent_ns, redis, config, local_resolver, geoip_dbs)
-    dns_local = get_dns_local(domain, config, local_resolver, geoip_dbs)
-    dns_auth = get_dns_auth(domain, dns_local["NS_AUTH"], redis, config, local_resolver, geoip_dbs)
+def get_timestamp():
+    return datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def get_mx_records(domain, dns_local):
     if dns_local["MAIL"]:
-        mail = get_mx_info(dns_local["MAIL"], config["mail"]["ports"], geoip_dbs, config["timeouts"]["mail"],
-                           config["mail"]["get_banners"], config["timeouts"]["cache"],
-                           local_resolver, redis, source_ipv4, source_ipv6, config["mail"]["max_ips_per_host"])
-    elif dns_local["WEB4"] or dns_local["WEB6"]:
-        mail = get_mx_info([{"value": domain}], config["mail"]["ports"], geoip_dbs, config["timeouts"]["mail"],
-                           config["mail"]["get_banners"], config["timeouts"]["cache"],
-                           local_resolver, redis, source_ipv4, source_ipv6, config["mail"]["max_ips_per_host"])
-    else:
-        mail = None
+        return dns_local["MAIL"]
+    if dns_local["WEB4"] or dns_local["WEB6"]:
+        return [{"value": domain}]
+    return None
+
+
+def get_web_paths(domain, dns_local, config, source_ipv4, source_ipv6, geoip_dbs):
+    return {path: get_web_status(domain, dns_local, config, source_ipv4, source_ipv6, geoip_dbs, path=path)
+            for path in config["web"]["paths"]}
+
+
+# Domains with the same SOA serial, NS and DS records as in the previous crawl get the previous DNS results,
+# only the probes from `incremental.probes` are run again. None if the domain has changed (or wasn't crawled before).
+def get_unchanged_result(domain, context, cache, memo, executor):
+    state, result = context.previous_results.get(domain)
+    if result is None:
+        return None
+    queries = [(domain, "SOA"), (domain, "NS"), (domain, "DS")]
+    records = get_records(queries, context.local_resolver, executor, memo=memo)
+    if get_zone_state(*(records[query] for query in queries)) != state:
+        increment("incremental_changed")
+        return None
+    increment("incremental_unchanged")
+    config = context.config
+    source_ipv4, source_ipv6 = context.source_ipv4, context.source_ipv6
+    dns_local = result["results"]["DNS_LOCAL"]
+    probes = config["incremental"]["probes"]
+    if "MAIL" in probes:
+        result["results"]["MAIL"] = get_mx_info(get_mx_records(domain, dns_local), config["mail"]["ports"],
+                                                context.geoip_dbs, config["timeouts"]["mail"],
+                                                config["mail"]["get_banners"], cache, context.local_resolver,
+                                                source_ipv4, source_ipv6, config["mail"]["max_ips_per_host"],
+                                                memo=memo)
+    if "WEB" in probes:
+        result["results"]["WEB"] = get_web_status(domain, dns_local, config, source_ipv4, source_ipv6,
+                                                  context.geoip_dbs)
+        if config["web"].get("paths"):
+            result["results"]["WEB_paths"] = get_web_paths(domain, dns_local, config, source_ipv4, source_ipv6,
+                                                           context.geoip_dbs)
+    result["results"]["HSTS"] = get_hsts_status(domain)
+    # the DNS results might have been reused several times already
+    result["dns_timestamp"] = result.get("dns_timestamp", result["timestamp"])
+    result["timestamp"] = get_timestamp()
+    if config["save_worker_hostname"]:
+        result["worker_hostname"] = context.hostname
+    return result
+
+
+def process_domain(domain, context=None):
+    if context is None:
+        context = get_crawl_context(get_current_connection())
+    cache = JobCache(context.cache)
+    hostname = context.hostname
+    config = context.config
+    source_ipv4, source_ipv6 = context.source_ipv4, context.source_ipv6
+    geoip_dbs = context.geoip_dbs
+    local_resolver = context.local_resolver
+    parent_zone = str(dns.name.from_text(domain).parent())
+    memo = QueryMemo()
+    query_executor, probe_executor = context.get_job_executors()
+    if context.previous_results is not None:
+        result = get_unchanged_result(domain, context, cache, memo, query_executor)
+        if result is not None:
+            return result
+    parent_ns, parent_ns_addresses = get_parent_ns(parent_zone, local_resolver, cache, query_executor,
+                                                   memo=memo, address_cache=context.ns_address_cache)
+    dns_local = get_dns_local(domain, config, local_resolver, geoip_dbs, query_executor, memo=memo)
+    mx_records = get_mx_records(domain, dns_local)
+    ns_addresses = {**parent_ns_addresses,
+                    **get_ns_addresses([dns_local["NS_AUTH"]], local_resolver, query_executor, memo=memo,
+                                       address_cache=context.ns_address_cache)}
+    cache.prefetch([get_ns_cache_key(ip["value"]) for ips in ns_addresses.values() if ips
+                    for ip in ips if ip.get("value")] +
+                   [get_mail_host_cache_key(host) for host in get_mx_hosts(mx_records)])
+    parent_ns_info = get_dns_auth(domain, parent_ns, ns_addresses, cache, config, geoip_dbs,
+                                  source_ipv4, source_ipv6, probe_executor)
+    dns_auth = get_dns_auth(domain, dns_local["NS_AUTH"], ns_addresses, cache, config, geoip_dbs,
+                            source_ipv4, source_ipv6, probe_executor)
+    mail = get_mx_info(mx_records, config["mail"]["ports"], geoip_dbs, config["timeouts"]["mail"],
+                       config["mail"]["get_banners"], cache,
+                       local_resolver, source_ipv4, source_ipv6, config["mail"]["max_ips_per_host"], memo=memo)
     web = get_web_status(domain, dns_local, config, source_ipv4, source_ipv6, geoip_dbs)
     hsts = get_hsts_status(domain)
 
     fetch_web_paths = "paths" in config["web"] and len(config["web"]["paths"]) > 0
 
     if fetch_web_paths:
-        web_paths = {}
-        for path in config["web"]["paths"]:
-            web_paths[path] = get_web_status(domain, dns_local, config, source_ipv4, source_ipv6, path=path)
+        web_paths = get_web_paths(domain, dns_local, config, source_ipv4, source_ipv6, geoip_dbs)
 
     result = {
         "domain": domain,
-        "timestamp": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+        "timestamp": get_timestamp(),
         "parent": {
             "zone": parent_zone,
             "ns": parent_ns_info
@@ -229,3 +353,72 @@ def process_domain(domain):
 
 def get_json_result(domain):
     return json.dumps(process_domain(domain), ensure_ascii=False, check_circular=False, separators=(",", ":"))
+
+
+# Jobs running in the worker process itself can be given to another worker (or failed) by the watchdog while they're
+# still running, so their results are claimed first – whoever claims a job's results first (the job pushing them,
+# or the watchdog giving the job up) is the only one to put anything for its domains into the stream
+class ResultClaims:
+    PUSHED = "pushed"
+    ABANDONED = "abandoned"
+
+    def __init__(self):
+        self.claims = {}
+        self.lock = Lock()
+
+    # the pipeline is executed while holding the lock, so once a job is abandoned, its results either are in the
+    # stream already or they never will be
+    def push(self, job_id, pipe):
+        with self.lock:
+            if job_id is not None and self.claims.setdefault(job_id, self.PUSHED) != self.PUSHED:
+                return False
+            pipe.execute()
+            return True
+
+    # True if the job's results weren't pushed (and now they won't be)
+    def abandon(self, job_id):
+        with self.lock:
+            return self.claims.setdefault(job_id, self.ABANDONED) == self.ABANDONED
+
+    def release(self, job_id):
+        with self.lock:
+            self.claims.pop(job_id, None)
+
+
+result_claims = ResultClaims()
+
+
+# Results of a batch are pushed together (with the stats, so they're counted before the controller sees the results),
+# failed domains get an error entry instead of a result
+def push_results(domains):
+    redis = get_current_connection()
+    compressor = get_crawl_context(redis).compressor
+    pipe = redis.pipeline()
+    for index, domain in enumerate(domains):
+        try:
+            result = get_json_result(domain)
+            if compressor is not None:
+                pipe.xadd(RESULTS_STREAM, {"result_zstd": compressor.compress(result.encode("utf-8"))})
+            else:
+                pipe.xadd(RESULTS_STREAM, {"result": result})
+        except BaseTimeoutException:
+            # the whole job is out of time, so this and all remaining domains fail
+            for failed_domain in domains[index:]:
+                pipe.xadd(RESULTS_STREAM, {"domain": failed_domain, "error": "Job timed out"})
+            break
+        except Exception as e:  # noqa: BLE001 (one broken domain mustn't fail the whole batch)
+            pipe.xadd(RESULTS_STREAM, {"domain": domain, "error": repr(e)})
+    flush_stats(pipe)
+    job = get_current_job()
+    result_claims.push(job.id if job is not None else None, pipe)
+
+
+# Jobs can also fail as a whole (work horse killed, stuck job stopped by the watchdog…), their domains get an error
+# entry too, so the controller doesn't wait for them
+def push_failed_job(job, error, redis):
+    if job.func_name != f"{push_results.__module__}.{push_results.__name__}":
+        return
+    pipe = redis.pipeline()
+    for domain in job.args[0]:
+        pipe.xadd(RESULTS_STREAM, {"domain": domain, "error": error})
+    pipe.execute()
@@ -0,0 +1,282 @@
+# Copyright © 2019-2023 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import mmap
+import re
+import struct
+import sys
+import zlib
+from array import array
+from hashlib import blake2b
+from os.path import basename
+
+from .output import OutputError
+from .timestamp import timestamp
+
+# Parts of a result which are hashed (and compared) separately, `parent` is the top-level field, the rest are in
+# `results`
+SECTIONS = ["parent", "DNS_LOCAL", "DNS_AUTH", "MAIL", "WEB", "WEB_paths", "HSTS"]
+HASH_SIZE = 8
+INDEX_MAGIC = b"DCDI"
+INDEX_HEADER = INDEX_MAGIC + struct.pack("<B", len(SECTIONS))
+# offset of the slot table, number of slots and number of domains, at the end of the index
+INDEX_FOOTER = struct.Struct("<QQQ")
+
+# Fields which change with time even if nothing else did
+VOLATILE_FIELDS = {"expires_in", "expired_for"}
+# Response headers (in web redirect steps) which differ with every request
+VOLATILE_HEADERS = {"date", "age", "expires", "set-cookie"}
+# Lists where the order matters (redirects, certificate chains), other ones (records, IPs, name servers) are sorted,
+# since their order can differ in every response
+ORDERED_FIELDS = {"steps", "cert"}
+
+message_id_re = re.compile(r"^id \d+\n")
+
+
+def dump(item):
+    return json.dumps(item, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+
+
+def strip_volatile_headers(step):
+    if isinstance(step, dict) and isinstance(step.get("headers"), dict):
+        return dict(step, headers={name: value for name, value in step["headers"].items()
+                                   if name.lower() not in VOLATILE_HEADERS})
+    return step
+
+
+def normalize_field(key, value):
+    if key == "answer" and isinstance(value, str):
+        return message_id_re.sub("", value)
+    if key == "steps" and isinstance(value, list):
+        value = [strip_volatile_headers(step) for step in value]
+    return normalize(value, key in ORDERED_FIELDS)
+
+
+def normalize(item, ordered=False):
+    if isinstance(item, dict):
+        return {key: normalize_field(key, value) for key, value in item.items() if key not in VOLATILE_FIELDS}
+    if isinstance(item, list):
+        items = [normalize(value) for value in item]
+        return items if ordered else sorted(items, key=dump)
+    return item
+
+
+# Hashes of all sections, concatenated in the order of SECTIONS
+def get_section_hashes(result):
+    sections = dict(result.get("results") or {}, parent=result.get("parent"))
+    return b"".join(blake2b(dump(normalize(sections.get(name))).encode("utf-8"), digest_size=HASH_SIZE).digest()
+                    for name in SECTIONS)
+
+
+def get_changed_sections(previous, current):
+    return [name for i, name in enumerate(SECTIONS)
+            if previous[i * HASH_SIZE:(i + 1) * HASH_SIZE] != current[i * HASH_SIZE:(i + 1) * HASH_SIZE]]
+
+
+# The index is a header (magic, section count), records (domain length (2 bytes), domain, section hashes), and an open
+# addressing hash table of the records' offsets (0 for empty slots), written at the end when all domains are known.
+# The footer says where the table starts, how many slots it has and how many domains are in it.
+class HashIndexWriter:
+    def __init__(self, filename):
+        self.file = open(filename, "w+b")  # noqa: SIM115 (written until close())
+        self.file.write(INDEX_HEADER)
+        self.offsets = array("Q")
+
+    def write(self, domain, hashes):
+        name = domain.encode("utf-8")
+        self.offsets.append(self.file.tell())
+        self.file.write(struct.pack("<H", len(name)) + name + hashes)
+
+    def close(self):
+        self.file.flush()
+        slot_count = 1 << (len(self.offsets) * 2).bit_length()
+        slots = array("Q", bytes(8 * slot_count))
+        count = 0
+        # the records are read back to place them, a domain written more than once keeps its last hashes
+        with mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for offset in self.offsets:
+                name = get_record_name(data, offset)
+                slot = zlib.crc32(name) & (slot_count - 1)
+                while slots[slot] and get_record_name(data, slots[slot]) != name:
+                    slot = (slot + 1) & (slot_count - 1)
+                if not slots[slot]:
+                    count = count + 1
+                slots[slot] = offset
+        if sys.byteorder != "little":
+            slots.byteswap()
+        table_offset = self.file.tell()
+        self.file.write(slots.tobytes())
+        self.file.write(INDEX_FOOTER.pack(table_offset, slot_count, count))
+        self.file.close()
+
+
+def get_record_name(data, offset):
+    (length,) = struct.unpack_from("<H", data, offset)
+    return data[offset + 2:offset + 2 + length]
+
+
+# Hash index of the previous crawl, memory-mapped instead of loaded, so it doesn't take memory for every domain.
+# Domains are popped as they're seen (marked in a bytearray, one byte per slot), the rest are the removed ones.
+class HashIndex:
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        size = len(self.data)
+        valid = self.data[:len(INDEX_HEADER)] == INDEX_HEADER and size >= len(INDEX_HEADER) + INDEX_FOOTER.size
+        if valid:
+            self.table_offset, self.slot_count, self.remaining = INDEX_FOOTER.unpack_from(self.data,
+                                                                                          size - INDEX_FOOTER.size)
+            valid = self.slot_count > 0 and self.slot_count & (self.slot_count - 1) == 0 and \
+                self.table_offset + 8 * self.slot_count + INDEX_FOOTER.size == size
+        if not valid:
+            self.data.close()
+            raise OutputError(f"'{filename}' is not a hash index of results (or it's from an incompatible version).")
+        self.record_size = len(SECTIONS) * HASH_SIZE
+        self.seen = bytearray(self.slot_count)
+
+    def get_offset(self, slot):
+        return struct.unpack_from("<Q", self.data, self.table_offset + 8 * slot)[0]
+
+    # section hashes of the domain, None if it isn't in the index (or it was popped already)
+    def pop(self, domain):
+        name = domain.encode("utf-8")
+        slot = zlib.crc32(name) & (self.slot_count - 1)
+        while True:
+            offset = self.get_offset(slot)
+            if not offset:
+                return None
+            if get_record_name(self.data, offset) == name:
+                break
+            slot = (slot + 1) & (self.slot_count - 1)
+        if self.seen[slot]:
+            return None
+        self.seen[slot] = 1
+        self.remaining = self.remaining - 1
+        position = offset + 2 + len(name)
+        return self.data[position:position + self.record_size]
+
+    def __len__(self):
+        return self.remaining
+
+    # domains which weren't popped
+    def __iter__(self):
+        for slot in range(self.slot_count):
+            offset = self.get_offset(slot)
+            if offset and not self.seen[slot]:
+                yield get_record_name(self.data, offset).decode("utf-8")
+
+    def close(self):
+        self.data.close()
+
+
+# Wraps another sink – only results which changed since the previous crawl (according to its hash index) are written,
+# with a `changed` field listing the changed sections (null for domains which weren't in the previous crawl).
+# Unchanged domains go to a separate list, and so do the ones from the previous crawl which weren't seen again.
+class DeltaSink:
+    def __init__(self, sink, previous=None, index=None, unchanged=None, removed=None):
+        self.sink = sink
+        self.previous = HashIndex(previous) if previous else None
+        self.index = HashIndexWriter(index) if index else None
+        self.unchanged = open(unchanged, "w", encoding="utf-8") if unchanged else None  # noqa: SIM115
+        self.removed = removed
+        self.counts = {"new": 0, "changed": 0, "unchanged": 0}
+
+    def write(self, result):
+        parsed = json.loads(result)
+        domain = parsed["domain"]
+        hashes = get_section_hashes(parsed)
+        if self.index:
+            self.index.write(domain, hashes)
+        if self.previous is None:
+            self.sink.write(result)
+            return
+        # seen domains are popped from the previous index, what's left at the end are the removed ones
+        previous = self.previous.pop(domain)
+        if previous == hashes:
+            self.counts["unchanged"] = self.counts["unchanged"] + 1
+            if self.unchanged:
+                self.unchanged.write(domain + "\n")
+            return
+        if previous is None:
+            self.counts["new"] = self.counts["new"] + 1
+            changed = None
+        else:
+            self.counts["changed"] = self.counts["changed"] + 1
+            changed = get_changed_sections(previous, hashes)
+        # the result is written as it came, just with the extra field before the closing brace
+        self.sink.write(result.rstrip()[:-1] + b',"changed":' + json.dumps(changed).encode("utf-8") + b"}")
+
+    def close(self):
+        self.sink.close()
+        if self.index:
+            self.index.close()
+        if self.unchanged:
+            self.unchanged.close()
+        if self.previous is not None:
+            if self.removed:
+                with open(self.removed, "w", encoding="utf-8") as f:
+                    f.writelines(domain + "\n" for domain in self.previous)
+            sys.stderr.write(f"{timestamp()} Delta: {self.counts['changed']} changed, {self.counts['new']} new, " +
+                             f"{self.counts['unchanged']} unchanged, {len(self.previous)} removed.\n")
+            self.previous.close()
+
+
+def get_delta_sink(sink, config):
+    delta = config["delta"]
+    if not delta["previous"] and not delta["save_index"]:
+        return sink
+    return DeltaSink(sink, delta["previous"], delta["save_index"], delta["unchanged"], delta["removed"])
+
+
+def print_help():
+    exe = basename(sys.argv[0])
+    sys.stderr.write(f"{exe} - builds a hash index of crawler results for the next delta output\n\n")
+    sys.stderr.write(f"Usage: {exe} <results> <index>\n")
+    sys.stderr.write("       results - results from dns-crawler or dns-crawler-controller (one JSON per line), " +
+                     "- for stdin\n")
+    sys.stderr.write("       index - file to save the index to\n\n")
+    sys.stderr.write(f"Example: {exe} results.json previous.idx\n")
+    sys.exit(1)
+
+
+def main():
+    if "-h" in sys.argv or "--help" in sys.argv or len(sys.argv) < 3:
+        print_help()
+
+    results_filename, index_filename = sys.argv[1:3]
+    try:
+        if results_filename == "-":
+            results_file = sys.stdin.buffer
+        else:
+            try:
+                results_file = open(results_filename, "rb")  # noqa: SIM115 (it can be stdin)
+            except FileNotFoundError:
+                sys.stderr.write(f"File '{results_filename}' does not exist.\n\n")
+                print_help()
+        sys.stderr.write(f"{timestamp()} Reading results from {results_filename}.\n")
+        index = HashIndexWriter(index_filename)
+        count = 0
+        for line in results_file:
+            result = json.loads(line)
+            index.write(result["domain"], get_section_hashes(result))
+            count = count + 1
+        index.close()
+        sys.stderr.write(f"{timestamp()} Finished, {count} domains saved to {index_filename}.\n")
+    except KeyboardInterrupt:
+        sys.exit(1)
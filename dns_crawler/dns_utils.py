@@ -16,8 +16,11 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import json
 import re
+from concurrent.futures import Future
+from copy import deepcopy
+from threading import Lock
+from time import sleep, time
 
 import dns.dnssec
 import dns.name
@@ -25,7 +28,38 @@ import dns.resolver
 
 import checkdmarc
 
+from . import transport
+from .cache import LRUCache
 from .geoip_utils import geoip_single
+from .stats import increment
+
+
+# Parsed SPF and DMARC records by the record text and domain, shared by all jobs in the worker
+record_cache = LRUCache(0)
+
+
+# checkdmarc resolves SPF includes and redirects (and DMARC report destinations) through this cache. The same
+# provider records (eg. _spf.google.com) are then resolved just once for all workers.
+class CheckdmarcCache:
+    def __init__(self, cache):
+        self.cache = cache
+
+    # checkdmarc doesn't use an empty cache at all
+    def __bool__(self):
+        return True
+
+    def get(self, key, default=None):
+        value = self.cache.get(f"cache-checkdmarc-{key}")
+        return default if value is None else value
+
+    def __setitem__(self, key, value):
+        self.cache.set(f"cache-checkdmarc-{key}", value)
+
+
+def init_record_cache(cache, size, ttl):
+    global record_cache
+    record_cache = LRUCache(size, ttl=ttl)
+    checkdmarc.DNS_CACHE = CheckdmarcCache(cache)
 
 
 def get_local_resolver(config):
@@ -76,14 +110,14 @@ def check_dnssec(domain, resolver):
     sub = (dnsname.split(depth=depth))[1]
     q = dns.message.make_query(sub, "DNSKEY", want_dnssec=True)
     try:
-        response = dns.query.udp(q, resolver.nameservers[0], resolver.timeout, ignore_unexpected=True)
+        response = transport.query(q, resolver.nameservers[0], resolver.timeout, port=resolver.port)
     except dns.exception.Timeout:
         return {"valid": None, "error": "timeout"}
     except dns.exception.FormError as e:
         return {"valid": None, "error": str(e)}
     except dns.message.Truncated:
         try:
-            response = dns.query.tcp(q, resolver.nameservers[0], resolver.timeout)
+            response = transport.tcp(q, resolver.nameservers[0], resolver.timeout, port=resolver.port)
         except dns.exception.Timeout:
             return {"valid": None, "error": "timeout"}
 
@@ -127,32 +161,32 @@ def check_dnssec(domain, resolver):
     return {"valid": True, "rrsig": str(rrsig).split("\n")}
 
 
-def annotate_dns_algorithm(items, index, key="value"):
-    if items:
-        for item in items:
-            if not item[key]:
-                continue
-            try:
-                alg_number = item[key].split()[index]
-            except IndexError:
-                continue
-            else:
-                item["algorithm"] = dns.dnssec.algorithm_to_text(int(alg_number))
-    return items
+def parse_dmarc_record(record, domain):
+    try:
+        return checkdmarc.parse_dmarc_record(record, domain)["tags"]
+    except (checkdmarc.DMARCError) as e:
+        return {"error": str(e)}
+    except AttributeError as e:
+        return {"error": f"empty record? {str(e)}"}
+
+
+def get_parsed_record(parse, record, domain):
+    key = (parse.__name__, record, domain)
+    parsed = record_cache.get(key)
+    if parsed is None:
+        increment("parsed_record_misses")
+        parsed = parse(record, domain)
+        record_cache.set(key, parsed)
+    else:
+        increment("parsed_record_hits")
+    # cached ones are shared between jobs
+    return deepcopy(parsed)
 
 
 def parse_dmarc(items, domain, key="value"):
     if (not items) or len(items) == 0:
         return None
-    parsed = []
-    for item in items:
-        try:
-            r = checkdmarc.parse_dmarc_record(item[key], domain)
-            parsed.append(r["tags"])
-        except (checkdmarc.DMARCError) as e:
-            parsed.append({"error": str(e)})
-        except AttributeError as e:
-            parsed.append({"error": f"empty record? {str(e)}"})
+    parsed = [get_parsed_record(parse_dmarc_record, item[key], domain) for item in items]
     if len(parsed) == 0:
         return None
     return parsed
@@ -163,21 +197,23 @@ def get_spf_pass_ips(parsed_record, ipv):
             if "mechanism" in item and item["mechanism"] == f"ip{ipv}"]
 
 
+def parse_spf_record(record, domain):
+    try:
+        r = checkdmarc.parse_spf_record(record, domain)
+        if "pass" in r["parsed"]:
+            r["parsed"]["ip4"] = get_spf_pass_ips(r, 4)
+            r["parsed"]["ip6"] = get_spf_pass_ips(r, 6)
+        return r["parsed"]
+    except checkdmarc.SPFError as e:
+        return {"error": str(e)}
+    except AttributeError as e:
+        return {"error": f"empty record? {str(e)}"}
+
+
 def parse_spf(items, domain, key="value"):
     if (not items) or len(items) == 0:
         return None
-    parsed = []
-    for item in items:
-        try:
-            r = checkdmarc.parse_spf_record(item[key], domain)
-            if "pass" in r["parsed"]:
-                r["parsed"]["ip4"] = get_spf_pass_ips(r, 4)
-                r["parsed"]["ip6"] = get_spf_pass_ips(r, 6)
-            parsed.append(r["parsed"])
-        except checkdmarc.SPFError as e:
-            parsed.append({"error": str(e)})
-        except AttributeError as e:
-            parsed.append({"error": f"empty record? {str(e)}"})
+    parsed = [get_parsed_record(parse_spf_record, item[key], domain) for item in items]
     if len(parsed) == 0:
         return None
     return parsed
@@ -190,14 +226,7 @@ def parse_tlsa(items, key="value"):
     for item in items:
         if key not in item or item[key] is None:
             continue
-        output = {}
-        fields = item[key].split(" ")
-        output["usage"] = int(fields[0])
-        output["selector"] = int(fields[1])
-        output["matchingtype"] = int(fields[2])
-        output["data"] = fields[3]
-        item = {k: v for k, v in output.items() if v is not None}
-        parsed.append(item)
+        parsed.append({field: item[field] for field in ("usage", "selector", "matchingtype", "data")})
     if len(parsed) == 0:
         return None
     return parsed
@@ -215,14 +244,46 @@ def get_txt(regex, items, key="value"):
     return filtered
 
 
-def get_chaostxt(nameserver, qname, timeout):
+# dns.resolver.Resolver which sends its queries through the shared UDP sockets and TCP connections – the resolution
+# itself (retries, TCP for truncated answers, timeouts and the errors raised) is dnspython's own, the loop is the same
+# as in Resolver.resolve()
+class PooledResolver(dns.resolver.Resolver):
+    def resolve(self, qname, rdtype=dns.rdatatype.A, rdclass=dns.rdataclass.IN, tcp=False, source=None,
+                raise_on_no_answer=True, source_port=0, lifetime=None, search=None):
+        resolution = dns.resolver._Resolution(self, qname, rdtype, rdclass, tcp, raise_on_no_answer, search)
+        start = time()
+        while True:
+            (request, answer) = resolution.next_request()
+            if answer is not None:
+                return answer
+            done = False
+            while not done:
+                (nameserver, port, tcp, backoff) = resolution.next_nameserver()
+                if backoff:
+                    sleep(backoff)
+                timeout = self._compute_timeout(start, lifetime, resolution.errors)
+                try:
+                    if tcp:
+                        response = transport.tcp(request, nameserver, timeout, port=port)
+                    else:
+                        response = transport.udp(request, nameserver, timeout, port=port)
+                except Exception as ex:  # noqa: BLE001 (handed over to the resolution, like in dnspython)
+                    (_, done) = resolution.query_result(None, ex)
+                    continue
+                (answer, done) = resolution.query_result(response, None)
+                if answer is not None:
+                    return answer
+
+
+def get_chaostxt(nameserver, qname, timeout, port=53):
     result = None
     try:
-        resolver = dns.resolver.Resolver(configure=False)
+        resolver = PooledResolver(configure=False)
         resolver.nameservers = [nameserver]
+        resolver.port = port
         resolver.timeout = timeout
         resolver.lifetime = timeout
-        answers = resolver.query(qname, rdtype="TXT", rdclass="CHAOS", lifetime=timeout)
+        answers = resolver.resolve(qname, rdtype="TXT", rdclass="CHAOS", lifetime=timeout, search=True)
         answers_l = []
         for answer in answers:
             answers_l.append(str(answer).replace('"', ""))
@@ -235,8 +296,8 @@ def get_chaostxt(nameserver, qname, timeout):
 def fingerprint_ns(ip, domain, timeout):
     NSECs = [dns.rdatatype.NSEC, dns.rdatatype.NSEC3]
     try:
-        r = dns.query.tcp(dns.message.make_query(f"does-not-exist\x00does-not-exist.{domain}",
-                          dns.rdatatype.A, want_dnssec=True), ip, timeout=timeout)
+        r = transport.tcp(dns.message.make_query(f"does-not-exist\x00does-not-exist.{domain}",
+                          dns.rdatatype.A, want_dnssec=True), ip, timeout)
     except (EOFError,
             OSError,
             TimeoutError,
@@ -274,13 +335,19 @@ def fingerprint_ns(ip, domain, timeout):
     }
 
 
-def get_ns_info(ip, domain, chaosrecords, geoip_dbs, timeout, cache_timeout, fingerprint_enabled, redis):
-    cache_key = f"cache-ns-{ip['value']}"
-    if redis is not None:
-        cached = redis.get(cache_key)
-        if cached is not None:
-            redis.expire(cache_key, cache_timeout)
-            return json.loads(cached.decode("utf-8"))
+def get_ns_cache_key(ip):
+    return f"cache-ns-{ip}"
+
+
+def get_ns_host_cache_key(name):
+    return f"cache-nshost-{name}"
+
+
+def get_ns_info(ip, domain, chaosrecords, geoip_dbs, timeout, fingerprint_enabled, cache):
+    cache_key = get_ns_cache_key(ip["value"])
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
     if ip["value"] is None:
         return None
     geoip = geoip_single(ip["value"], geoip_dbs)
@@ -292,40 +359,87 @@ def get_ns_info(ip, domain, chaosrecords, geoip_dbs, timeout, cache_timeout, fin
         result["fingerprint"] = fingerprint_ns(ip["value"], domain, timeout)
     for record in chaosrecords:
         result[record.replace(".", "")] = get_chaostxt(ip["value"], record, timeout)
-    if redis is not None:
-        redis.set(cache_key, json.dumps(result), ex=cache_timeout)
+    cache.set(cache_key, result)
     return result
 
 
-def get_dkim(domain, selectors, resolver):
-    result = {}
-    for selector in selectors:
-        result[selector] = get_record(selector + "._domainkey." + domain, "TXT", resolver)
-    return result
+def get_mx_fields(rdata):
+    return {
+        "preference": rdata.preference,
+        "exchange": rdata.exchange.to_text()
+    }
+
+
+def get_tlsa_fields(rdata):
+    return {
+        "usage": rdata.usage,
+        "selector": rdata.selector,
+        "matchingtype": rdata.mtype,
+        "data": rdata.cert.hex()
+    }
+
+
+def get_soa_fields(rdata):
+    return {
+        "mname": rdata.mname.to_text(),
+        "rname": rdata.rname.to_text(),
+        "serial": rdata.serial
+    }
+
+
+def get_algorithm_fields(rdata):
+    return {
+        "algorithm": dns.dnssec.algorithm_to_text(rdata.algorithm)
+    }
+
+
+# typed fields added next to the text value for some record types, so parsers don't need to split the text again
+rdata_fields = {
+    dns.rdatatype.MX: get_mx_fields,
+    dns.rdatatype.TLSA: get_tlsa_fields,
+    dns.rdatatype.SOA: get_soa_fields,
+    dns.rdatatype.DS: get_algorithm_fields,
+    dns.rdatatype.DNSKEY: get_algorithm_fields
+}
 
 
-def value_from_record(record, data):
-    return re.sub(r".*" + re.escape(record) + " ", "", data)
+def get_record_value(rdata):
+    value = {"value": rdata.to_text()}
+    fields = rdata_fields.get(rdata.rdtype)
+    if fields is not None:
+        value.update(fields(rdata))
+    return value
 
 
-def get_record(domain_name, record, resolver, protocol="udp", cname_count=None):
+def get_record(domain_name, record, resolver, protocol="udp", cname_count=None, memo=None, with_ttl=False):
+    if memo is not None:
+        results, ttl = memo.get_record(domain_name, record, resolver)
+    else:
+        results, ttl = query_record(domain_name, record, resolver, protocol=protocol)
+    if with_ttl:
+        return results, ttl
+    return results
+
+
+# Returns the records and their TTL (the lowest one in the answer, None if there wasn't any response)
+def query_record(domain_name, record, resolver, protocol="udp"):
     results = []
     domain = dns.name.from_text(domain_name)
     if not domain.is_absolute():
         domain = domain.concatenate(dns.name.root)
-    request = dns.message.make_query(domain, record)
+    rdtype = dns.rdatatype.from_text(record)
+    request = dns.message.make_query(domain, rdtype)
     request.flags |= dns.flags.CD
     try:
         if protocol == "udp":
-            response = getattr(dns.query, protocol)(request, resolver.nameservers[0],
-                                                    resolver.timeout, raise_on_truncation=True)
+            response = transport.query(request, resolver.nameservers[0], resolver.timeout, port=resolver.port)
         else:
-            response = getattr(dns.query, protocol)(request, resolver.nameservers[0], resolver.timeout)
+            response = transport.tcp(request, resolver.nameservers[0], resolver.timeout, port=resolver.port)
     except (
         dns.query.UnexpectedSource,
         dns.query.BadResponse
     ):
-        return get_record(domain_name, record, resolver)
+        return query_record(domain_name, record, resolver)
     except (
         dns.resolver.NoAnswer,
         dns.rdatatype.UnknownRdatatype,
@@ -334,29 +448,60 @@ def get_record(domain_name, record, resolver, protocol="udp", cname_count=None):
         dns.exception.Timeout,
         dns.exception.FormError
     ):
-        return None
+        return None, None
     except dns.message.Truncated:
-        return get_record(domain_name, record, resolver, protocol="tcp")
+        return query_record(domain_name, record, resolver, protocol="tcp")
     for item in response.answer:
-        if item.rdtype == dns.rdatatype.from_text(record) and item.name == domain:
-            for line in str(item).split("\n"):
-                results.append({"value": value_from_record(record, line)})
-        elif item.rdtype == dns.rdatatype.from_text("CNAME"):
-            for line in str(item).split("\n"):
-                cname_domain = value_from_record("CNAME", line)
-                results.append({
-                    "cname": cname_domain,
-                    "value": None
-                })
-        if item.rdtype == dns.rdatatype.from_text(record) and "cname" in results[-1]:
-            for line in str(item).split("\n"):
-                results.append({"value": value_from_record(record, line), "from_cname": str(item.name)})
+        if item.rdtype == rdtype and item.name == domain:
+            results += [get_record_value(rdata) for rdata in item]
+        elif item.rdtype == dns.rdatatype.CNAME:
+            results += [{"cname": rdata.to_text(), "value": None} for rdata in item]
+        if item.rdtype == rdtype and results and "cname" in results[-1]:
+            results += [dict(get_record_value(rdata), from_cname=str(item.name)) for rdata in item]
     for item in response.additional:
         results.append({"additional": str(item)})
+    ttl = min((item.ttl for item in response.answer), default=None)
+    if ttl is None:  # negative answer, its TTL comes from the SOA record (RFC 2308)
+        ttl = min((min(item.ttl, item[0].minimum) for item in response.authority
+                   if item.rdtype == dns.rdatatype.SOA), default=None)
     if len(results) > 0:
-        return results
+        return results, ttl
     else:
-        return None
+        return None, ttl
+
+
+def get_records(queries, resolver, executor, memo=None, with_ttl=False):
+    futures = {query: executor.submit(get_record, query[0], query[1], resolver, memo=memo, with_ttl=with_ttl)
+               for query in queries}
+    return {query: future.result() for query, future in futures.items()}
+
+
+# Answers fetched during one job, keyed by (name, type, server) – the same query asked again (or while the first one
+# is still running) gets a copy of the first answer instead of going to the network
+class QueryMemo:
+    def __init__(self):
+        self.answers = {}
+        self.lock = Lock()
+
+    # returns (records, ttl) like query_record
+    def get_record(self, domain_name, record, resolver):
+        key = (domain_name.lower().rstrip("."), record, resolver.nameservers[0])
+        with self.lock:
+            answer = self.answers.get(key)
+            first = answer is None
+            if first:
+                answer = self.answers[key] = Future()
+        if not first:
+            increment("dns_duplicate_queries")
+            return deepcopy(answer.result())
+        try:
+            result = query_record(domain_name, record, resolver)
+        except Exception as e:
+            answer.set_exception(e)
+            raise
+        # callers modify the results (eg. annotate_geoip), so the memo keeps its own copy
+        answer.set_result(deepcopy(result))
+        return result
 
 
 additional_parsers = {
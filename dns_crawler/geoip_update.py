@@ -0,0 +1,117 @@
+# Copyright © 2019-2023 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import sys
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool, cpu_count
+from os.path import basename
+
+from .config_loader import default_config_filename, load_config
+from .geoip_utils import geoip_single, init_geoip
+from .timestamp import timestamp
+
+CHUNK_SIZE = 1000
+
+geoip_dbs = None
+
+
+def print_help():
+    exe = basename(sys.argv[0])
+    sys.stderr.write(f"{exe} - re-annotates existing crawler results with the current GeoIP databases\n\n")
+    sys.stderr.write(f"Usage: {exe} <file> [processes]\n")
+    sys.stderr.write("       file - results from dns-crawler or dns-crawler-controller (one JSON per line), " +
+                     "- for stdin\n")
+    sys.stderr.write("       processes - number of processes, one per CPU core by default\n\n")
+    sys.stderr.write(f"Example: {exe} results.json > results-new.json\n")
+    sys.exit(1)
+
+
+def init_process():
+    global geoip_dbs
+    geoip_dbs = init_geoip(load_config(default_config_filename))
+
+
+# Every object with a `geoip` field gets it replaced, the IP is in its `ip` (name and mail servers)
+# or `value` (A/AAAA records) field
+def update_geoip(item):
+    if isinstance(item, dict):
+        if "geoip" in item:
+            ip = item.get("ip", item.get("value"))
+            if isinstance(ip, str):
+                item["geoip"] = geoip_single(ip, geoip_dbs)
+        for value in item.values():
+            update_geoip(value)
+    elif isinstance(item, list):
+        for value in item:
+            update_geoip(value)
+
+
+def update_lines(lines):
+    output = []
+    for line in lines:
+        if '"geoip"' in line:
+            result = json.loads(line)
+            update_geoip(result)
+            line = json.dumps(result, ensure_ascii=False, check_circular=False, separators=(",", ":")) + "\n"
+        output.append(line)
+    return "".join(output)
+
+
+def main():
+    if "-h" in sys.argv or "--help" in sys.argv or len(sys.argv) < 2:
+        print_help()
+
+    filename = sys.argv[1]
+    try:
+        processes = int(sys.argv[2]) if len(sys.argv) > 2 else cpu_count()
+    except ValueError:
+        sys.stderr.write(f"Process count ('{sys.argv[2]}') is not an integer.\n\n")
+        print_help()
+
+    try:
+        if filename == "-":
+            file = sys.stdin
+        else:
+            try:
+                file = open(filename, "r", encoding="utf-8")  # noqa: SIM115 (it can be stdin)
+            except FileNotFoundError:
+                sys.stderr.write(f"File '{filename}' does not exist.\n\n")
+                print_help()
+        sys.stderr.write(f"{timestamp()} Reading results from {filename}.\n")
+        done = 0
+        with Pool(processes, initializer=init_process) as pool:
+            # only a few chunks are in flight at once, so memory use doesn't depend on the file size
+            pending = deque()
+            while True:
+                lines = list(islice(file, CHUNK_SIZE))
+                if lines:
+                    pending.append((len(lines), pool.apply_async(update_lines, (lines,))))
+                if pending and (not lines or len(pending) >= processes * 2):
+                    count, chunk = pending.popleft()
+                    sys.stdout.write(chunk.get())
+                    done += count
+                    if done % (CHUNK_SIZE * 100) == 0:
+                        sys.stderr.write(f"{timestamp()} {done}\n")
+                elif not lines:
+                    break
+        sys.stdout.flush()
+        sys.stderr.write(f"{timestamp()} Finished, {done} results processed.\n")
+    except KeyboardInterrupt:
+        sys.exit(0)
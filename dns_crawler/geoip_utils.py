@@ -21,7 +21,24 @@ from sys import stderr
 
 import geoip2.database
 
+from .cache import LRUCache
 from .ip_utils import is_valid_ip_address
+from .stats import increment
+
+
+# Opened databases along with a memo of results for recently seen IPs – the same hosting, CDN and parking IPs
+# show up for a lot of domains, so most of them don't need to be looked up again.
+class GeoIPDatabases:
+    def __init__(self, country, isp, asn, memo_size):
+        self.country = country
+        self.isp = isp
+        self.asn = asn
+        self.memo = LRUCache(memo_size) if memo_size else None
+
+    def close(self):
+        for reader in (self.country, self.isp, self.asn):
+            if reader is not None:
+                reader.close()
 
 
 def init_geoip(config):
@@ -51,11 +68,11 @@ def init_geoip(config):
         except FileNotFoundError:
             stderr.write(f"GeoIP ASN DB cannot be found in '{db_path}'. Disabling.\n")
 
-    return (geoip_country, geoip_isp, geoip_asn)
+    return GeoIPDatabases(geoip_country, geoip_isp, geoip_asn, config["cache"]["geoip_size"])
 
 
-def geoip_single(ip, dbs):
-    geoip_country, geoip_isp, geoip_asn = dbs
+def lookup_geoip(ip, dbs):
+    geoip_country, geoip_isp, geoip_asn = dbs.country, dbs.isp, dbs.asn
     try:
         result = {}
         if geoip_country:
@@ -73,11 +90,39 @@ def geoip_single(ip, dbs):
     return result
 
 
+# Returns (whether the IP should be annotated, GeoIP result)
+def get_geoip_entry(ip, dbs):
+    if dbs.memo is not None:
+        entry = dbs.memo.get(ip)
+        if entry is not None:
+            increment("geoip_memo_hits")
+            return entry
+        increment("geoip_memo_misses")
+    # invalid and non-public IPs (and CNAME entries without a value) aren't annotated, so they aren't looked up either
+    valid = is_valid_ip_address(ip)
+    entry = (valid, lookup_geoip(ip, dbs) if valid else None)
+    if dbs.memo is not None:
+        dbs.memo.set(ip, entry)
+    return entry
+
+
+def geoip_single(ip, dbs):
+    valid, result = get_geoip_entry(ip, dbs)
+    # name and mail server IPs always get a result, with the error from the databases for non-public ones
+    return dict(result) if valid else lookup_geoip(ip, dbs)
+
+
+# Annotates items from all the lists at once, each distinct IP is looked up just once
+def annotate_geoip_many(item_lists, dbs, key="value"):
+    items = [item for items in item_lists if items for item in items]
+    entries = {ip: get_geoip_entry(ip, dbs) for ip in {item[key] for item in items}}
+    for item in items:
+        valid, result = entries[item[key]]
+        if valid:
+            item["geoip"] = dict(result)
+    return item_lists
+
+
 def annotate_geoip(items, dbs, key="value"):
-    if items:
-        for item in items:
-            ip = item[key]
-            if not is_valid_ip_address(ip):
-                continue
-            item["geoip"] = geoip_single(ip, dbs)
+    annotate_geoip_many([items], dbs, key=key)
     return items
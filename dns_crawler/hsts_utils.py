@@ -16,9 +16,113 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import zlib
+
+import hstspreload
 from hstspreload import in_hsts_preload
 import idna
 
+INDEX_MAGIC = b"HSTS"
+
+hsts_index = None
+
+
+# Hosts from the preload list (IDNA-encoded) with their include_subdomains flag, read from the hstspreload data
+def get_preload_entries():
+    with hstspreload.open_pkg_binary("hstspreload.bin") as f:
+        data = f.read()
+    entries = {tld: True for tld in hstspreload._GTLD_INCLUDE_SUBDOMAINS}
+    for layer in hstspreload._JUMPTABLE:
+        for jump_info in layer:
+            if jump_info is None:
+                continue
+            offset, size = jump_info
+            for is_leaf, include_subdomains, label in hstspreload._iter_entries(bytearray(data[offset:offset + size])):
+                if is_leaf:
+                    entries[label] = entries.get(label, False) or bool(include_subdomains)
+    return entries
+
+
+# Open addressing hash table of all preloaded hosts: magic, slot count, slots (offsets of entries, 0 for empty ones),
+# and entries (include_subdomains flag, host length, host)
+def build_hsts_index(filename):
+    entries = get_preload_entries()
+    slot_count = 1 << (len(entries) * 2).bit_length()
+    slots = [0] * slot_count
+    header_size = len(INDEX_MAGIC) + 4 + 4 * slot_count
+    blob = bytearray()
+    for host, include_subdomains in entries.items():
+        slot = zlib.crc32(host) & (slot_count - 1)
+        while slots[slot]:
+            slot = (slot + 1) & (slot_count - 1)
+        slots[slot] = header_size + len(blob)
+        blob += bytes((include_subdomains, len(host))) + host
+    # workers on the same host might be building it at the same time
+    tmp_filename = f"{filename}.{os.getpid()}"
+    with open(tmp_filename, "wb") as f:
+        f.write(INDEX_MAGIC + struct.pack("<I", slot_count))
+        f.write(struct.pack(f"<{slot_count}I", *slots))
+        f.write(blob)
+    os.replace(tmp_filename, filename)
+
+
+# The index is built once per host and memory-mapped by every worker process, so they all share the same memory
+# and each lookup takes constant time
+class HSTSIndex:
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            raise ValueError(f"'{filename}' is not an HSTS preload index")
+        self.mask = struct.unpack_from("<I", self.data, len(INDEX_MAGIC))[0] - 1
+
+    # None if the host isn't on the list, its include_subdomains flag otherwise
+    def get(self, host):
+        slot = zlib.crc32(host) & self.mask
+        while True:
+            offset = struct.unpack_from("<I", self.data, len(INDEX_MAGIC) + 4 + 4 * slot)[0]
+            if not offset:
+                return None
+            length = self.data[offset + 1]
+            if length == len(host) and self.data[offset + 2:offset + 2 + length] == host:
+                return bool(self.data[offset])
+            slot = (slot + 1) & self.mask
+
+    def contains(self, host):
+        host = host.lower()
+        if self.get(host) is not None:
+            return True
+        labels = host.split(b".")
+        return any(self.get(b".".join(labels[i:])) for i in range(1, len(labels)))
+
+
+def get_hsts_index():
+    global hsts_index
+    if hsts_index is None:
+        filename = os.path.join(tempfile.gettempdir(), f"dns-crawler-hsts-{hstspreload.__checksum__[:16]}.idx")
+        try:
+            if not os.path.isfile(filename):
+                build_hsts_index(filename)
+            hsts_index = HSTSIndex(filename)
+        except Exception as e:  # noqa: BLE001
+            # hstspreload internals changed or the file can't be written, look the domains up one by one instead
+            sys.stderr.write(f"Can't use HSTS preload index '{filename}': {e}\n")
+            hsts_index = False
+    return hsts_index
+
+
+def get_hsts_statuses(domains):
+    index = get_hsts_index()
+    hosts = {domain: idna.encode(domain) for domain in domains}
+    if not index:
+        return {domain: in_hsts_preload(host) for domain, host in hosts.items()}
+    return {domain: index.contains(host) for domain, host in hosts.items()}
+
 
 def get_hsts_status(domain):
-    return in_hsts_preload(idna.encode(domain).decode("ascii"))
+    return get_hsts_statuses([domain])[domain]
@@ -0,0 +1,132 @@
+# Copyright © 2019-2023 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import sqlite3
+import sys
+import zlib
+from os.path import basename
+from threading import Lock
+
+from .timestamp import timestamp
+
+INDEX_COMMIT_INTERVAL = 10000
+
+
+def get_soa_serial(soa_records):
+    if not soa_records:
+        return None
+    return soa_records[0].get("serial")
+
+
+# Records which have to stay the same for the previous DNS results to be reused – the zone's content (SOA serial)
+# and its delegation (NS and DS)
+def get_zone_state(soa_records, ns_records, ds_records):
+    serial = get_soa_serial(soa_records)
+    if serial is None:
+        return None
+    # glue (`additional`) and CNAME entries have no value
+    ns = sorted(record["value"].lower() for record in ns_records or [] if record.get("value"))
+    ds = sorted(record["value"].lower() for record in ds_records or [] if record.get("value"))
+    return json.dumps([serial, ns, ds])
+
+
+# Index of results from a previous crawl (SQLite, built by dns-crawler-index), opened read-only by each worker process
+class PreviousResults:
+    def __init__(self, filename):
+        self.filename = filename
+        self.pid = None
+        self.lock = Lock()
+
+    def get(self, domain):
+        with self.lock:
+            # SQLite connections can't be shared with forked processes
+            if self.pid != os.getpid():
+                self.db = sqlite3.connect(f"file:{self.filename}?mode=ro", uri=True, check_same_thread=False)
+                self.pid = os.getpid()
+            row = self.db.execute("SELECT state, result FROM results WHERE domain = ?", (domain,)).fetchone()
+        if row is None:
+            return None, None
+        return row[0], json.loads(zlib.decompress(row[1]))
+
+
+def get_previous_results(config):
+    filename = config["incremental"]["index"]
+    if not filename:
+        return None
+    if not os.path.isfile(filename):
+        sys.stderr.write(f"Index of previous results '{filename}' cannot be found. Disabling incremental crawl.\n")
+        return None
+    return PreviousResults(filename)
+
+
+def build_index(results_file, filename):
+    db = sqlite3.connect(filename)
+    db.execute("DROP TABLE IF EXISTS results")
+    db.execute("CREATE TABLE results (domain TEXT PRIMARY KEY, state TEXT, result BLOB)")
+    count = 0
+    for line in results_file:
+        result = json.loads(line)
+        dns_local = (result.get("results") or {}).get("DNS_LOCAL")
+        if not dns_local:
+            continue
+        state = get_zone_state(dns_local.get("SOA"), dns_local.get("NS_AUTH"), dns_local.get("DS"))
+        if state is None:
+            continue
+        db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+                   (result["domain"], state, zlib.compress(line.rstrip("\n").encode("utf-8"))))
+        count = count + 1
+        if count % INDEX_COMMIT_INTERVAL == 0:
+            db.commit()
+            sys.stderr.write(f"{timestamp()} {count}\n")
+    db.commit()
+    db.close()
+    return count
+
+
+def print_help():
+    exe = basename(sys.argv[0])
+    sys.stderr.write(f"{exe} - builds an index of crawler results for the next (incremental) crawl\n\n")
+    sys.stderr.write(f"Usage: {exe} <results> <index>\n")
+    sys.stderr.write("       results - results from dns-crawler or dns-crawler-controller (one JSON per line), " +
+                     "- for stdin\n")
+    sys.stderr.write("       index - SQLite file to save the index to (an existing one is replaced)\n\n")
+    sys.stderr.write(f"Example: {exe} results.json previous.sqlite\n")
+    sys.exit(1)
+
+
+def main():
+    if "-h" in sys.argv or "--help" in sys.argv or len(sys.argv) < 3:
+        print_help()
+
+    results_filename, index_filename = sys.argv[1:3]
+    try:
+        if results_filename == "-":
+            results_file = sys.stdin
+        else:
+            try:
+                results_file = open(results_filename, "r", encoding="utf-8")  # noqa: SIM115 (it can be stdin)
+            except FileNotFoundError:
+                sys.stderr.write(f"File '{results_filename}' does not exist.\n\n")
+                print_help()
+        sys.stderr.write(f"{timestamp()} Reading results from {results_filename}.\n")
+        count = build_index(results_file, index_filename)
+        sys.stderr.write(f"{timestamp()} Finished, {count} domains saved to {index_filename}.\n")
+    except KeyboardInterrupt:
+        sys.exit(1)
@@ -38,7 +38,11 @@ def is_valid_ipv4_address(ip):
 
 
 def is_valid_ip_address(ip):
-    return is_valid_ipv4_address(ip) or is_valid_ipv6_address(ip)
+    try:
+        addr = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    return addr.is_global
 
 
 def get_source_address(v, ip):
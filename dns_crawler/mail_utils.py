@@ -17,7 +17,6 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import json
 import socket
 
 from .dns_utils import get_record, parse_tlsa
@@ -45,65 +44,71 @@ def get_smtp_banner(host_ip, port, timeout):
     return result
 
 
-def get_mailserver_info(host, ports, geoip_dbs, timeout, get_banners, cache_timeout,
-                        resolver, redis, source_ipv4, source_ipv6, max_ips_per_host):
-    cache_key_host = f"cache-mail-host-{host}"
-    if redis is not None:
-        cached_host = redis.get(cache_key_host)
-        if cached_host is not None:
-            redis.expire(cache_key_host, cache_timeout)
-            return json.loads(cached_host.decode("utf-8"))
+def get_mail_host_cache_key(host):
+    return f"cache-mail-host-{host}"
+
+
+def get_mail_ip_cache_key(ip):
+    return f"cache-mail-ip-{ip}"
+
+
+def get_mailserver_info(host, ports, geoip_dbs, timeout, get_banners, cache,
+                        resolver, source_ipv4, source_ipv6, max_ips_per_host, memo=None):
+    cache_key_host = get_mail_host_cache_key(host)
+    cached_host = cache.get(cache_key_host)
+    if cached_host is not None:
+        return cached_host
     result = {}
     result["host"] = host
     result["TLSA"] = {}
     for port in ports:
-        result["TLSA"][port] = parse_tlsa(get_record(f"_{port}._tcp." + host, "TLSA", resolver))
+        result["TLSA"][port] = parse_tlsa(get_record(f"_{port}._tcp." + host, "TLSA", resolver, memo=memo))
     if get_banners:
         result["banners"] = []
         if source_ipv4 and source_ipv6:
-            host_ip4s = get_record(host, "A", resolver) or []
-            host_ip6s = get_record(host, "AAAA", resolver) or []
+            host_ip4s = get_record(host, "A", resolver, memo=memo) or []
+            host_ip6s = get_record(host, "AAAA", resolver, memo=memo) or []
             host_ips = host_ip4s + host_ip6s
         if source_ipv4 and not source_ipv6:
-            host_ips = get_record(host, "A", resolver) or []
+            host_ips = get_record(host, "A", resolver, memo=memo) or []
         if source_ipv6 and not source_ipv4:
-            host_ips = get_record(host, "AAAA", resolver) or []
-        for host_ip in host_ips[:max_ips_per_host]:
-            if "value" not in host_ip:
+            host_ips = get_record(host, "AAAA", resolver, memo=memo) or []
+        host_ips = [host_ip["value"] for host_ip in host_ips[:max_ips_per_host] if "value" in host_ip]
+        cache.prefetch([get_mail_ip_cache_key(host_ip) for host_ip in host_ips])
+        for host_ip in host_ips:
+            cache_key_ip = get_mail_ip_cache_key(host_ip)
+            cached_ip = cache.get(cache_key_ip)
+            if cached_ip is not None:
+                # copied, annotate_geoip below adds to it
+                result["banners"].append(dict(cached_ip))
                 continue
-            host_ip = host_ip["value"]
-            cache_key_ip = f"cache-mail-ip-{host_ip}"
-            if redis is not None:
-                cached_ip = redis.get(cache_key_ip)
-                if cached_ip is not None:
-                    redis.expire(cache_key_ip, cache_timeout)
-                    result["banners"].append(json.loads(cached_ip.decode("utf-8")))
-                    continue
             ip_banners = {"ip": host_ip, "banners": {}}
             for port in ports:
                 ip_banners["banners"][port] = get_smtp_banner(host_ip, port, timeout)
-            if redis is not None:
-                redis.set(cache_key_ip, json.dumps(ip_banners), ex=cache_timeout)
+            cache.set(cache_key_ip, ip_banners)
             result["banners"].append(ip_banners)
         if len(result["banners"]) == 0:
             result["banners"] = None
     if "banners" in result and result["banners"] is not None:
         annotate_geoip(result["banners"], geoip_dbs, "ip")
-    if redis is not None:
-        redis.set(cache_key_host, json.dumps(result), ex=cache_timeout)
+    cache.set(cache_key_host, result)
     return result
 
 
-def get_mx_info(mx_records, ports, geoip_dbs, timeout, get_banners, cache_timeout,
-                resolver, redis, source_ipv4, source_ipv6, max_ips_per_host):
-    results = []
-    if not mx_records:
-        return None
-    for mx in mx_records:
+def get_mx_hosts(mx_records):
+    hosts = []
+    for mx in mx_records or []:
         if mx and mx["value"]:
-            host = mx["value"].split(" ")[-1]
+            host = mx.get("exchange") or mx["value"]
             if host and host != ".":
-                results.append(get_mailserver_info(host, ports, geoip_dbs, timeout, get_banners,
-                                                   cache_timeout, resolver, redis, source_ipv4, source_ipv6,
-                                                   max_ips_per_host))
-    return results
+                hosts.append(host)
+    return hosts
+
+
+def get_mx_info(mx_records, ports, geoip_dbs, timeout, get_banners, cache,
+                resolver, source_ipv4, source_ipv6, max_ips_per_host, memo=None):
+    if not mx_records:
+        return None
+    return [get_mailserver_info(host, ports, geoip_dbs, timeout, get_banners, cache, resolver, source_ipv4, source_ipv6,
+                                max_ips_per_host, memo=memo)
+            for host in get_mx_hosts(mx_records)]
@@ -0,0 +1,264 @@
+# Copyright © 2019-2023 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import gzip
+import json
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from os.path import basename
+
+import zstandard
+
+from .mail_utils import get_mx_hosts
+
+SHARD_BATCH_SIZE = 1000
+SHARD_MAX_PENDING = 2
+SHARD_EXTENSIONS = {"zstd": ".zst", "gzip": ".gz", None: ""}
+
+WEB_KEYS = [f"WEB{ipv}_{port}{www}" for ipv in (4, 6) for port in (80, 443) for www in ("", "_www")]
+
+# Columns of the Parquet output: name, type (list types are lists of the values, eg. one per IP)
+PARQUET_COLUMNS = [
+    ("domain", "string"),
+    ("timestamp", "string"),
+    ("parent_zone", "string"),
+    ("ns", "list<string>"),
+    ("a", "list<string>"),
+    ("aaaa", "list<string>"),
+    ("a_www", "list<string>"),
+    ("aaaa_www", "list<string>"),
+    ("mx", "list<string>"),
+    ("ds_algorithms", "list<string>"),
+    ("dnssec_valid", "bool"),
+    ("dmarc_policy", "string"),
+    ("hsts_preload", "bool"),
+] + [
+    (f"{key.lower()}_status", "list<int32>") for key in WEB_KEYS
+] + [
+    (f"{key.lower()}_cert_sha256", "list<string>") for key in WEB_KEYS if "_443" in key
+]
+
+
+class OutputError(Exception):
+    pass
+
+
+def get_values(records, key="value"):
+    return [record[key] for record in records or [] if record.get(key) is not None]
+
+
+# HTTP status of the last step (after redirects) for each web server IP
+def get_web_statuses(probes):
+    return [probe["steps"][-1].get("status") if probe.get("steps") else None for probe in probes or []]
+
+
+# Fingerprint of the certificate (first in the chain) from the last step for each web server IP
+def get_cert_fingerprints(probes):
+    fingerprints = []
+    for probe in probes or []:
+        certs = probe["steps"][-1].get("cert") if probe.get("steps") else None
+        fingerprint = certs[0].get("fingerprint", {}).get("cert", {}).get("sha256") if certs else None
+        fingerprints.append(fingerprint)
+    return fingerprints
+
+
+def flatten_result(result):
+    results = result.get("results") or {}
+    dns_local = results.get("DNS_LOCAL") or {}
+    web = results.get("WEB") or {}
+    dmarc = dns_local.get("TXT_DMARC") or [{}]
+    row = {
+        "domain": result.get("domain"),
+        "timestamp": result.get("timestamp"),
+        "parent_zone": (result.get("parent") or {}).get("zone"),
+        "ns": get_values(dns_local.get("NS_AUTH")),
+        "a": get_values(dns_local.get("WEB4")),
+        "aaaa": get_values(dns_local.get("WEB6")),
+        "a_www": get_values(dns_local.get("WEB4_www")),
+        "aaaa_www": get_values(dns_local.get("WEB6_www")),
+        "mx": get_mx_hosts(dns_local.get("MAIL")),
+        "ds_algorithms": get_values(dns_local.get("DS"), "algorithm"),
+        "dnssec_valid": (dns_local.get("DNSSEC") or {}).get("valid"),
+        "dmarc_policy": (dmarc[0].get("p") or {}).get("value"),
+        "hsts_preload": results.get("HSTS"),
+    }
+    for key in WEB_KEYS:
+        row[f"{key.lower()}_status"] = get_web_statuses(web.get(key))
+        if "_443" in key:
+            row[f"{key.lower()}_cert_sha256"] = get_cert_fingerprints(web.get(key))
+    return row
+
+
+# One JSON per line, as it came from the workers
+class JSONSink:
+    def __init__(self, filename=None):
+        self.file = open(filename, "wb") if filename else sys.stdout.buffer  # noqa: SIM115 (written until close())
+
+    def write(self, result):
+        self.file.write(result + b"\n")
+
+    def close(self):
+        self.file.flush()
+        if self.file is not sys.stdout.buffer:
+            self.file.close()
+
+
+# The core fields flattened into fixed columns, written in row groups as the results come
+class ParquetSink:
+    def __init__(self, filename=None, row_group_size=10000, include_json=False):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise OutputError("Parquet output needs pyarrow, install it with `pip install dns-crawler[parquet]`.")
+        self.pyarrow = pyarrow
+        self.row_group_size = row_group_size
+        self.include_json = include_json
+        fields = [(name, pyarrow.type_for_alias(column_type) if not column_type.startswith("list")
+                   else pyarrow.list_(pyarrow.type_for_alias(column_type[5:-1])))
+                  for name, column_type in PARQUET_COLUMNS]
+        if include_json:
+            fields.append(("json", pyarrow.string()))
+        self.schema = pyarrow.schema(fields)
+        self.writer = pyarrow.parquet.ParquetWriter(filename or sys.stdout.buffer, self.schema)
+        self.rows = []
+
+    def write(self, result):
+        row = flatten_result(json.loads(result))
+        if self.include_json:
+            row["json"] = result.decode("utf-8")
+        self.rows.append(row)
+        if len(self.rows) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.writer.write_table(self.pyarrow.Table.from_pylist(self.rows, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+# Results of one shard, written (and compressed) in its own thread. A new file is started after `rotate_size` bytes
+# or `rotate_count` results.
+class Shard:
+    def __init__(self, prefix, number, compression, level, rotate_size, rotate_count):
+        self.prefix = prefix
+        self.number = number
+        self.compression = compression
+        self.level = level
+        self.rotate_size = rotate_size
+        self.rotate_count = rotate_count
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = deque()
+        self.files = []
+        self.file = None
+
+    # called from the controller's thread, it waits only if the shard is too far behind
+    def submit(self, results):
+        while len(self.pending) >= SHARD_MAX_PENDING:
+            self.pending.popleft().result()
+        self.pending.append(self.executor.submit(self.write, results))
+
+    def write(self, results):
+        for result in results:
+            if self.file is None:
+                self.open_file()
+            self.file.write(result + b"\n")
+            self.count = self.count + 1
+            self.size = self.size + len(result) + 1
+            if (self.rotate_count and self.count >= self.rotate_count) or \
+               (self.rotate_size and self.size >= self.rotate_size):
+                self.close_file()
+
+    def open_file(self):
+        self.filename = f"{self.prefix}-{self.number:03}-{len(self.files):05}.jsonl" + \
+            SHARD_EXTENSIONS[self.compression]
+        # the file is written by batches until it's rotated or the shard is closed
+        if self.compression == "zstd":
+            self.file = zstandard.open(self.filename, "wb", cctx=zstandard.ZstdCompressor(level=self.level))
+        elif self.compression == "gzip":
+            self.file = gzip.open(self.filename, "wb", compresslevel=self.level)  # noqa: SIM115
+        else:
+            self.file = open(self.filename, "wb")  # noqa: SIM115
+        self.count = 0
+        self.size = 0
+
+    def close_file(self):
+        self.file.close()
+        self.files.append({"file": basename(self.filename), "shard": self.number, "results": self.count,
+                           "size": self.size})
+        self.file = None
+
+    def close(self):
+        while self.pending:
+            self.pending.popleft().result()
+        if self.file is not None:
+            self.close_file()
+        self.executor.shutdown()
+
+
+# Results are spread over multiple files in batches, each of them is compressed and written in a separate thread.
+# A manifest with the list of files is written at the end.
+class ShardedSink:
+    def __init__(self, prefix, shards, compression="zstd", level=3, rotate_size=0, rotate_count=0):
+        if compression not in SHARD_EXTENSIONS:
+            raise OutputError(f"Unknown shard compression '{compression}'.")
+        self.prefix = prefix
+        self.shards = [Shard(prefix, number, compression, level, rotate_size, rotate_count)
+                       for number in range(shards)]
+        self.next_shard = 0
+        self.batch = []
+
+    def write(self, result):
+        self.batch.append(result)
+        if len(self.batch) >= SHARD_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.shards[self.next_shard].submit(self.batch)
+            self.next_shard = (self.next_shard + 1) % len(self.shards)
+            self.batch = []
+
+    def close(self):
+        self.flush()
+        files = []
+        for shard in self.shards:
+            shard.close()
+            files = files + shard.files
+        manifest = {"files": files, "results": sum(file["results"] for file in files)}
+        with open(f"{self.prefix}-manifest.json", "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+
+
+def get_output_sink(config):
+    output = config["output"]
+    if output["format"] == "json" and output["shards"]:
+        if not output["file"]:
+            raise OutputError("Sharded output needs `output.file` (used as a prefix of the file names).")
+        return ShardedSink(output["file"], output["shards"], output["shard_compression"],
+                           output["shard_compression_level"], output["rotate_size"], output["rotate_count"])
+    if output["format"] == "json":
+        return JSONSink(output["file"])
+    if output["format"] == "parquet":
+        return ParquetSink(output["file"], output["row_group_size"], output["include_json"])
+    raise OutputError(f"Unknown output format '{output['format']}'.")
@@ -21,6 +21,10 @@ from redis.exceptions import ConnectionError
 
 
 REDIS_DEFAULT_HOST = "localhost:6379:0"
+RESULTS_STREAM = "crawler-results"
+RESULTS_GROUP = "crawler-controller"
+FEEDING_KEY = "crawler-feeding"
+DICTIONARY_KEY = "crawler-zstd-dictionary"
 
 
 def get_redis_host(argv, index):
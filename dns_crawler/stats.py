@@ -0,0 +1,47 @@
+# Copyright © 2019-2023 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from collections import Counter
+from threading import Lock
+
+stats_key = "crawler-stats"
+
+counters = Counter()
+counters_lock = Lock()
+
+
+def increment(name, value=1):
+    if not value:
+        return
+    with counters_lock:
+        counters[name] += value
+
+
+# Counters are kept in memory and added to the shared hash in Redis with each result (queued into the result's
+# pipeline), so the controller can print totals for all workers at the end
+def flush_stats(pipe):
+    with counters_lock:
+        flushed = dict(counters)
+        counters.clear()
+    for name, value in flushed.items():
+        pipe.hincrby(stats_key, name, value)
+
+
+def get_stats(redis):
+    return {name.decode("utf-8"): int(value) for name, value in sorted(redis.hgetall(stats_key).items())}
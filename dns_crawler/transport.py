@@ -0,0 +1,371 @@
+# Copyright © 2019-2023 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import socket
+import ssl
+import struct
+from collections import OrderedDict
+from ipaddress import ip_address
+from itertools import count
+from queue import Empty, SimpleQueue
+from threading import Lock, Thread, current_thread
+from time import monotonic
+
+import dns.entropy
+import dns.exception
+import dns.message
+
+DEFAULT_UDP_SOCKETS = 4
+# how often the receiving threads check whether their pool was closed (closing a socket doesn't wake up recvfrom)
+UDP_RECEIVE_INTERVAL = 0.5
+# queries sent from a pooled UDP socket before it's replaced by a new one (with another source port)
+UDP_SOCKET_QUERIES = 100
+STREAM_CLOSE_TIMEOUT = 1
+DEFAULT_STREAM_CONNECTIONS = 64
+
+# the configured pool settings are kept, so a pool recreated after a fork (for a new pid) has them too
+udp_pool = None
+udp_pool_size = DEFAULT_UDP_SOCKETS
+udp_pool_lock = Lock()
+stream_pool = None
+stream_pool_size = DEFAULT_STREAM_CONNECTIONS
+stream_pool_tls_servers = set()
+stream_pool_lock = Lock()
+
+
+# Long-lived UDP sockets shared by all DNS queries in the process, instead of a new socket (and ephemeral port) for
+# every query. Queries from all threads are multiplexed over the sockets and the responses are matched back
+# by the query ID and the address they came from. A fixed source port would leave just the 16-bit query ID to
+# guess for spoofed responses, so every socket is replaced by a new one (with a new ephemeral port) after sending
+# max_queries queries; the old one keeps receiving until the queries sent from it are done, and is closed then.
+class UDPPool:
+    def __init__(self, size, max_queries=UDP_SOCKET_QUERIES):
+        self.size = size
+        self.max_queries = max_queries
+        self.pid = os.getpid()
+        self.sockets = {}
+        self.threads = []
+        self.pending = {}
+        self.sent = {}
+        self.in_flight = {}
+        self.retired = set()
+        self.lock = Lock()
+        self.counter = count()
+        self.closed = False
+
+    def open_socket(self, family):
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        sock.settimeout(UDP_RECEIVE_INTERVAL)
+        self.sent[sock] = 0
+        self.in_flight[sock] = 0
+        thread = Thread(target=self.receive, args=(sock,), daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        return sock
+
+    # the socket is counted as in use by the caller until release_socket() is called
+    def get_socket(self, family):
+        with self.lock:
+            sockets = self.sockets.get(family)
+            if sockets is None:
+                sockets = self.sockets[family] = [self.open_socket(family) for _ in range(self.size)]
+            index = next(self.counter) % len(sockets)
+            sock = sockets[index]
+            if self.sent[sock] >= self.max_queries:
+                self.retired.add(sock)
+                sock = sockets[index] = self.open_socket(family)
+            self.sent[sock] += 1
+            self.in_flight[sock] += 1
+            return sock
+
+    def release_socket(self, sock):
+        with self.lock:
+            self.in_flight[sock] -= 1
+
+    def receive(self, sock):
+        while not self.closed:
+            with self.lock:
+                if sock in self.retired and not self.in_flight[sock]:
+                    break
+            try:
+                wire, source = sock.recvfrom(65535)
+            except socket.timeout:
+                continue
+            except OSError:  # closed
+                return
+            if len(wire) < 2:
+                continue
+            with self.lock:
+                responses = self.pending.get((int.from_bytes(wire[:2], "big"), source[0], source[1]))
+            if responses is not None:
+                responses.put(wire)
+        with self.lock:
+            if sock in self.retired:
+                self.retired.discard(sock)
+                del self.sent[sock]
+                del self.in_flight[sock]
+                if current_thread() in self.threads:
+                    self.threads.remove(current_thread())
+                sock.close()
+
+    def query(self, request, where, timeout, port=53):
+        address = ip_address(where)
+        where = address.compressed
+        family = socket.AF_INET6 if address.version == 6 else socket.AF_INET
+        sock = self.get_socket(family)
+        responses = SimpleQueue()
+        with self.lock:
+            while (request.id, where, port) in self.pending:
+                request.id = dns.entropy.random_16()
+            key = (request.id, where, port)
+            self.pending[key] = responses
+        try:
+            sock.sendto(request.to_wire(), (where, port))
+            return self.wait_for_response(request, responses, timeout)
+        finally:
+            with self.lock:
+                del self.pending[key]
+            self.release_socket(sock)
+
+    def wait_for_response(self, request, responses, timeout):
+        deadline = monotonic() + timeout
+        while True:
+            try:
+                wire = responses.get(timeout=max(deadline - monotonic(), 0))
+            except Empty:
+                raise dns.exception.Timeout(timeout=timeout)
+            try:
+                response = dns.message.from_wire(wire, keyring=request.keyring, request_mac=request.mac,
+                                                 raise_on_truncation=True)
+            except dns.message.Truncated as e:
+                if request.is_response(e.message()):
+                    raise
+                continue
+            except (dns.exception.DNSException, ValueError):
+                # garbage with a matching ID, keep waiting for the real response
+                continue
+            if request.is_response(response):
+                return response
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            sockets = [sock for family_sockets in self.sockets.values() for sock in family_sockets]
+            sockets.extend(self.retired)
+            threads = self.threads
+            self.sockets = {}
+            self.threads = []
+        for thread in threads:
+            if thread is not current_thread():
+                thread.join()
+        for sock in sockets:
+            sock.close()
+
+
+def get_udp_pool(size=None):
+    global udp_pool, udp_pool_size
+    with udp_pool_lock:
+        if size is not None:
+            udp_pool_size = size
+        if udp_pool is not None and (udp_pool.pid != os.getpid() or udp_pool_size != udp_pool.size):
+            if udp_pool.pid == os.getpid():
+                udp_pool.close()
+            udp_pool = None
+        if udp_pool is None:
+            udp_pool = UDPPool(udp_pool_size)
+    return udp_pool
+
+
+def udp(request, where, timeout, port=53):
+    return get_udp_pool().query(request, where, timeout, port=port)
+
+
+def receive_exactly(sock, length):
+    data = b""
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise EOFError()
+        data = data + chunk
+    return data
+
+
+# One persistent TCP (or TLS) connection, queries are pipelined on it and the responses (which can come in any order,
+# RFC 7766) are matched by the query ID
+class StreamConnection:
+    def __init__(self, where, port, timeout, tls=False):
+        sock = socket.create_connection((where, port), timeout)
+        if tls:
+            context = ssl.create_default_context()
+            context.set_alpn_protocols(["dot"])
+            sock = context.wrap_socket(sock, server_hostname=where)
+        sock.settimeout(None)
+        self.sock = sock
+        self.pending = {}
+        self.lock = Lock()
+        self.send_lock = Lock()
+        self.closed = False
+        self.thread = Thread(target=self.receive, daemon=True)
+        self.thread.start()
+
+    def receive(self):
+        try:
+            while True:
+                (length,) = struct.unpack("!H", receive_exactly(self.sock, 2))
+                wire = receive_exactly(self.sock, length)
+                with self.lock:
+                    responses = self.pending.get(int.from_bytes(wire[:2], "big"))
+                if responses is not None:
+                    responses.put(wire)
+        except (OSError, EOFError, struct.error):
+            pass
+        self.close()
+
+    def query(self, request, timeout):
+        responses = SimpleQueue()
+        with self.lock:
+            if self.closed:
+                raise EOFError()
+            while request.id in self.pending:
+                request.id = dns.entropy.random_16()
+            query_id = request.id
+            self.pending[query_id] = responses
+        try:
+            wire = request.to_wire()
+            with self.send_lock:
+                self.sock.sendall(struct.pack("!H", len(wire)) + wire)
+            return self.wait_for_response(request, responses, timeout)
+        finally:
+            with self.lock:
+                del self.pending[query_id]
+
+    def wait_for_response(self, request, responses, timeout):
+        deadline = monotonic() + timeout
+        while True:
+            try:
+                wire = responses.get(timeout=max(deadline - monotonic(), 0))
+            except Empty:
+                raise dns.exception.Timeout(timeout=timeout)
+            if wire is None:  # connection closed
+                raise EOFError()
+            response = dns.message.from_wire(wire, keyring=request.keyring, request_mac=request.mac)
+            if request.is_response(response):
+                return response
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            for responses in self.pending.values():
+                responses.put(None)
+        # closing the socket alone doesn't wake the receiving thread up from recv()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        if self.thread is not current_thread():
+            self.thread.join(STREAM_CLOSE_TIMEOUT)
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+# Persistent connections for queries over TCP (truncated responses, fingerprinting) or TLS (to resolvers listed
+# in tls_servers), so a query costs one round trip instead of a new handshake each time. The least recently used
+# connection is closed when there's too many of them.
+class StreamPool:
+    def __init__(self, size, tls_servers=()):
+        self.size = size
+        self.tls_servers = {ip_address(server).compressed for server in tls_servers}
+        self.pid = os.getpid()
+        self.connections = OrderedDict()
+        self.lock = Lock()
+
+    def get_connection(self, where, port, timeout):
+        tls = where in self.tls_servers
+        if tls and port == 53:
+            port = 853
+        key = (where, port)
+        with self.lock:
+            connection = self.connections.get(key)
+            if connection is not None and not connection.closed:
+                self.connections.move_to_end(key)
+                return connection
+        connection = StreamConnection(where, port, timeout, tls=tls)
+        with self.lock:
+            current = self.connections.get(key)
+            if current is not None and not current.closed:
+                connection.close()
+                return current
+            self.connections[key] = connection
+            while len(self.connections) > self.size:
+                self.connections.popitem(last=False)[1].close()
+        return connection
+
+    def query(self, request, where, timeout, port=53):
+        where = ip_address(where).compressed
+        deadline = monotonic() + timeout
+        connection = self.get_connection(where, port, timeout)
+        try:
+            return connection.query(request, max(deadline - monotonic(), 0))
+        except EOFError:
+            # the server might have closed an idle connection just before we sent the query, so try a new one once
+            if monotonic() >= deadline:
+                raise dns.exception.Timeout(timeout=timeout)
+            connection = self.get_connection(where, port, max(deadline - monotonic(), 0))
+            return connection.query(request, max(deadline - monotonic(), 0))
+
+    def close(self):
+        with self.lock:
+            for connection in self.connections.values():
+                connection.close()
+            self.connections = OrderedDict()
+
+
+def get_stream_pool(size=None, tls_servers=None):
+    global stream_pool, stream_pool_size, stream_pool_tls_servers
+    with stream_pool_lock:
+        if size is not None:
+            stream_pool_size = size
+        if tls_servers is not None:
+            stream_pool_tls_servers = {ip_address(server).compressed for server in tls_servers}
+        if stream_pool is not None and (stream_pool.pid != os.getpid()
+                                        or stream_pool_size != stream_pool.size
+                                        or stream_pool_tls_servers != stream_pool.tls_servers):
+            if stream_pool.pid == os.getpid():
+                stream_pool.close()
+            stream_pool = None
+        if stream_pool is None:
+            stream_pool = StreamPool(stream_pool_size, stream_pool_tls_servers)
+    return stream_pool
+
+
+def tcp(request, where, timeout, port=53):
+    return get_stream_pool().query(request, where, timeout, port=port)
+
+
+# Queries to servers using DNS-over-TLS go right to their TLS connection, everything else over UDP
+def query(request, where, timeout, port=53):
+    pool = get_stream_pool()
+    if ip_address(where).compressed in pool.tls_servers:
+        return pool.query(request, where, timeout, port=port)
+    return udp(request, where, timeout, port=port)
@@ -17,17 +17,34 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from os.path import basename
 from os import nice
+from socket import gethostname
+from threading import BoundedSemaphore, Condition, Lock, Thread
+from time import monotonic, sleep
 
 from redis import Redis
-from rq import Connection, Worker
+from rq import Connection, Queue, SimpleWorker, Worker
+from rq.job import Job, JobStatus
+from rq.timeouts import TimerDeathPenalty
+from rq.worker import StopRequested, WorkerStatus
 
-from .crawl import process_domain, get_json_result  # noqa F401
+from .config_loader import default_config_filename, load_config
+from .context import get_crawl_context
+from .crawl import process_domain, get_json_result, push_failed_job, push_results, result_claims  # noqa F401
+from .redis_utils import FEEDING_KEY
 
 logger = logging.getLogger("rq.worker")
 
+WATCHDOG_INTERVAL = 5
+WATCHDOG_GRACE_PERIOD = 60
+WATCHDOG_EXIT_CODE = 3
+DEAD_WORKER_ERROR = "Worker died while running the job."
+FEEDING_WAIT_INTERVAL = 1
+
 
 def print_help():
     exe = basename(sys.argv[0])
@@ -41,6 +58,163 @@ class CrawlerWorker(Worker):
     log_result_lifespan = False
     log_job_description = False
 
+    def dequeue_job_and_maintain_ttl(self, timeout):
+        # done in the worker process itself (and before taking a job from the queue), so forked work horses
+        # just inherit the already loaded context
+        self.refresh_context()
+        result = super().dequeue_job_and_maintain_ttl(timeout)
+        # the queue can be empty for a moment when the controller feeds it gradually, don't quit in that case
+        while result is None and timeout is None and self.connection.exists(FEEDING_KEY):
+            sleep(FEEDING_WAIT_INTERVAL)
+            result = super().dequeue_job_and_maintain_ttl(timeout)
+        return result
+
+    def refresh_context(self):
+        get_crawl_context(self.connection).refresh()
+
+    def handle_job_failure(self, job, queue, started_job_registry=None, exc_string=""):
+        super().handle_job_failure(job, queue, started_job_registry=started_job_registry, exc_string=exc_string)
+        if not job.retries_left and self.claim_failed_job(job):
+            lines = exc_string.strip().splitlines()
+            push_failed_job(job, lines[-1] if lines else "Job failed", self.connection)
+
+    # whether the failed job's domains should get error entries (they don't if its results were pushed already)
+    def claim_failed_job(self, job):
+        return True
+
+
+class InProcessCrawlerWorker(CrawlerWorker, SimpleWorker):
+    # runs jobs in the worker process itself (no fork per job), so anything cached in memory survives
+    # to the next domain; a watchdog thread kills the whole process if a job gets stuck despite its timeout
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.running_jobs = {}
+        self.running_jobs_lock = Lock()
+
+    def bootstrap(self, *args, **kwargs):
+        super().bootstrap(*args, **kwargs)
+        Thread(target=self.watch_running_jobs, daemon=True).start()
+
+    def perform_job(self, job, queue):
+        timeout = job.timeout or self.queue_class.DEFAULT_TIMEOUT
+        deadline = monotonic() + timeout + WATCHDOG_GRACE_PERIOD if timeout > 0 else None
+        with self.running_jobs_lock:
+            self.running_jobs[job.id] = (job, queue, deadline)
+        try:
+            return super().perform_job(job, queue)
+        finally:
+            with self.running_jobs_lock:
+                del self.running_jobs[job.id]
+                result_claims.release(job.id)
+
+    def claim_failed_job(self, job):
+        return result_claims.abandon(job.id)
+
+    def watch_running_jobs(self):
+        while True:
+            sleep(WATCHDOG_INTERVAL)
+            if self.check_running_jobs():
+                self.register_death()
+                os._exit(WATCHDOG_EXIT_CODE)
+
+    # Returns True if a job got stuck – the other running jobs are then given to another worker (unless they pushed
+    # their results already), since they would die with the process. The lock is held all the time, so no job
+    # can finish (and release its claim) in the meantime.
+    def check_running_jobs(self):
+        now = monotonic()
+        with self.running_jobs_lock:
+            running_jobs = list(self.running_jobs.values())
+            if not any(deadline is not None and deadline < now for _, _, deadline in running_jobs):
+                return False
+            for job, queue, deadline in running_jobs:
+                if deadline is not None and deadline < now:
+                    self.log.warning(f"Job {job.id} is stuck, moving it to FailedJobRegistry and killing the worker")
+                    self.handle_job_failure(job, queue, exc_string="Job got stuck and its worker was killed.")
+                elif result_claims.abandon(job.id):
+                    queue.started_job_registry.remove(job)
+                    queue.enqueue_job(job, at_front=True)
+        return True
+
+
+class ThreadedCrawlerWorker(InProcessCrawlerWorker):
+    # jobs run in threads of the worker process, so SIGALRM can't be used to time them out
+    death_penalty_class = TimerDeathPenalty
+
+    def __init__(self, *args, concurrency=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.slots = BoundedSemaphore(concurrency)
+        self.active_jobs = 0
+        self.idle = Condition()
+
+    def dequeue_job_and_maintain_ttl(self, timeout):
+        # wait for a free slot first, so the job isn't taken from the queue before it can run
+        self.slots.acquire()
+        # the stop might have been requested while waiting
+        if self._stop_requested:
+            self.slots.release()
+            raise StopRequested()
+        result = super().dequeue_job_and_maintain_ttl(timeout)
+        if result is None:
+            self.slots.release()
+        return result
+
+    # Reloading the context closes its DNS pools and executors, so no new jobs are started until the running ones
+    # finish
+    def refresh_context(self):
+        context = get_crawl_context(self.connection)
+        if context.is_outdated():
+            with self.idle:
+                self.idle.wait_for(lambda: self.active_jobs == 0)
+            context.refresh()
+
+    def execute_job(self, job, queue):
+        self.set_state(WorkerStatus.BUSY)
+        with self.idle:
+            self.active_jobs = self.active_jobs + 1
+        self.executor.submit(self.perform_job_in_thread, job, queue)
+
+    def perform_job_in_thread(self, job, queue):
+        try:
+            self.perform_job(job, queue)
+        finally:
+            with self.running_jobs_lock:
+                if len(self.running_jobs) == 0:
+                    self.set_state(WorkerStatus.IDLE)
+            with self.idle:
+                self.active_jobs = self.active_jobs - 1
+                self.idle.notify_all()
+            self.slots.release()
+
+    def teardown(self):
+        self.executor.shutdown(wait=True)
+        super().teardown()
+
+
+# A worker process which died without cleaning up after itself (OOM killer, crash in a C extension, unhandled
+# exception…) leaves its jobs in StartedJobRegistry – they're failed and their domains get error entries, so the
+# controller doesn't wait for them, and the worker is marked as dead, so it can be started again under the same name.
+# Returns the number of failed jobs.
+def clean_up_dead_worker(name, redis, queue_name="default"):
+    queue = Queue(queue_name, connection=redis)
+    registry = queue.started_job_registry
+    failed_count = 0
+    for job in Job.fetch_many(registry.get_job_ids(), connection=redis):
+        if job is None or job.worker_name != name:
+            continue
+        with redis.pipeline() as pipe:
+            registry.remove(job, pipeline=pipe)
+            job.set_status(JobStatus.FAILED, pipeline=pipe)
+            queue.failed_job_registry.add(job, ttl=job.failure_ttl, exc_string=DEAD_WORKER_ERROR, pipeline=pipe)
+            pipe.execute()
+        push_failed_job(job, DEAD_WORKER_ERROR, redis)
+        failed_count = failed_count + 1
+    worker = Worker.find_by_key(Worker.redis_worker_namespace_prefix + name, connection=redis)
+    if worker is not None:
+        worker.register_death()
+    return failed_count
+
 
 def main():
     if "-h" in sys.argv or "--help" in sys.argv or len(sys.argv) < 5:
@@ -56,7 +230,16 @@ def main():
 
     nice(niceness)
 
-    with Connection(Redis(host=redis_host, port=redis_port, db=redis_db)):
+    redis = Redis(host=redis_host, port=redis_port, db=redis_db)
+    config = load_config(default_config_filename, redis=redis, hostname=gethostname())
+    concurrency = config["worker_concurrency"]
+
+    with Connection(redis):
         q = ["default"]
-        w = CrawlerWorker(q, name=sys.argv[4])
+        if concurrency > 1:
+            w = ThreadedCrawlerWorker(q, name=sys.argv[4], concurrency=concurrency)
+        elif not config["worker_fork"]:
+            w = InProcessCrawlerWorker(q, name=sys.argv[4])
+        else:
+            w = CrawlerWorker(q, name=sys.argv[4])
         w.work(burst=True)
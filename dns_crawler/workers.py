@@ -31,13 +31,15 @@ from .controller import ControllerNotRunning
 from .ip_utils import get_source_addresses
 from .redis_utils import get_redis_host
 from .timestamp import timestamp
+from .worker import WATCHDOG_EXIT_CODE, clean_up_dead_worker
 
 
 def print_help():
     exe = basename(sys.argv[0])
     sys.stderr.write(f"{exe} - a process that spawns crawler workers.\n\n")
     sys.stderr.write(f"Usage: {exe} [count] [redis]\n")
-    sys.stderr.write("       count - worker count, 8 workers per CPU core by default\n")
+    sys.stderr.write("       count - worker count, 8 workers per CPU core by default " +
+                     "(1 per core if worker_concurrency is set in the config)\n")
     sys.stderr.write("       redis - redis host:port:db, localhost:6379:0 by default\n\n")
     sys.stderr.write(f"Examples: {exe} 8\n")
     sys.stderr.write(f"          {exe} 24 192.168.0.22:4444:0\n")
@@ -48,7 +50,7 @@ def print_help():
 
 def main():
     cpus = cpu_count()
-    worker_count = cpus * 8
+    worker_count = None
     hostname = gethostname()
     if "-h" in sys.argv or "--help" in sys.argv:
         print_help()
@@ -60,10 +62,10 @@ def main():
         print_help()
     except IndexError:
         pass
-    if worker_count <= 0:
+    if worker_count is not None and worker_count <= 0:
         sys.stderr.write("At least one worker is needed.\n\n")
         print_help()
-    if worker_count > 24 * cpus:
+    if worker_count is not None and worker_count > 24 * cpus:
         sys.stderr.write((
             f"Whoa. You are trying to run {worker_count} workers on {cpus} CPU "
             f"core{('s' if cpus > 1 else '')}. It's easy to scale \n"
@@ -103,6 +105,10 @@ def main():
     sys.stderr.write(f"{timestamp()} We will use these source IPs for HTTP(S) " +
                      f"connections – IPv4: {source_ipv4}, IPv6: {source_ipv6}.\n")
 
+    concurrency = config["worker_concurrency"]
+    if worker_count is None:
+        worker_count = cpus * 8 if concurrency <= 1 else cpus
+
     commands = []
 
     for n in range(worker_count):
@@ -121,7 +127,10 @@ def main():
         except KeyboardInterrupt:
             exit(0)
 
-    sys.stderr.write(f"{timestamp()} Starting {worker_count} workers.\n")
+    if concurrency > 1:
+        sys.stderr.write(f"{timestamp()} Starting {worker_count} workers, {concurrency} domains in parallel each.\n")
+    else:
+        sys.stderr.write(f"{timestamp()} Starting {worker_count} workers.\n")
 
     procs = []
     for i, cmd in enumerate(commands):
@@ -129,8 +138,25 @@ def main():
         if i % 10 == 0:
             sleep(5)
 
+    workers = list(zip(commands, procs))
     try:
-        for p in procs:
-            p.wait()
+        while len(workers) > 0:
+            sleep(1)
+            running = []
+            for cmd, p in workers:
+                returncode = p.poll()
+                if returncode is None:
+                    running.append((cmd, p))
+                elif returncode != 0:
+                    # burst workers exit with 0 once the queue is empty, anything else means the worker died
+                    if returncode == WATCHDOG_EXIT_CODE:
+                        reason = "was killed by its watchdog"
+                    else:
+                        reason = f"died (exit code {returncode})"
+                    failed_count = clean_up_dead_worker(cmd[4], redis)
+                    sys.stderr.write(f"{timestamp()} Worker {cmd[4]} {reason}, {failed_count} of its jobs failed, "
+                                     "restarting it.\n")
+                    running.append((cmd, subprocess.Popen(cmd)))
+            workers = running
     except KeyboardInterrupt:
         pass
@@ -0,0 +1,177 @@
+# Copyright © 2019-2023 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import socket
+import struct
+from threading import Lock, Thread
+from time import sleep
+
+import dns.flags
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import dns.resolver
+import dns.rrset
+import pytest
+
+from dns_crawler import transport
+
+
+def receive_exactly(sock, length):
+    data = b""
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise EOFError()
+        data = data + chunk
+    return data
+
+
+# A tiny authoritative server on localhost (UDP and TCP on the same port) answering from a dict of records, so DNS
+# code can be tested without the network
+class FakeDNSServer:
+    def __init__(self):
+        self.records = {}
+        self.rcodes = {}
+        self.truncated = set()
+        self.delays = {}
+        self.queries = []
+        self.lock = Lock()
+        self.running = True
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind(("127.0.0.1", 0))
+        self.udp.settimeout(0.1)
+        self.ip, self.port = self.udp.getsockname()
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp.bind((self.ip, self.port))
+        self.tcp.listen()
+        self.tcp.settimeout(0.1)
+        self.threads = [Thread(target=self.serve_udp, daemon=True), Thread(target=self.serve_tcp, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def add(self, name, rdtype, *values, ttl=300, rdclass="IN"):
+        name = dns.name.from_text(name)
+        rrset = dns.rrset.from_text_list(name, ttl, rdclass, rdtype, list(values))
+        self.records.setdefault((name, rrset.rdclass, rrset.rdtype), []).append(rrset)
+
+    # answers for this name get the rcode (eg. NXDOMAIN or REFUSED)
+    def set_rcode(self, name, rcode, soa=None):
+        self.rcodes[dns.name.from_text(name)] = (rcode, soa)
+
+    def resolver(self):
+        resolver = dns.resolver.Resolver(configure=False)
+        resolver.nameservers = [self.ip]
+        resolver.port = self.port
+        resolver.timeout = resolver.lifetime = 2
+        return resolver
+
+    def count(self, name, rdtype, protocol=None):
+        with self.lock:
+            return len([query for query in self.queries if query[1:] == (name, rdtype)
+                        and (protocol is None or query[0] == protocol)])
+
+    def respond(self, wire, protocol):
+        request = dns.message.from_wire(wire)
+        question = request.question[0]
+        with self.lock:
+            self.queries.append((protocol, question.name.to_text(), dns.rdatatype.to_text(question.rdtype)))
+        sleep(self.delays.get(question.name.to_text(), 0))
+        response = dns.message.make_response(request)
+        rcode, soa = self.rcodes.get(question.name, (dns.rcode.NOERROR, None))
+        response.set_rcode(rcode)
+        for rrset in self.records.get((question.name, question.rdclass, question.rdtype), []):
+            response.answer.append(rrset)
+        if soa is not None:
+            response.authority.append(dns.rrset.from_text(question.name.parent(), soa[0], "IN", "SOA", soa[1]))
+        if protocol == "udp" and question.name.to_text() in self.truncated:
+            response.flags |= dns.flags.TC
+            response.answer = []
+        return response.to_wire()
+
+    def serve_udp(self):
+        while self.running:
+            try:
+                wire, source = self.udp.recvfrom(65535)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            Thread(target=lambda w=wire, s=source: self.udp.sendto(self.respond(w, "udp"), s), daemon=True).start()
+
+    def serve_tcp(self):
+        while self.running:
+            try:
+                connection, _ = self.tcp.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            Thread(target=self.serve_connection, args=(connection,), daemon=True).start()
+
+    def serve_connection(self, connection):
+        send_lock = Lock()
+
+        def answer(wire):
+            response = self.respond(wire, "tcp")
+            with send_lock:
+                connection.sendall(struct.pack("!H", len(response)) + response)
+
+        try:
+            while self.running:
+                (length,) = struct.unpack("!H", receive_exactly(connection, 2))
+                # answered in threads, so pipelined queries can be answered out of order
+                Thread(target=answer, args=(receive_exactly(connection, length),), daemon=True).start()
+        except (OSError, EOFError):
+            pass
+        connection.close()
+
+    def close(self):
+        self.running = False
+        for thread in self.threads:
+            thread.join()
+        self.udp.close()
+        self.tcp.close()
+
+
+@pytest.fixture
+def dns_server():
+    server = FakeDNSServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def other_dns_server():
+    server = FakeDNSServer()
+    yield server
+    server.close()
+
+
+# every test gets its own transport pools, so sockets and connections from earlier tests aren't reused
+@pytest.fixture(autouse=True)
+def transport_pools():
+    yield
+    for pool in (transport.udp_pool, transport.stream_pool):
+        if pool is not None:
+            pool.close()
+    transport.udp_pool = None
+    transport.stream_pool = None
@@ -0,0 +1,137 @@
+# Copyright © 2019-2023 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import pytest
+
+from dns_crawler import cache
+from dns_crawler.cache import JobCache, LRUCache, SharedCache
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+@pytest.fixture
+def redis():
+    return fakeredis.FakeStrictRedis()
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_cache_evicts_least_recently_used():
+    lru = LRUCache(2)
+    lru.set("a", 1)
+    lru.set("b", 2)
+    assert lru.get("a") == 1
+    lru.set("c", 3)
+    assert lru.get("b") is None
+    assert lru.get("a") == 1
+    assert lru.get("c") == 3
+    assert lru.get("b", "default") == "default"
+
+
+def test_lru_cache_expires_items(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache, "monotonic", clock)
+    lru = LRUCache(10, ttl=60)
+    lru.set("a", 1)
+    clock.now += 59
+    assert lru.get("a") == 1
+    clock.now += 2
+    assert lru.get("a") is None
+    assert "a" not in lru.items
+
+
+def test_lru_cache_disabled():
+    lru = LRUCache(0)
+    lru.set("a", 1)
+    assert lru.get("a") is None
+
+
+def test_shared_cache_serves_hot_keys_from_memory(redis):
+    shared = SharedCache(redis, 3600, 10)
+    shared.set("ns", [{"value": "192.0.2.1"}])
+    assert redis.get("ns") == b'[{"value": "192.0.2.1"}]'
+    # changed in Redis by another worker, but this one still has its local copy
+    redis.set("ns", "[]")
+    assert shared.get("ns") == [{"value": "192.0.2.1"}]
+    # a worker without the key in memory gets it from Redis and keeps it
+    other = SharedCache(redis, 3600, 10)
+    assert other.get("ns") == []
+    redis.delete("ns")
+    assert other.get("ns") == []
+    assert other.get("unknown") is None
+
+
+def test_shared_cache_stores_a_copy(redis):
+    shared = SharedCache(redis, 3600, 10)
+    value = {"ips": ["192.0.2.1"]}
+    shared.set("key", value)
+    value["ips"].append("192.0.2.2")
+    assert shared.get("key") == {"ips": ["192.0.2.1"]}
+
+
+def test_shared_cache_without_redis():
+    shared = SharedCache(None, 3600, 10)
+    assert shared.get("key") is None
+    shared.set("key", 1)
+    assert shared.get("key") == 1
+
+
+def test_get_many_fetches_missing_keys_in_one_round_trip(redis, monkeypatch):
+    shared = SharedCache(redis, 3600, 10)
+    shared.set("local", 1)
+    redis.set("remote", "2", ex=10)
+    executed = []
+    pipeline = redis.pipeline
+
+    def counting_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+        pipe.execute = lambda: executed.append(True) or execute()
+        return pipe
+
+    monkeypatch.setattr(redis, "pipeline", counting_pipeline)
+    assert shared.get_many(["local", "remote", "missing"]) == {"local": 1, "remote": 2, "missing": None}
+    assert len(executed) == 1
+    # found keys don't expire while they're used
+    assert redis.ttl("remote") > 10
+    # all keys in memory, no round trip at all
+    assert shared.get_many(["local", "remote"]) == {"local": 1, "remote": 2}
+    assert len(executed) == 1
+
+
+def test_job_cache_remembers_prefetched_hits_and_misses(redis):
+    shared = SharedCache(redis, 3600, 0)
+    redis.set("a", "1")
+    job_cache = JobCache(shared)
+    job_cache.prefetch(["a", "b", "a"])
+    assert job_cache.known == {"a": 1, "b": None}
+    redis.set("b", "2")
+    redis.delete("a")
+    assert job_cache.get("a") == 1
+    assert job_cache.get("b") is None
+    # set values go to the shared cache, and are read from it again
+    job_cache.set("b", 3)
+    assert job_cache.get("b") == 3
+    assert redis.get("b") == b"3"
+    assert job_cache.get("c") is None
@@ -0,0 +1,84 @@
+# Copyright © 2019-2023 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import zstandard
+
+from dns_crawler.compression import (
+    ResultCompressor,
+    get_result_compressor,
+    get_result_decompressor,
+    save_dictionary,
+)
+from dns_crawler.redis_utils import DICTIONARY_KEY
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+def make_result(i):
+    return json.dumps({"domain": f"domain{i}.cz", "results": {"DNS_LOCAL": {"WEB4": [{"value": f"192.0.2.{i % 256}"}],
+                                                                           "MAIL": None}}}).encode("utf-8")
+
+
+@pytest.fixture(scope="module")
+def dictionary():
+    return zstandard.train_dictionary(4096, [make_result(i) for i in range(2000)]).as_bytes()
+
+
+def make_config(algorithm="zstd", dictionary=None):
+    return {"compression": {"algorithm": algorithm, "level": 3, "dictionary": dictionary}}
+
+
+def test_round_trip():
+    compressor = ResultCompressor(3)
+    results = [make_result(i) for i in range(10)]
+    with ThreadPoolExecutor(4) as executor:
+        compressed = list(executor.map(compressor.compress, results))
+    decompressor = get_result_decompressor()
+    assert [decompressor.decompress(data) for data in compressed] == results
+
+
+def test_round_trip_with_dictionary(dictionary):
+    result = make_result(12345)
+    compressed = ResultCompressor(3, dictionary).compress(result)
+    assert len(compressed) < len(ResultCompressor(3).compress(result))
+    assert get_result_decompressor(dictionary).decompress(compressed) == result
+    # the dictionary is needed
+    with pytest.raises(zstandard.ZstdError):
+        get_result_decompressor().decompress(compressed)
+
+
+def test_dictionary_shared_via_redis(tmp_path, dictionary):
+    redis = fakeredis.FakeStrictRedis()
+    (tmp_path / "results.dict").write_bytes(dictionary)
+    config = make_config(dictionary=str(tmp_path / "results.dict"))
+    assert save_dictionary(config, redis) == dictionary
+    assert redis.get(DICTIONARY_KEY) == dictionary
+    compressor = get_result_compressor(config, redis)
+    assert get_result_decompressor(dictionary).decompress(compressor.compress(b"{}")) == b"{}"
+
+
+def test_compression_disabled():
+    redis = fakeredis.FakeStrictRedis()
+    assert get_result_compressor(make_config(None), redis) is None
+    assert save_dictionary(make_config(None, "results.dict"), redis) is None
+    assert save_dictionary(make_config(), redis) is None
+    assert get_result_compressor(make_config(), redis).dictionary is None
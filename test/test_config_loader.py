@@ -0,0 +1,38 @@
+# Copyright © 2019-2023 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from dns_crawler.config_loader import merge_dicts
+
+
+def test_merge_dicts_converts_values():
+    config = merge_dicts({"timeouts": {"dns": "5"}, "web": {"check_http": "False", "check_https": "True"},
+                          "dns": {"resolvers": ["193.17.47.1"]}}, {"timeouts": {"dns": 2, "http": 2}})
+    assert config == {"timeouts": {"dns": 5.0, "http": 2}, "web": {"check_http": False, "check_https": True},
+                      "dns": {"resolvers": ["193.17.47.1"]}}
+
+
+def test_merge_dicts_keeps_file_names():
+    config = merge_dicts({"output": {"file": "2023-06-01.parquet", "row_group_size": 100},
+                          "delta": {"previous": "2023-05-01.idx"},
+                          "geoip": {"country": "2023/GeoLite2-Country.mmdb"},
+                          "connectivity_check_ips": {"ipv4": "193.17.47.1"}}, {})
+    assert config["output"] == {"file": "2023-06-01.parquet", "row_group_size": 100}
+    assert config["delta"]["previous"] == "2023-05-01.idx"
+    assert config["geoip"]["country"] == "2023/GeoLite2-Country.mmdb"
+    assert config["connectivity_check_ips"]["ipv4"] == "193.17.47.1"
+
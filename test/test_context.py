@@ -0,0 +1,94 @@
+# Copyright © 2019-2023 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import sleep
+
+import pytest
+
+from dns_crawler import context as context_module
+from dns_crawler.context import CrawlContext, JobExecutor
+from dns_crawler.geoip_utils import GeoIPDatabases
+
+
+class Reader:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def context(tmp_path, monkeypatch):
+    # defaults only (no config.yml in the working directory)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(context_module, "init_geoip", lambda config: GeoIPDatabases(Reader(), None, Reader(), 0))
+    return CrawlContext()
+
+
+def test_reload_replaces_the_executors(context):
+    query_executor, probe_executor = context.query_executor, context.probe_executor
+    context.load()
+    assert context.query_executor is not query_executor
+    assert context.probe_executor is not probe_executor
+    assert query_executor._shutdown
+    assert probe_executor._shutdown
+    assert not context.query_executor._shutdown
+
+
+def test_reload_closes_the_previous_geoip_databases(context):
+    geoip_dbs = context.geoip_dbs
+    context.load()
+    assert geoip_dbs.country.closed
+    assert geoip_dbs.asn.closed
+    assert not context.geoip_dbs.country.closed
+    assert not context.geoip_dbs.asn.closed
+
+
+def test_job_executor_limits_tasks_of_one_job():
+    running = []
+    peaks = {}
+    lock = Lock()
+
+    def task(job):
+        with lock:
+            running.append(job)
+            peaks[job] = max(peaks.get(job, 0), running.count(job))
+        sleep(0.05)
+        with lock:
+            running.remove(job)
+        return job
+
+    shared = ThreadPoolExecutor(8)
+    jobs = {job: JobExecutor(shared, 2) for job in ("a", "b")}
+    futures = [jobs[job].submit(task, job) for _ in range(5) for job in jobs]
+    assert sorted(future.result() for future in futures) == ["a"] * 5 + ["b"] * 5
+    shared.shutdown()
+    # both jobs ran in parallel, but neither of them had more than two tasks running at once
+    assert peaks == {"a": 2, "b": 2}
+
+
+def test_job_executors_use_the_configured_limits(context):
+    query_executor, probe_executor = context.get_job_executors()
+    assert query_executor.executor is context.query_executor
+    assert probe_executor.executor is context.probe_executor
+    for _ in range(context.config["dns"]["max_parallel_queries"]):
+        assert query_executor.slots.acquire(blocking=False)
+    assert not query_executor.slots.acquire(blocking=False)
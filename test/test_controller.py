@@ -0,0 +1,95 @@
+# Copyright © 2019-2023 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from io import StringIO
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from dns_crawler import web_utils
+
+# a checkout without the web probes can't import dns_crawler.controller (any other import error is a failure)
+if not hasattr(web_utils, "get_webserver_info"):
+    pytest.skip("dns_crawler.web_utils has no get_webserver_info", allow_module_level=True)
+
+from rq import Queue
+
+from dns_crawler import controller
+from dns_crawler.redis_utils import FEEDING_KEY
+
+
+@pytest.fixture
+def redis():
+    return fakeredis.FakeStrictRedis()
+
+
+def get_domains(queue):
+    return [domain for job in queue.jobs for domain in job.args[0]]
+
+
+def test_feed_queue_keeps_at_most_max_jobs_queued(redis):
+    queue = Queue(connection=redis)
+    redis.set(FEEDING_KEY, 1)
+    input_file = StringIO("".join(f"domain{i}.cz\n" for i in range(10)))
+    assert controller.feed_queue(input_file, redis, queue, 4, 60, 1) == (4, True)
+    assert get_domains(queue) == [f"domain{i}.cz" for i in range(4)]
+    # nothing is added until workers take some jobs
+    assert controller.feed_queue(input_file, redis, queue, 4, 60, 1) == (0, True)
+    # workers take two of the jobs
+    redis.lpop(queue.key)
+    redis.lpop(queue.key)
+    assert controller.feed_queue(input_file, redis, queue, 4, 60, 1) == (2, True)
+    assert get_domains(queue) == [f"domain{i}.cz" for i in range(2, 6)]
+    assert redis.get(FEEDING_KEY) == b"1"
+    redis.delete(queue.key)
+    assert controller.feed_queue(input_file, redis, queue, 4, 60, 1) == (4, True)
+    redis.delete(queue.key)
+    # the input ends, workers are told there won't be more jobs
+    assert controller.feed_queue(input_file, redis, queue, 4, 60, 1) == (0, False)
+    assert input_file.closed
+    assert redis.get(FEEDING_KEY) is None
+
+
+def test_feed_queue_with_short_input(redis):
+    queue = Queue(connection=redis)
+    input_file = StringIO("example.cz\nexample.sk\n")
+    assert controller.feed_queue(input_file, redis, queue, 10, 60, 1) == (2, False)
+    assert get_domains(queue) == ["example.cz", "example.sk"]
+
+
+def test_create_jobs_in_batches(redis):
+    queue = Queue(connection=redis)
+    domains = [f"domain{i}.cz" for i in range(5)]
+    assert controller.create_jobs(domains, controller.push_results, redis, queue, 60, 2) == 5
+    jobs = queue.jobs
+    assert [job.args[0] for job in jobs] == [domains[0:2], domains[2:4], domains[4:5]]
+    assert [job.description for job in jobs] == ["domain0.cz (+1 more)", "domain2.cz (+1 more)", "domain4.cz"]
+    # single domain jobs keep the domain as their ID
+    assert jobs[2].id == "domain4.cz"
+    assert [job.timeout for job in jobs] == [120, 120, 60]
+
+
+def test_feed_queue_counts_batches_as_jobs(redis):
+    queue = Queue(connection=redis)
+    input_file = StringIO("".join(f"domain{i}.cz\n" for i in range(10)))
+    assert controller.feed_queue(input_file, redis, queue, 2, 60, 3) == (6, True)
+    assert queue.count == 2
+    redis.delete(queue.key)
+    assert controller.feed_queue(input_file, redis, queue, 2, 60, 3) == (4, False)
+    assert [job.args[0] for job in queue.jobs] == [[f"domain{i}.cz" for i in range(6, 9)], ["domain9.cz"]]
@@ -0,0 +1,260 @@
+# Copyright © 2019-2023 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from threading import Barrier
+from types import SimpleNamespace
+
+import pytest
+from rq.timeouts import JobTimeoutException
+
+from dns_crawler import web_utils
+
+# a checkout without the web probes can't import dns_crawler.crawl (any other import error is a failure)
+if not hasattr(web_utils, "get_webserver_info"):
+    pytest.skip("dns_crawler.web_utils has no get_webserver_info", allow_module_level=True)
+
+from dns_crawler import crawl
+from dns_crawler.cache import SharedCache
+from dns_crawler.compression import ResultCompressor, get_result_decompressor
+from dns_crawler.dns_utils import QueryMemo
+from dns_crawler.geoip_utils import GeoIPDatabases
+from dns_crawler.incremental import PreviousResults, build_index
+from dns_crawler.redis_utils import RESULTS_STREAM
+from dns_crawler.stats import get_stats, increment
+
+config = {
+    "dns": {
+        "check_www": True,
+        "dkim_selectors": ["default"],
+        "additional": []
+    }
+}
+
+
+def add_domain(server, domain):
+    server.add(domain, "A", "93.184.216.34")
+    server.add(domain, "NS", f"ns.{domain}.")
+    server.add(domain, "MX", f"10 mail.{domain}.")
+    server.add(f"www.{domain}", "A", "93.184.216.35")
+    server.add(f"default._domainkey.{domain}", "TXT", '"v=DKIM1; p=abc"')
+
+
+def test_get_dns_local_reuses_the_executor(dns_server):
+    executor = ThreadPoolExecutor(4)
+    dbs = GeoIPDatabases(None, None, None, 0)
+    for domain in ("example.cz", "example.sk"):
+        add_domain(dns_server, domain)
+        result = crawl.get_dns_local(domain, config, dns_server.resolver(), dbs, executor)
+        assert result["WEB4"] == [{"value": "93.184.216.34", "geoip": {}}]
+        assert result["WEB4_www"] == [{"value": "93.184.216.35", "geoip": {}}]
+        assert result["NS_AUTH"] == [{"value": f"ns.{domain}."}]
+        assert result["MAIL"] == [{"value": f"10 mail.{domain}.", "preference": 10, "exchange": f"mail.{domain}."}]
+        assert result["TXT_DKIM"] == {"default": [{"value": '"v=DKIM1; p=abc"'}]}
+        assert result["WEB6"] is None
+        assert result["DNSSEC"] == {"valid": None, "message": "No records"}
+    # the same threads were used for both domains, and they're still there for the next one
+    assert len(executor._threads) <= 4
+    assert not executor._shutdown
+    executor.shutdown()
+
+
+def test_get_dns_auth_probes_servers_concurrently(monkeypatch):
+    ns_addresses = {
+        ("a.ns.cz.", "A"): [{"value": "192.0.2.1"}],
+        ("a.ns.cz.", "AAAA"): [{"value": "2001:db8::1"}],
+        ("b.ns.cz.", "A"): [{"value": "192.0.2.2"}, {"value": "192.0.2.3"}],
+        ("b.ns.cz.", "AAAA"): None,
+    }
+    # all four probes have to be running at once to get past the barrier
+    barrier = Barrier(4, timeout=5)
+
+    def get_auth_server_info(ip, domain, chaosrecords, geoip_dbs, timeout, fingerprint_enabled, cache):
+        barrier.wait()
+        return {"ip": ip["value"], "domain": domain}
+
+    monkeypatch.setattr(crawl, "get_auth_server_info", get_auth_server_info)
+    auth_config = {"timeouts": {"dns": 2}, "dns": {"auth_chaos_txt": [], "fingerprint": False}}
+    executor = ThreadPoolExecutor(4)
+    result = crawl.get_dns_auth("example.cz", [{"value": "a.ns.cz."}, {"value": "b.ns.cz."}], ns_addresses, None,
+                                auth_config, None, "192.0.2.100", "2001:db8::100", executor)
+    executor.shutdown()
+    assert result == [
+        {"ns": "a.ns.cz.", "ipv4": [{"ip": "192.0.2.1", "domain": "example.cz"}],
+         "ipv6": [{"ip": "2001:db8::1", "domain": "example.cz"}]},
+        {"ns": "b.ns.cz.", "ipv4": [{"ip": "192.0.2.2", "domain": "example.cz"},
+                                    {"ip": "192.0.2.3", "domain": "example.cz"}]},
+    ]
+
+
+def test_get_dns_auth_skips_families_without_source_address(monkeypatch):
+    monkeypatch.setattr(crawl, "get_auth_server_info", lambda ip, *args: {"ip": ip["value"]})
+    auth_config = {"timeouts": {"dns": 2}, "dns": {"auth_chaos_txt": [], "fingerprint": False}}
+    executor = ThreadPoolExecutor(2)
+    ns_addresses = {("a.ns.cz.", "A"): [{"value": "192.0.2.1"}], ("a.ns.cz.", "AAAA"): [{"value": "2001:db8::1"}]}
+    result = crawl.get_dns_auth("example.cz", [{"value": "a.ns.cz."}], ns_addresses, None, auth_config, None,
+                                "192.0.2.100", None, executor)
+    executor.shutdown()
+    assert result == [{"ns": "a.ns.cz.", "ipv4": [{"ip": "192.0.2.1"}]}]
+    assert crawl.get_dns_auth("example.cz", None, ns_addresses, None, auth_config, None, "192.0.2.100", None,
+                              executor) is None
+
+
+def test_get_parent_ns_is_resolved_once_per_zone(dns_server):
+    dns_server.add("cz", "NS", "a.ns.nic.cz.", "b.ns.nic.cz.")
+    dns_server.add("a.ns.nic.cz", "A", "194.0.12.1")
+    dns_server.add("a.ns.nic.cz", "AAAA", "2001:678:f::1")
+    dns_server.add("b.ns.nic.cz", "A", "194.0.13.1")
+    shared = SharedCache(None, 3600, 100)
+    executor = ThreadPoolExecutor(4)
+    for _ in range(3):
+        nameservers, addresses = crawl.get_parent_ns("cz.", dns_server.resolver(), shared, executor)
+        assert sorted(ns["value"] for ns in nameservers) == ["a.ns.nic.cz.", "b.ns.nic.cz."]
+        assert addresses[("a.ns.nic.cz.", "A")] == [{"value": "194.0.12.1"}]
+        assert addresses[("a.ns.nic.cz.", "AAAA")] == [{"value": "2001:678:f::1"}]
+        assert addresses[("b.ns.nic.cz.", "A")] == [{"value": "194.0.13.1"}]
+        assert addresses[("b.ns.nic.cz.", "AAAA")] is None
+    executor.shutdown()
+    assert dns_server.count("cz.", "NS") == 1
+    assert dns_server.count("a.ns.nic.cz.", "A") == 1
+
+
+def test_get_parent_ns_without_answer_is_not_cached(dns_server):
+    shared = SharedCache(None, 3600, 100)
+    executor = ThreadPoolExecutor(2)
+    assert crawl.get_parent_ns("cz.", dns_server.resolver(), shared, executor) == (None, {})
+    dns_server.add("cz", "NS", "a.ns.nic.cz.")
+    nameservers, _ = crawl.get_parent_ns("cz.", dns_server.resolver(), shared, executor)
+    executor.shutdown()
+    assert nameservers == [{"value": "a.ns.nic.cz."}]
+
+
+def get_stream_entries(redis):
+    return [fields for _, fields in redis.xrange(RESULTS_STREAM)]
+
+
+def test_push_results_streams_results_and_errors(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    redis = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr(crawl, "get_crawl_context", lambda redis: SimpleNamespace(compressor=None))
+
+    def get_json_result(domain):
+        if domain == "broken.cz":
+            raise ValueError("broken")
+        increment("results")
+        return f'{{"domain":"{domain}"}}'
+
+    monkeypatch.setattr(crawl, "get_json_result", get_json_result)
+    monkeypatch.setattr(crawl, "get_current_connection", lambda: redis)
+    crawl.push_results(["example.cz", "broken.cz", "example.sk"])
+    assert get_stream_entries(redis) == [{b"result": b'{"domain":"example.cz"}'},
+                                         {b"domain": b"broken.cz", b"error": b"ValueError('broken')"},
+                                         {b"result": b'{"domain":"example.sk"}'}]
+    # the stats were pushed with the results
+    assert get_stats(redis)["results"] == 2
+
+
+def test_push_results_fails_remaining_domains_when_the_job_times_out(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    redis = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr(crawl, "get_crawl_context", lambda redis: SimpleNamespace(compressor=None))
+
+    def get_json_result(domain):
+        if domain == "slow.cz":
+            raise JobTimeoutException()
+        return f'{{"domain":"{domain}"}}'
+
+    monkeypatch.setattr(crawl, "get_json_result", get_json_result)
+    monkeypatch.setattr(crawl, "get_current_connection", lambda: redis)
+    crawl.push_results(["example.cz", "slow.cz", "example.sk"])
+    assert get_stream_entries(redis) == [{b"result": b'{"domain":"example.cz"}'},
+                                         {b"domain": b"slow.cz", b"error": b"Job timed out"},
+                                         {b"domain": b"example.sk", b"error": b"Job timed out"}]
+
+
+def test_get_ns_addresses_are_cached_for_their_ttl(dns_server, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(crawl, "time", lambda: now[0])
+    dns_server.add("a.ns.example.cz", "A", "192.0.2.1", ttl=300)
+    dns_server.add("a.ns.example.cz", "AAAA", "2001:db8::1", ttl=60)
+    address_cache = SharedCache(None, 3600, 100)
+    executor = ThreadPoolExecutor(4)
+    nameservers = [[{"value": "a.ns.example.cz."}]]
+    expected = {("a.ns.example.cz.", "A"): [{"value": "192.0.2.1"}],
+                ("a.ns.example.cz.", "AAAA"): [{"value": "2001:db8::1"}]}
+    assert crawl.get_ns_addresses(nameservers, dns_server.resolver(), executor, address_cache=address_cache) == expected
+    now[0] += 59
+    assert crawl.get_ns_addresses(nameservers, dns_server.resolver(), executor, address_cache=address_cache) == expected
+    assert dns_server.count("a.ns.example.cz.", "A") == 1
+    # the lower TTL is over
+    now[0] += 2
+    assert crawl.get_ns_addresses(nameservers, dns_server.resolver(), executor, address_cache=address_cache) == expected
+    executor.shutdown()
+    assert dns_server.count("a.ns.example.cz.", "A") == 2
+
+
+def test_push_results_compresses_results(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    redis = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr(crawl, "get_crawl_context", lambda redis: SimpleNamespace(compressor=ResultCompressor(3)))
+    monkeypatch.setattr(crawl, "get_json_result", lambda domain: f'{{"domain":"{domain}"}}')
+    monkeypatch.setattr(crawl, "get_current_connection", lambda: redis)
+    crawl.push_results(["example.cz"])
+    [entry] = get_stream_entries(redis)
+    assert list(entry) == [b"result_zstd"]
+    assert get_result_decompressor().decompress(entry[b"result_zstd"]) == b'{"domain":"example.cz"}'
+
+
+def make_incremental_context(dns_server, tmp_path, previous):
+    index = tmp_path / "index.sqlite"
+    build_index(StringIO(json.dumps(previous) + "\n"), str(index))
+    return SimpleNamespace(previous_results=PreviousResults(str(index)), local_resolver=dns_server.resolver(),
+                           query_executor=ThreadPoolExecutor(4), source_ipv4=None, source_ipv6=None,
+                           config={"incremental": {"probes": []}, "save_worker_hostname": False})
+
+
+def add_zone(server, serial):
+    server.add("example.cz", "SOA", f"ns.example.cz. hostmaster.example.cz. {serial} 900 300 604800 900")
+    server.add("example.cz", "NS", "ns.example.cz.")
+
+
+def test_get_unchanged_result_reuses_dns_results(dns_server, tmp_path):
+    add_zone(dns_server, 2023050101)
+    dns_local = {"SOA": [{"value": "…", "serial": 2023050101}], "NS_AUTH": [{"value": "ns.example.cz."}],
+                 "DS": None, "WEB4": [{"value": "192.0.2.1"}]}
+    previous = {"domain": "example.cz", "timestamp": "2023-05-01 10:00:00", "results": {"DNS_LOCAL": dns_local}}
+    context = make_incremental_context(dns_server, tmp_path, previous)
+    result = crawl.get_unchanged_result("example.cz", context, None, QueryMemo(), context.query_executor)
+    context.query_executor.shutdown()
+    assert result["results"]["DNS_LOCAL"] == dns_local
+    assert result["dns_timestamp"] == "2023-05-01 10:00:00"
+    assert result["timestamp"] != "2023-05-01 10:00:00"
+    assert result["results"]["HSTS"] is False
+
+
+def test_get_unchanged_result_of_changed_zone(dns_server, tmp_path):
+    add_zone(dns_server, 2023050102)
+    dns_local = {"SOA": [{"value": "…", "serial": 2023050101}], "NS_AUTH": [{"value": "ns.example.cz."}], "DS": None}
+    previous = {"domain": "example.cz", "timestamp": "2023-05-01 10:00:00", "results": {"DNS_LOCAL": dns_local}}
+    context = make_incremental_context(dns_server, tmp_path, previous)
+    assert crawl.get_unchanged_result("example.cz", context, None, QueryMemo(), context.query_executor) is None
+    # not crawled before
+    assert crawl.get_unchanged_result("example.sk", context, None, QueryMemo(), context.query_executor) is None
+    context.query_executor.shutdown()
@@ -0,0 +1,155 @@
+# Copyright © 2019-2023 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+
+import pytest
+
+from dns_crawler.delta import (
+    SECTIONS,
+    DeltaSink,
+    HashIndex,
+    HashIndexWriter,
+    get_changed_sections,
+    get_section_hashes,
+    normalize,
+)
+from dns_crawler.output import OutputError
+
+# over 255 bytes in UTF-8
+LONG_DOMAIN = ".".join(["příliš-žluťoučký-kůň-úpěl-ďábelské-ódy"] * 4) + ".cz"
+
+
+class ListSink:
+    def __init__(self):
+        self.results = []
+        self.closed = False
+
+    def write(self, result):
+        self.results.append(result)
+
+    def close(self):
+        self.closed = True
+
+
+def make_result(domain, a="192.0.2.1", status=200, date="Mon, 01 May 2023 10:00:00 GMT"):
+    return {
+        "domain": domain,
+        "timestamp": "2023-05-01 10:00:00",
+        "parent": {"zone": "cz.", "ns": None},
+        "results": {
+            "DNS_LOCAL": {"WEB4": [{"value": a}]},
+            "WEB": {"WEB4_80": [{"steps": [{"status": status, "headers": {"Date": date}}]}]},
+            "HSTS": False
+        }
+    }
+
+
+def encode(result):
+    return json.dumps(result, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def write_index(filename, results):
+    writer = HashIndexWriter(filename)
+    for result in results:
+        writer.write(result["domain"], get_section_hashes(result))
+    writer.close()
+
+
+def test_normalize_ignores_volatile_fields_and_order():
+    first = {"records": [{"value": "b"}, {"value": "a"}], "expires_in": 10, "answer": "id 1234\nopcode QUERY",
+             "steps": [{"status": 301, "headers": {"Date": "x", "Server": "nginx"}}, {"status": 200}]}
+    second = {"records": [{"value": "a"}, {"value": "b"}], "expires_in": 20, "answer": "id 4321\nopcode QUERY",
+              "steps": [{"status": 301, "headers": {"date": "y", "Server": "nginx"}}, {"status": 200}]}
+    assert normalize(first) == normalize(second)
+    # redirect steps keep their order
+    second["steps"].reverse()
+    assert normalize(first) != normalize(second)
+
+
+def test_changed_sections():
+    previous = get_section_hashes(make_result("example.cz"))
+    current = get_section_hashes(make_result("example.cz", a="192.0.2.2", date="Tue, 02 May 2023 10:00:00 GMT"))
+    assert len(current) == len(SECTIONS) * 8
+    assert get_changed_sections(previous, current) == ["DNS_LOCAL"]
+
+
+def test_hash_index_round_trip(tmp_path):
+    results = [make_result(f"domain{i}.cz", a=f"192.0.2.{i}") for i in range(100)] + [make_result(LONG_DOMAIN)]
+    write_index(tmp_path / "index", results)
+    index = HashIndex(tmp_path / "index")
+    assert len(index) == 101
+    assert index.pop(LONG_DOMAIN) == get_section_hashes(make_result(LONG_DOMAIN))
+    assert index.pop("domain7.cz") == get_section_hashes(results[7])
+    # popped just once, unknown domains aren't there at all
+    assert index.pop("domain7.cz") is None
+    assert index.pop("unknown.cz") is None
+    assert len(index) == 99
+    assert sorted(index) == sorted(f"domain{i}.cz" for i in range(100) if i != 7)
+    index.close()
+
+
+def test_hash_index_keeps_the_last_duplicate(tmp_path):
+    write_index(tmp_path / "index", [make_result("example.cz"), make_result("example.cz", status=404)])
+    index = HashIndex(tmp_path / "index")
+    assert len(index) == 1
+    assert index.pop("example.cz") == get_section_hashes(make_result("example.cz", status=404))
+    index.close()
+
+
+def test_empty_hash_index(tmp_path):
+    write_index(tmp_path / "index", [])
+    index = HashIndex(tmp_path / "index")
+    assert len(index) == 0
+    assert index.pop("example.cz") is None
+    assert list(index) == []
+    index.close()
+
+
+@pytest.mark.parametrize("cut", [0, 10])
+def test_invalid_hash_index(tmp_path, cut):
+    write_index(tmp_path / "index", [make_result("example.cz")])
+    data = (tmp_path / "index").read_bytes()
+    # not closed (eg. the controller was killed) or a different file
+    (tmp_path / "index").write_bytes(data[:-cut] if cut else b"not an index")
+    with pytest.raises(OutputError):
+        HashIndex(tmp_path / "index")
+
+
+def test_delta_sink(tmp_path):
+    write_index(tmp_path / "previous", [make_result("same.cz"), make_result("changed.cz"), make_result("removed.cz"),
+                                        make_result(LONG_DOMAIN)])
+    sink = ListSink()
+    delta = DeltaSink(sink, previous=tmp_path / "previous", index=tmp_path / "current",
+                      unchanged=tmp_path / "unchanged", removed=tmp_path / "removed")
+    delta.write(encode(make_result("same.cz", date="Tue, 02 May 2023 10:00:00 GMT")))
+    delta.write(encode(make_result("changed.cz", status=500)))
+    delta.write(encode(make_result("new.cz")))
+    delta.write(encode(make_result(LONG_DOMAIN)))
+    delta.close()
+    assert sink.closed
+    written = [json.loads(result) for result in sink.results]
+    assert [(result["domain"], result["changed"]) for result in written] == [("changed.cz", ["WEB"]),
+                                                                             ("new.cz", None)]
+    assert (tmp_path / "unchanged").read_text(encoding="utf-8") == f"same.cz\n{LONG_DOMAIN}\n"
+    assert (tmp_path / "removed").read_text(encoding="utf-8") == "removed.cz\n"
+    # the index of this crawl is ready for the next one
+    index = HashIndex(tmp_path / "current")
+    assert len(index) == 4
+    assert index.pop("changed.cz") == get_section_hashes(make_result("changed.cz", status=500))
+    index.close()
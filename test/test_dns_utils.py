@@ -0,0 +1,187 @@
+# Copyright © 2019-2023 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import socket
+from concurrent.futures import ThreadPoolExecutor
+
+import checkdmarc
+import dns.name
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import dns.resolver
+import dns.rrset
+
+from dns_crawler import dns_utils
+from dns_crawler.cache import LRUCache, SharedCache
+from dns_crawler.dns_utils import (
+    QueryMemo,
+    get_parsed_record,
+    get_record,
+    init_record_cache,
+    parse_spf,
+    parse_tlsa,
+    query_record,
+)
+
+SHA256 = "8cb0fc6c527506a053f4f14c8464bebbd6dede2738d11468dd953d7d6a3021f1"
+CERTIFICATE = "3082" + "ab" * 200
+
+
+# answers for the name with a CNAME to the target, followed by the target's records (like a resolver does)
+def add_cname(server, name, target, rdtype, *values):
+    server.records[(dns.name.from_text(name), dns.rdataclass.IN, dns.rdatatype.from_text(rdtype))] = [
+        dns.rrset.from_text(name, 300, "IN", "CNAME", target),
+        dns.rrset.from_text_list(target, 300, "IN", rdtype, list(values))
+    ]
+
+
+def test_get_record_values(dns_server):
+    dns_server.add("example.cz", "A", "192.0.2.1", "192.0.2.2")
+    dns_server.add("example.cz", "TXT", '"hello TXT world"')
+    assert sorted(get_record("example.cz", "A", dns_server.resolver()), key=lambda item: item["value"]) == [
+        {"value": "192.0.2.1"}, {"value": "192.0.2.2"}]
+    assert get_record("example.cz", "TXT", dns_server.resolver()) == [{"value": '"hello TXT world"'}]
+    assert get_record("example.cz", "AAAA", dns_server.resolver()) is None
+
+
+def test_get_record_typed_fields(dns_server):
+    dns_server.add("example.cz", "MX", "10 mail.example.cz.")
+    dns_server.add("_25._tcp.mail.example.cz", "TLSA", f"3 1 1 {SHA256}", f"2 0 0 {CERTIFICATE}")
+    dns_server.add("example.cz", "SOA", "ns.example.cz. hostmaster.example.cz. 2023050101 900 300 604800 900")
+    dns_server.add("example.cz", "DS", "12345 13 2 " + SHA256)
+    dns_server.add("example.cz", "DNSKEY", "257 3 13 mdsswUyr3DPW132mOi8V9xESWE8jTo0dxCjjnopKl+GqJxpVXckHAeF+"
+                   "KkxLbxILfDLUT0rAK9iUzy1L53eKGQ==")
+    assert get_record("example.cz", "MX", dns_server.resolver()) == [
+        {"value": "10 mail.example.cz.", "preference": 10, "exchange": "mail.example.cz."}]
+    tlsa = sorted(get_record("_25._tcp.mail.example.cz", "TLSA", dns_server.resolver()), key=lambda item: item["usage"])
+    # long data is split into chunks in the text, but not in the data field
+    assert [(item["usage"], item["selector"], item["matchingtype"], item["data"]) for item in tlsa] == [
+        (2, 0, 0, CERTIFICATE), (3, 1, 1, SHA256)]
+    assert parse_tlsa(tlsa) == [{"usage": 2, "selector": 0, "matchingtype": 0, "data": CERTIFICATE},
+                                {"usage": 3, "selector": 1, "matchingtype": 1, "data": SHA256}]
+    soa = get_record("example.cz", "SOA", dns_server.resolver())[0]
+    assert (soa["mname"], soa["rname"], soa["serial"]) == ("ns.example.cz.", "hostmaster.example.cz.", 2023050101)
+    assert get_record("example.cz", "DS", dns_server.resolver())[0]["algorithm"] == "ECDSAP256SHA256"
+    assert get_record("example.cz", "DNSKEY", dns_server.resolver())[0]["algorithm"] == "ECDSAP256SHA256"
+
+
+def test_get_record_follows_cname(dns_server):
+    add_cname(dns_server, "www.example.cz.", "example.cdn.cz.", "A", "192.0.2.1")
+    assert get_record("www.example.cz", "A", dns_server.resolver()) == [
+        {"cname": "example.cdn.cz.", "value": None},
+        {"value": "192.0.2.1", "from_cname": "example.cdn.cz."}
+    ]
+
+
+def test_get_record_retries_truncated_answers_over_tcp(dns_server):
+    dns_server.add("big.example.cz", "TXT", *[f'"record {i}"' for i in range(3)])
+    dns_server.truncated.add("big.example.cz.")
+    assert len(get_record("big.example.cz", "TXT", dns_server.resolver())) == 3
+    assert dns_server.count("big.example.cz.", "TXT", "udp") == 1
+    assert dns_server.count("big.example.cz.", "TXT", "tcp") == 1
+
+
+def test_query_memo_sends_each_query_once(dns_server):
+    dns_server.add("example.cz", "A", "192.0.2.1")
+    memo = QueryMemo()
+    first = get_record("example.cz", "A", dns_server.resolver(), memo=memo)
+    # callers can modify their results without changing the others'
+    first[0]["geoip"] = {"country": "CZ"}
+    assert get_record("example.cz.", "A", dns_server.resolver(), memo=memo) == [{"value": "192.0.2.1"}]
+    assert get_record("EXAMPLE.cz", "A", dns_server.resolver(), memo=memo) == [{"value": "192.0.2.1"}]
+    assert get_record("example.cz", "AAAA", dns_server.resolver(), memo=memo) is None
+    assert dns_server.count("example.cz.", "A") == 1
+    # another job has its own memo
+    get_record("example.cz", "A", dns_server.resolver(), memo=QueryMemo())
+    assert dns_server.count("example.cz.", "A") == 2
+
+
+def test_query_memo_waits_for_running_query(dns_server):
+    dns_server.add("slow.cz", "A", "192.0.2.1")
+    dns_server.delays["slow.cz."] = 0.3
+    memo = QueryMemo()
+    executor = ThreadPoolExecutor(4)
+    futures = [executor.submit(get_record, "slow.cz", "A", dns_server.resolver(), memo=memo) for _ in range(4)]
+    results = [future.result() for future in futures]
+    executor.shutdown()
+    assert results == [[{"value": "192.0.2.1"}]] * 4
+    assert dns_server.count("slow.cz.", "A") == 1
+
+
+def test_query_record_ttl(dns_server):
+    dns_server.add("example.cz", "A", "192.0.2.1", ttl=300)
+    add_cname(dns_server, "www.example.cz.", "example.cdn.cz.", "A", "192.0.2.2")
+    dns_server.records[(dns.name.from_text("www.example.cz"), dns.rdataclass.IN, dns.rdatatype.A)][1].ttl = 60
+    assert query_record("example.cz", "A", dns_server.resolver()) == ([{"value": "192.0.2.1"}], 300)
+    # the lowest TTL in the chain
+    assert query_record("www.example.cz", "A", dns_server.resolver())[1] == 60
+
+
+def test_query_record_negative_ttl(dns_server):
+    soa = "ns.example.cz. hostmaster.example.cz. 1 900 300 604800 120"
+    dns_server.set_rcode("missing.example.cz", dns.rcode.NXDOMAIN, soa=(3600, soa))
+    dns_server.set_rcode("empty.example.cz", dns.rcode.NOERROR, soa=(60, soa))
+    # the lower of the SOA record's TTL and its minimum
+    assert query_record("missing.example.cz", "A", dns_server.resolver()) == (None, 120)
+    assert query_record("empty.example.cz", "A", dns_server.resolver()) == (None, 60)
+
+
+def test_query_record_without_response():
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(("127.0.0.1", 0))
+    resolver = dns.resolver.Resolver(configure=False)
+    resolver.nameservers = ["127.0.0.1"]
+    resolver.port = server.getsockname()[1]
+    resolver.timeout = resolver.lifetime = 0.2
+    try:
+        assert query_record("example.cz", "A", resolver) == (None, None)
+    finally:
+        server.close()
+
+
+def test_parsed_records_are_cached(monkeypatch):
+    monkeypatch.setattr(dns_utils, "record_cache", LRUCache(10))
+    parsed = []
+
+    def parse_record(record, domain):
+        parsed.append((record, domain))
+        return {"parsed": record.split()}
+
+    first = get_parsed_record(parse_record, "v=spf1 -all", "example.cz")
+    first["parsed"].append("modified")
+    assert get_parsed_record(parse_record, "v=spf1 -all", "example.cz") == {"parsed": ["v=spf1", "-all"]}
+    # the domain can change the result (eg. DMARC report destinations)
+    get_parsed_record(parse_record, "v=spf1 -all", "example.sk")
+    assert parsed == [("v=spf1 -all", "example.cz"), ("v=spf1 -all", "example.sk")]
+
+
+def test_checkdmarc_cache(monkeypatch):
+    shared = SharedCache(None, 3600, 10)
+    # both are restored after the test
+    monkeypatch.setattr(checkdmarc, "DNS_CACHE", None)
+    monkeypatch.setattr(dns_utils, "record_cache", dns_utils.record_cache)
+    init_record_cache(shared, 10, 60)
+    cache = checkdmarc.DNS_CACHE
+    # checkdmarc skips empty caches
+    assert cache
+    assert cache.get("_spf.example.cz_TXT", "default") == "default"
+    cache["_spf.example.cz_TXT"] = ["v=spf1 -all"]
+    assert shared.get("cache-checkdmarc-_spf.example.cz_TXT") == ["v=spf1 -all"]
+    assert cache.get("_spf.example.cz_TXT") == ["v=spf1 -all"]
+    assert parse_spf([{"value": "v=spf1 ip4:192.0.2.0/24 -all"}], "example.cz")[0]["ip4"] == ["192.0.2.0/24"]
@@ -0,0 +1,100 @@
+# Copyright © 2019-2023 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+from types import SimpleNamespace
+
+from dns_crawler import geoip_update
+from dns_crawler.geoip_utils import GeoIPDatabases, annotate_geoip, annotate_geoip_many, geoip_single
+
+
+# Stands in for geoip2.database.Reader, every IP is in the Czech Republic
+class FakeReader:
+    def __init__(self):
+        self.lookups = []
+
+    def country(self, ip):
+        self.lookups.append(ip)
+        return SimpleNamespace(country=SimpleNamespace(iso_code="CZ"))
+
+    def asn(self, ip):
+        self.lookups.append(ip)
+        if ip == "8.8.8.8":
+            raise ValueError(f"The address {ip} is not in the database.")
+        return SimpleNamespace(autonomous_system_organization="CZ.NIC, z.s.p.o.", autonomous_system_number=25192)
+
+    def close(self):
+        pass
+
+
+def make_dbs(memo_size=100):
+    return GeoIPDatabases(FakeReader(), None, FakeReader(), memo_size)
+
+
+def test_annotate_geoip_looks_up_each_ip_once():
+    dbs = make_dbs()
+    web4 = [{"value": "217.31.205.50"}, {"value": "192.168.1.1"}, {"cname": "example.cdn.cz.", "value": None}]
+    mail4 = [{"value": "217.31.205.50"}]
+    annotate_geoip_many([web4, None, mail4], dbs)
+    geoip = {"country": "CZ", "org": "CZ.NIC, z.s.p.o.", "asn": 25192}
+    assert web4 == [{"value": "217.31.205.50", "geoip": geoip}, {"value": "192.168.1.1"},
+                    {"cname": "example.cdn.cz.", "value": None}]
+    assert mail4 == [{"value": "217.31.205.50", "geoip": geoip}]
+    # items don't share their results
+    assert web4[0]["geoip"] is not mail4[0]["geoip"]
+    # remembered for the next domains
+    annotate_geoip([{"value": "217.31.205.50"}], dbs)
+    assert dbs.country.lookups == ["217.31.205.50"]
+    assert dbs.asn.lookups == ["217.31.205.50"]
+
+
+def test_annotate_geoip_without_memo():
+    dbs = make_dbs(0)
+    annotate_geoip([{"value": "217.31.205.50"}], dbs)
+    annotate_geoip([{"value": "217.31.205.50"}], dbs)
+    assert dbs.country.lookups == ["217.31.205.50", "217.31.205.50"]
+
+
+def test_geoip_single():
+    dbs = make_dbs()
+    assert geoip_single("8.8.8.8", dbs) == {"country": "CZ", "error": "The address 8.8.8.8 is not in the database."}
+    assert geoip_single("8.8.8.8", dbs) == {"country": "CZ", "error": "The address 8.8.8.8 is not in the database."}
+    assert dbs.country.lookups == ["8.8.8.8"]
+    # name servers with non-public IPs still get a result
+    assert geoip_single("192.168.1.1", dbs) == {"country": "CZ", "org": "CZ.NIC, z.s.p.o.", "asn": 25192}
+
+
+def test_update_lines_replaces_geoip_results(monkeypatch):
+    monkeypatch.setattr(geoip_update, "geoip_dbs", GeoIPDatabases(FakeReader(), None, None, 100))
+    result = {
+        "domain": "example.cz",
+        "results": {
+            "DNS_LOCAL": {"WEB4": [{"value": "217.31.205.50", "geoip": {"country": "US"}},
+                                  {"cname": "example.cdn.cz.", "value": None}]},
+            "DNS_AUTH": [{"ns": "a.ns.example.cz.", "ipv4": [{"ip": "192.168.1.1", "geoip": {}}]}],
+            "WEB": {"geoip": "not a result of an IP"}
+        }
+    }
+    lines = [json.dumps(result) + "\n", '{"domain":"příklad.cz","results":null}\n']
+    updated = geoip_update.update_lines(lines).splitlines()
+    assert len(updated) == 2
+    result["results"]["DNS_LOCAL"]["WEB4"][0]["geoip"] = {"country": "CZ"}
+    result["results"]["DNS_AUTH"][0]["ipv4"][0]["geoip"] = {"country": "CZ"}
+    assert json.loads(updated[0]) == result
+    # lines without any GeoIP results are kept as they are
+    assert updated[1] == '{"domain":"příklad.cz","results":null}'
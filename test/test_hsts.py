@@ -0,0 +1,65 @@
+# Copyright © 2019-2023 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import pytest
+from hstspreload import in_hsts_preload
+
+from dns_crawler import hsts_utils
+from dns_crawler.hsts_utils import HSTSIndex, build_hsts_index, get_hsts_statuses, get_preload_entries
+
+
+@pytest.fixture(scope="module")
+def index(tmp_path_factory):
+    filename = tmp_path_factory.mktemp("hsts") / "hsts.idx"
+    build_hsts_index(filename)
+    return HSTSIndex(filename)
+
+
+def get_sample_hosts():
+    entries = sorted(get_preload_entries())
+    hosts = [b"google.com", b"mail.google.com", b"example.cz", b"google", b"dev", b"a.b.c.d.dev", b"cz"]
+    for host in entries[::97]:
+        hosts += [host, b"www." + host, b"not" + host, host.split(b".", 1)[-1]]
+    # hstspreload only goes 5 labels deep
+    return [host for host in hosts if host.count(b".") < 5]
+
+
+def test_index_matches_hstspreload(index):
+    for host in get_sample_hosts():
+        assert index.contains(host) == in_hsts_preload(host), host
+
+
+def test_index_flags(index):
+    entries = get_preload_entries()
+    for host, include_subdomains in list(entries.items())[::501]:
+        assert index.get(host) == include_subdomains
+    assert index.get(b"not-preloaded.example.cz") is None
+
+
+def test_invalid_index(tmp_path):
+    (tmp_path / "hsts.idx").write_bytes(b"not an index")
+    with pytest.raises(ValueError):
+        HSTSIndex(tmp_path / "hsts.idx")
+
+
+@pytest.mark.parametrize("use_index", [True, False])
+def test_get_hsts_statuses(index, monkeypatch, use_index):
+    monkeypatch.setattr(hsts_utils, "hsts_index", index if use_index else False)
+    domains = ["github.com", "api.github.com", "google.com", "mail.google.com", "example.cz", "příklad.dev"]
+    assert get_hsts_statuses(domains) == {"github.com": True, "api.github.com": True, "google.com": False,
+                                          "mail.google.com": True, "example.cz": False, "příklad.dev": True}
@@ -0,0 +1,64 @@
+# Copyright © 2019-2023 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+from io import StringIO
+
+from dns_crawler.incremental import PreviousResults, build_index, get_previous_results, get_zone_state
+
+SOA = [{"value": "a.ns.nic.cz. hostmaster.nic.cz. 1683100000 900 300 604800 900", "serial": 1683100000}]
+NS = [{"value": "b.ns.nic.cz."}, {"value": "a.ns.nic.cz."}]
+DS = [{"value": "12345 13 2 8CB0FC6C", "algorithm": "ECDSAP256SHA256"}]
+
+
+def make_result(domain, soa=SOA, ns=NS, ds=DS):
+    return {"domain": domain, "timestamp": "2023-05-01 10:00:00",
+            "results": {"DNS_LOCAL": {"SOA": soa, "NS_AUTH": ns, "DS": ds}}}
+
+
+def test_zone_state():
+    state = get_zone_state(SOA, NS, DS)
+    # order, case, glue and CNAME entries don't matter
+    assert get_zone_state(SOA, [{"value": "A.ns.nic.cz."}, {"cname": "ns.nic.cz.", "value": None},
+                                {"additional": "a.ns.nic.cz. 300 IN A 194.0.12.1"}, {"value": "b.ns.nic.cz."}],
+                          [{"value": "12345 13 2 8cb0fc6c"}]) == state
+    assert get_zone_state([{"value": "…", "serial": 1683100001}], NS, DS) != state
+    assert get_zone_state(SOA, NS[:1], DS) != state
+    assert get_zone_state(SOA, NS, None) != state
+    # without SOA, the domain is always crawled again
+    assert get_zone_state(None, NS, DS) is None
+
+
+def test_index_of_previous_results(tmp_path):
+    lines = [make_result("nic.cz"), make_result("no-soa.cz", soa=None), {"domain": "failed.cz", "results": None},
+             make_result("nic.cz", ns=NS[:1])]
+    results_file = StringIO("".join(json.dumps(result) + "\n" for result in lines))
+    assert build_index(results_file, str(tmp_path / "index.sqlite")) == 2
+    previous = PreviousResults(str(tmp_path / "index.sqlite"))
+    # the last one is kept
+    assert previous.get("nic.cz") == (get_zone_state(SOA, NS[:1], DS), lines[3])
+    assert previous.get("no-soa.cz") == (None, None)
+    assert previous.get("failed.cz") == (None, None)
+
+
+def test_get_previous_results(tmp_path):
+    build_index(StringIO(""), str(tmp_path / "index.sqlite"))
+    assert get_previous_results({"incremental": {"index": None}}) is None
+    assert get_previous_results({"incremental": {"index": str(tmp_path / "missing.sqlite")}}) is None
+    assert isinstance(get_previous_results({"incremental": {"index": str(tmp_path / "index.sqlite")}}),
+                      PreviousResults)
@@ -0,0 +1,152 @@
+# Copyright © 2019-2023 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import gzip
+import json
+from pathlib import Path
+
+import pytest
+import zstandard
+
+from dns_crawler import output
+from dns_crawler.output import (
+    JSONSink,
+    OutputError,
+    ParquetSink,
+    ShardedSink,
+    flatten_result,
+    get_output_sink,
+)
+
+EXAMPLE = (Path(__file__).parent.parent / "result-example.json").read_text(encoding="utf-8")
+
+
+def make_config(**output):
+    return {"output": {"format": "json", "file": None, "row_group_size": 10000, "include_json": False, "shards": 0,
+                       "shard_compression": "zstd", "shard_compression_level": 3, "rotate_size": 0,
+                       "rotate_count": 0, **output}}
+
+
+def test_flatten_result():
+    row = flatten_result(json.loads(EXAMPLE))
+    assert row["domain"] == "nic.cz"
+    assert row["parent_zone"] == "cz."
+    assert row["ns"] == ["a.ns.nic.cz.", "b.ns.nic.cz.", "d.ns.nic.cz."]
+    assert row["a"] == ["217.31.205.50"]
+    assert row["mx"] == ["mx.nic.cz.", "mail.nic.cz."]
+    assert row["ds_algorithms"] == ["ECDSAP256SHA256"]
+    assert row["dnssec_valid"] is True
+    assert row["dmarc_policy"] == "reject"
+    assert row["hsts_preload"] is False
+    assert row["web6_443_status"] == [200]
+    assert row["web6_443_cert_sha256"] == ["c4f6d68b281033cdb7547e06330c4eb3dcddc1a7c82e152ff4f6ed4944d978e7"]
+
+
+def test_flatten_empty_result():
+    row = flatten_result({"domain": "example.cz", "timestamp": "2023-05-01 10:00:00", "results": None})
+    assert row["domain"] == "example.cz"
+    assert row["a"] == []
+    assert row["dmarc_policy"] is None
+    assert row["web4_80_status"] == []
+
+
+def test_json_sink(tmp_path):
+    sink = JSONSink(tmp_path / "results.json")
+    sink.write(b'{"domain":"example.cz"}')
+    sink.write(b'{"domain":"example.sk"}')
+    sink.close()
+    assert (tmp_path / "results.json").read_bytes() == b'{"domain":"example.cz"}\n{"domain":"example.sk"}\n'
+
+
+@pytest.mark.parametrize("include_json", [False, True])
+def test_parquet_sink(tmp_path, include_json):
+    parquet = pytest.importorskip("pyarrow.parquet")
+    sink = ParquetSink(str(tmp_path / "results.parquet"), row_group_size=2, include_json=include_json)
+    results = [EXAMPLE.replace("nic.cz", f"domain{i}.cz").encode("utf-8") for i in range(5)]
+    for result in results:
+        sink.write(result)
+    sink.close()
+    file = parquet.ParquetFile(tmp_path / "results.parquet")
+    assert file.metadata.num_row_groups == 3
+    table = file.read()
+    assert table.column("domain").to_pylist() == [f"domain{i}.cz" for i in range(5)]
+    assert table.column("web6_443_status").to_pylist() == [[200]] * 5
+    assert table.column("dnssec_valid").to_pylist() == [True] * 5
+    if include_json:
+        assert table.column("json").to_pylist() == [result.decode("utf-8") for result in results]
+    else:
+        assert "json" not in table.column_names
+
+
+def test_get_output_sink(tmp_path):
+    assert isinstance(get_output_sink(make_config(file=str(tmp_path / "results.json"))), JSONSink)
+    with pytest.raises(OutputError):
+        get_output_sink(make_config(format="csv"))
+
+
+def read_shard(filename):
+    if filename.suffix == ".zst":
+        with zstandard.open(filename, "rb") as f:
+            return f.read()
+    if filename.suffix == ".gz":
+        return gzip.decompress(filename.read_bytes())
+    return filename.read_bytes()
+
+
+@pytest.mark.parametrize(("compression", "extension"), [("zstd", ".zst"), ("gzip", ".gz"), (None, "")])
+def test_sharded_sink(tmp_path, monkeypatch, compression, extension):
+    monkeypatch.setattr(output, "SHARD_BATCH_SIZE", 2)
+    sink = ShardedSink(str(tmp_path / "crawl"), 2, compression=compression, rotate_count=3)
+    results = [f'{{"domain":"domain{i}.cz"}}'.encode() for i in range(9)]
+    for result in results:
+        sink.write(result)
+    sink.close()
+    manifest = json.loads((tmp_path / "crawl-manifest.json").read_text(encoding="utf-8"))
+    assert manifest["results"] == 9
+    # batches of two go to the shards in turn, files are rotated after three results
+    assert [(file["file"], file["shard"], file["results"]) for file in manifest["files"]] == [
+        (f"crawl-000-00000.jsonl{extension}", 0, 3),
+        (f"crawl-000-00001.jsonl{extension}", 0, 2),
+        (f"crawl-001-00000.jsonl{extension}", 1, 3),
+        (f"crawl-001-00001.jsonl{extension}", 1, 1),
+    ]
+    written = []
+    for file in manifest["files"]:
+        content = read_shard(tmp_path / file["file"])
+        assert len(content) == file["size"]
+        written += content.splitlines()
+    assert sorted(written) == sorted(results)
+
+
+def test_sharded_sink_rotates_by_size(tmp_path):
+    sink = ShardedSink(str(tmp_path / "crawl"), 1, compression=None, rotate_size=50)
+    for i in range(10):
+        sink.write(f'{{"domain":"domain{i}.cz"}}'.encode())
+    sink.close()
+    manifest = json.loads((tmp_path / "crawl-manifest.json").read_text(encoding="utf-8"))
+    # 24 bytes per result with the newline, a file is closed once it has at least 50 bytes
+    assert [file["results"] for file in manifest["files"]] == [3, 3, 3, 1]
+    assert [file["size"] for file in manifest["files"]] == [72, 72, 72, 24]
+
+
+def test_sharded_output_config(tmp_path):
+    assert isinstance(get_output_sink(make_config(file=str(tmp_path / "crawl"), shards=2)), ShardedSink)
+    with pytest.raises(OutputError):
+        get_output_sink(make_config(shards=2))
+    with pytest.raises(OutputError):
+        get_output_sink(make_config(file=str(tmp_path / "crawl"), shards=2, shard_compression="lzma"))
@@ -0,0 +1,271 @@
+# Copyright © 2019-2023 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import socket
+from threading import Thread, Timer
+from time import sleep
+
+import dns.exception
+import dns.message
+import dns.rcode
+import dns.resolver
+import pytest
+
+from dns_crawler import transport
+from dns_crawler.dns_utils import get_chaostxt
+
+
+def make_query(name, rdtype="A"):
+    return dns.message.make_query(name, rdtype)
+
+
+def test_udp_pool_query(dns_server):
+    dns_server.add("example.cz", "A", "192.0.2.1")
+    pool = transport.UDPPool(2)
+    try:
+        for _ in range(3):
+            response = pool.query(make_query("example.cz"), dns_server.ip, 2, port=dns_server.port)
+            assert [rdata.to_text() for rdata in response.answer[0]] == ["192.0.2.1"]
+    finally:
+        pool.close()
+
+
+def test_udp_pool_raises_on_truncation(dns_server):
+    dns_server.truncated.add("big.example.cz.")
+    pool = transport.UDPPool(1)
+    try:
+        with pytest.raises(dns.message.Truncated):
+            pool.query(make_query("big.example.cz"), dns_server.ip, 2, port=dns_server.port)
+    finally:
+        pool.close()
+
+
+# Responses from other addresses and garbage with the query's ID are ignored, the pool waits for the real response
+def test_udp_pool_matches_responses_by_id_and_source():
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(("127.0.0.1", 0))
+    other = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    other.bind(("127.0.0.1", 0))
+
+    def respond():
+        wire, source = server.recvfrom(65535)
+        request = dns.message.from_wire(wire)
+        wrong = dns.message.make_response(request)
+        wrong.set_rcode(dns.rcode.REFUSED)
+        other.sendto(wrong.to_wire(), source)
+        server.sendto(wire[:2] + b"garbage", source)
+        server.sendto(dns.message.make_response(request).to_wire(), source)
+
+    responder = Thread(target=respond)
+    responder.start()
+    pool = transport.UDPPool(1)
+    try:
+        response = pool.query(make_query("example.cz"), "127.0.0.1", 2, port=server.getsockname()[1])
+        assert response.rcode() == dns.rcode.NOERROR
+    finally:
+        responder.join()
+        pool.close()
+        server.close()
+        other.close()
+
+
+def test_udp_pool_close_stops_receiving_threads(dns_server):
+    pool = transport.UDPPool(3)
+    pool.query(make_query("example.cz"), dns_server.ip, 2, port=dns_server.port)
+    threads = list(pool.threads)
+    assert len(threads) == 3
+    pool.close()
+    assert not any(thread.is_alive() for thread in threads)
+    assert pool.threads == []
+
+
+# Sockets are replaced after max_queries queries, so the source port doesn't stay the same for the whole worker
+def test_udp_pool_rotates_sockets(dns_server):
+    dns_server.add("example.cz", "A", "192.0.2.1")
+    pool = transport.UDPPool(1, max_queries=2)
+    try:
+        ports = []
+        for _ in range(5):
+            response = pool.query(make_query("example.cz"), dns_server.ip, 2, port=dns_server.port)
+            assert [rdata.to_text() for rdata in response.answer[0]] == ["192.0.2.1"]
+            ports.append(pool.sockets[socket.AF_INET][0].getsockname()[1])
+        assert ports[0] == ports[1] != ports[2] == ports[3] != ports[4]
+        sleep(transport.UDP_RECEIVE_INTERVAL * 3)
+        assert len(pool.threads) == 1
+        assert not pool.retired
+        assert len(pool.sent) == 1
+    finally:
+        pool.close()
+
+
+# A retired socket keeps receiving until the queries sent from it get their responses
+def test_udp_pool_retired_socket_receives_pending_responses():
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(("127.0.0.1", 0))
+    pool = transport.UDPPool(1, max_queries=1)
+
+    def respond():
+        wire, source = server.recvfrom(65535)
+        # a query sent from a new socket retires the one waiting for this response
+        pool.release_socket(pool.get_socket(socket.AF_INET))
+        sleep(transport.UDP_RECEIVE_INTERVAL * 2)
+        server.sendto(dns.message.make_response(dns.message.from_wire(wire)).to_wire(), source)
+
+    responder = Thread(target=respond)
+    responder.start()
+    try:
+        response = pool.query(make_query("example.cz"), "127.0.0.1", 5, port=server.getsockname()[1])
+        assert response.rcode() == dns.rcode.NOERROR
+    finally:
+        responder.join()
+        pool.close()
+        server.close()
+
+
+def test_get_udp_pool_replaces_pool_with_another_size():
+    pool = transport.get_udp_pool(2)
+    pool.get_socket(socket.AF_INET)
+    threads = list(pool.threads)
+    assert transport.get_udp_pool() is pool
+    assert transport.get_udp_pool(3) is not pool
+    assert pool.closed
+    assert not any(thread.is_alive() for thread in threads)
+
+
+def get_resolver_error(server, qname):
+    resolver = dns.resolver.Resolver(configure=False)
+    resolver.nameservers = [server.ip]
+    resolver.port = server.port
+    resolver.timeout = resolver.lifetime = 2
+    try:
+        resolver.resolve(qname, rdtype="TXT", rdclass="CHAOS", lifetime=2, search=True)
+    except Exception as e:  # noqa: BLE001
+        return str(e)
+    return None
+
+
+def test_get_chaostxt(dns_server):
+    dns_server.add("version.bind", "TXT", '"9.18.0"', rdclass="CH")
+    assert get_chaostxt(dns_server.ip, "version.bind", 2, port=dns_server.port) == {"value": ["9.18.0"]}
+
+
+def test_get_chaostxt_retries_truncated_answers_over_tcp(dns_server):
+    dns_server.add("version.bind", "TXT", '"9.18.0"', rdclass="CH")
+    dns_server.truncated.add("version.bind.")
+    assert get_chaostxt(dns_server.ip, "version.bind", 2, port=dns_server.port) == {"value": ["9.18.0"]}
+    assert dns_server.count("version.bind.", "TXT", "udp") == 1
+    assert dns_server.count("version.bind.", "TXT", "tcp") == 1
+
+
+# the errors are the same as with dns.resolver (which the crawler used for these queries before)
+@pytest.mark.parametrize("rcode", [dns.rcode.REFUSED, dns.rcode.NXDOMAIN, dns.rcode.NOERROR])
+def test_get_chaostxt_errors(dns_server, rcode):
+    dns_server.set_rcode("hostname.bind", rcode)
+    expected = get_resolver_error(dns_server, "hostname.bind")
+    assert expected
+    assert get_chaostxt(dns_server.ip, "hostname.bind", 2, port=dns_server.port) == {"value": None,
+                                                                                    "error": expected}
+
+
+def test_get_chaostxt_timeout():
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(("127.0.0.1", 0))
+    try:
+        result = get_chaostxt("127.0.0.1", "version.bind", 0.3, port=server.getsockname()[1])
+    finally:
+        server.close()
+    assert result["value"] is None
+    assert result["error"].startswith("The resolution lifetime expired after")
+
+
+def test_stream_pool_pipelines_queries_on_one_connection(dns_server):
+    dns_server.add("slow.cz", "A", "192.0.2.1")
+    dns_server.add("fast.cz", "A", "192.0.2.2")
+    dns_server.delays["slow.cz."] = 0.5
+    pool = transport.StreamPool(10)
+    answers = []
+    slow = Thread(target=lambda: answers.append(pool.query(make_query("slow.cz"), dns_server.ip, 2,
+                                                           port=dns_server.port)))
+    slow.start()
+    sleep(0.1)
+    # answered while the slow query is still waiting on the same connection
+    answers.append(pool.query(make_query("fast.cz"), dns_server.ip, 2, port=dns_server.port))
+    slow.join()
+    pool.close()
+    assert [response.answer[0][0].to_text() for response in answers] == ["192.0.2.2", "192.0.2.1"]
+    assert [response.question[0].name.to_text() for response in answers] == ["fast.cz.", "slow.cz."]
+    assert len(pool.connections) == 0
+    assert dns_server.count("slow.cz.", "A", "tcp") == 1
+
+
+def test_stream_pool_reuses_connections(dns_server):
+    pool = transport.StreamPool(10)
+    pool.query(make_query("example.cz"), dns_server.ip, 2, port=dns_server.port)
+    connection = pool.connections[(dns_server.ip, dns_server.port)]
+    pool.query(make_query("example.sk"), dns_server.ip, 2, port=dns_server.port)
+    assert pool.connections[(dns_server.ip, dns_server.port)] is connection
+    # closed (eg. by the server), a new one is opened
+    connection.close()
+    pool.query(make_query("example.cz"), dns_server.ip, 2, port=dns_server.port)
+    assert pool.connections[(dns_server.ip, dns_server.port)] is not connection
+    pool.close()
+
+
+def test_stream_pool_retries_queries_on_closed_connection(dns_server):
+    dns_server.delays["slow.cz."] = 0.3
+    pool = transport.StreamPool(10)
+    pool.query(make_query("example.cz"), dns_server.ip, 2, port=dns_server.port)
+    connection = pool.connections[(dns_server.ip, dns_server.port)]
+    Timer(0.1, connection.close).start()
+    response = pool.query(make_query("slow.cz"), dns_server.ip, 2, port=dns_server.port)
+    assert response.question[0].name.to_text() == "slow.cz."
+    assert dns_server.count("slow.cz.", "A", "tcp") == 2
+    pool.close()
+
+
+def test_stream_pool_closes_least_recently_used_connections(dns_server, other_dns_server):
+    pool = transport.StreamPool(1)
+    pool.query(make_query("example.cz"), dns_server.ip, 2, port=dns_server.port)
+    connection = pool.connections[(dns_server.ip, dns_server.port)]
+    pool.query(make_query("example.cz"), other_dns_server.ip, 2, port=other_dns_server.port)
+    assert list(pool.connections) == [(other_dns_server.ip, other_dns_server.port)]
+    assert connection.closed
+    pool.close()
+
+
+def test_stream_pool_timeout(dns_server):
+    dns_server.delays["slow.cz."] = 1
+    pool = transport.StreamPool(1)
+    with pytest.raises(dns.exception.Timeout):
+        pool.query(make_query("slow.cz"), dns_server.ip, 0.2, port=dns_server.port)
+    # the connection is still usable
+    assert pool.query(make_query("example.cz"), dns_server.ip, 2, port=dns_server.port).rcode() == dns.rcode.NOERROR
+    pool.close()
+
+
+def test_stream_pool_eviction_stops_the_receiving_thread(dns_server, other_dns_server):
+    pool = transport.StreamPool(1)
+    pool.query(make_query("example.cz"), dns_server.ip, 2, port=dns_server.port)
+    connection = pool.connections[(dns_server.ip, dns_server.port)]
+    assert connection.thread.is_alive()
+    pool.query(make_query("example.cz"), other_dns_server.ip, 2, port=other_dns_server.port)
+    assert connection.closed
+    assert not connection.thread.is_alive()
+    other = pool.connections[(other_dns_server.ip, other_dns_server.port)]
+    pool.close()
+    assert not other.thread.is_alive()
@@ -0,0 +1,332 @@
+# Copyright © 2019-2023 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import subprocess
+import sys
+from pathlib import Path
+from threading import Barrier, Event, Thread
+from time import monotonic, sleep
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from dns_crawler import web_utils
+
+# a checkout without the web probes can't import dns_crawler.worker (any other import error is a failure)
+if not hasattr(web_utils, "get_webserver_info"):
+    pytest.skip("dns_crawler.web_utils has no get_webserver_info", allow_module_level=True)
+
+from rq import Queue, get_current_connection
+from rq.worker import StopRequested
+
+from dns_crawler import context, worker
+from dns_crawler.config_loader import config_token_key, load_config
+from dns_crawler.crawl import push_results, result_claims
+from dns_crawler.redis_utils import FEEDING_KEY, RESULTS_STREAM
+
+
+@pytest.fixture
+def redis():
+    return fakeredis.FakeStrictRedis()
+
+
+def start_job(w, queue, domains, deadline):
+    job = queue.enqueue(push_results, domains, job_id=domains[0])
+    queue.remove(job)
+    queue.started_job_registry.add(job, -1)
+    w.running_jobs[job.id] = (job, queue, deadline)
+    return job
+
+
+def push_result(redis, job, domain):
+    pipe = redis.pipeline()
+    pipe.xadd(RESULTS_STREAM, {"result": f'{{"domain":"{domain}"}}'})
+    return result_claims.push(job.id, pipe)
+
+
+def get_stream_domains(redis):
+    domains = []
+    for _, fields in redis.xrange(RESULTS_STREAM):
+        domains.append(fields.get(b"domain") or fields[b"result"])
+    return domains
+
+
+def test_watchdog_keeps_each_domain_in_the_stream_once(redis):
+    queue = Queue(connection=redis)
+    w = worker.InProcessCrawlerWorker([queue], connection=redis)
+    now = monotonic()
+    pushed = start_job(w, queue, ["pushed.cz"], now + 100)
+    running = start_job(w, queue, ["running.cz"], now + 100)
+    stuck = start_job(w, queue, ["stuck.cz", "stuck2.cz"], now - 1)
+    stuck_pushed = start_job(w, queue, ["stuck-pushed.cz"], now - 1)
+    assert push_result(redis, pushed, "pushed.cz")
+    assert push_result(redis, stuck_pushed, "stuck-pushed.cz")
+    try:
+        assert w.check_running_jobs()
+        # the running job was given to another worker and it can't push its results anymore
+        assert queue.job_ids == [running.id]
+        assert not push_result(redis, running, "running.cz")
+        # only the stuck job which didn't push its results gets errors
+        assert sorted(get_stream_domains(redis)) == sorted([b'{"domain":"pushed.cz"}', b'{"domain":"stuck-pushed.cz"}',
+                                                            b"stuck.cz", b"stuck2.cz"])
+        assert stuck.id in queue.failed_job_registry
+    finally:
+        for job in (pushed, running, stuck, stuck_pushed):
+            result_claims.release(job.id)
+
+
+def test_watchdog_leaves_jobs_within_their_deadline(redis):
+    queue = Queue(connection=redis)
+    w = worker.InProcessCrawlerWorker([queue], connection=redis)
+    job = start_job(w, queue, ["slow.cz"], monotonic() + 100)
+    try:
+        assert not w.check_running_jobs()
+        assert queue.job_ids == []
+        assert push_result(redis, job, "slow.cz")
+    finally:
+        result_claims.release(job.id)
+
+
+def test_failed_job_gets_errors_unless_its_results_were_pushed(redis):
+    queue = Queue(connection=redis)
+    w = worker.InProcessCrawlerWorker([queue], connection=redis)
+    failed = start_job(w, queue, ["failed.cz"], None)
+    pushed = start_job(w, queue, ["pushed.cz"], None)
+    assert push_result(redis, pushed, "pushed.cz")
+    try:
+        for job in (failed, pushed):
+            job.retries_left = None
+            w.handle_job_failure(job, queue, exc_string="Traceback…\nValueError: broken\n")
+        entries = [fields for _, fields in redis.xrange(RESULTS_STREAM)]
+        assert entries == [{b"result": b'{"domain":"pushed.cz"}'},
+                           {b"domain": b"failed.cz", b"error": b"ValueError: broken"}]
+    finally:
+        for job in (failed, pushed):
+            result_claims.release(job.id)
+
+
+def test_threaded_worker_stops_after_waiting_for_a_slot(redis):
+    queue = Queue(connection=redis)
+    w = worker.ThreadedCrawlerWorker([queue], connection=redis, concurrency=2)
+    queue.enqueue(push_results, ["example.cz"])
+    w._stop_requested = True
+    with pytest.raises(StopRequested):
+        w.dequeue_job_and_maintain_ttl(None)
+    assert queue.count == 1
+    # the slot was given back
+    assert w.slots.acquire(blocking=False)
+    assert w.slots.acquire(blocking=False)
+
+
+def test_threaded_worker_reloads_the_context_when_no_job_is_running(redis, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(context, "crawl_context", None)
+    load_config(redis=redis, save=True)
+    w = worker.ThreadedCrawlerWorker([Queue(connection=redis)], connection=redis, concurrency=2)
+    crawl_context = context.get_crawl_context(redis)
+    query_executor = crawl_context.query_executor
+    w.active_jobs = 1
+    redis.set(config_token_key, "changed")
+    refresh = Thread(target=w.refresh_context)
+    refresh.start()
+    refresh.join(0.3)
+    # still waiting for the running job, whose executor is untouched
+    assert refresh.is_alive()
+    assert crawl_context.query_executor is query_executor
+    with w.idle:
+        w.active_jobs = 0
+        w.idle.notify_all()
+    refresh.join(5)
+    assert not refresh.is_alive()
+    assert crawl_context.config_token == b"changed"
+    assert query_executor._shutdown
+
+
+def test_dead_worker_jobs_are_failed(redis):
+    queue = Queue(connection=redis)
+    dead = worker.InProcessCrawlerWorker([queue], connection=redis, name="dead")
+    dead.register_birth()
+    other = worker.InProcessCrawlerWorker([queue], connection=redis, name="other")
+    jobs = {}
+    for name, w, domains in (("dead", dead, ["a.cz", "b.cz"]), ("other", other, ["c.cz"])):
+        job = start_job(w, queue, domains, None)
+        job.worker_name = name
+        job.save()
+        jobs[name] = job
+    assert worker.clean_up_dead_worker("dead", redis) == 1
+    assert jobs["dead"].id in queue.failed_job_registry
+    assert jobs["dead"].id not in queue.started_job_registry
+    assert jobs["other"].id in queue.started_job_registry
+    assert [fields for _, fields in redis.xrange(RESULTS_STREAM)] == [
+        {b"domain": b"a.cz", b"error": worker.DEAD_WORKER_ERROR.encode("utf-8")},
+        {b"domain": b"b.cz", b"error": worker.DEAD_WORKER_ERROR.encode("utf-8")}]
+    # it can be started again under the same name
+    worker.InProcessCrawlerWorker([queue], connection=redis, name="dead").register_birth()
+
+
+# jobs for the threaded worker tests, they can't be local functions (RQ imports them by name)
+job_barrier = None
+job_events = {}
+job_records = []
+
+
+def wait_for_other_job():
+    job_barrier.wait()
+
+
+def hold_context():
+    crawl_context = context.get_crawl_context(get_current_connection())
+    executor = crawl_context.query_executor
+    job_events["started"].set()
+    job_events["release"].wait(10)
+    # the context wasn't reloaded under the running job
+    job_records.append((crawl_context.config_token, executor._shutdown))
+
+
+def record_context():
+    job_records.append((context.get_crawl_context(get_current_connection()).config_token, None))
+
+
+def run_worker(redis, tmp_path, monkeypatch, concurrency, jobs, control=None):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(context, "crawl_context", None)
+    load_config(redis=redis, save=True)
+    queue = Queue(connection=redis)
+    for function, args in jobs:
+        queue.enqueue(function, *args)
+    w = worker.ThreadedCrawlerWorker([queue], connection=redis, concurrency=concurrency)
+    errors = []
+
+    def run_control():
+        try:
+            control(queue, w)
+        except Exception as e:  # noqa: BLE001 (re-raised in the test's thread)
+            errors.append(e)
+            job_events["release"].set()
+            redis.delete(FEEDING_KEY)
+
+    if control is not None:
+        controller = Thread(target=run_control)
+        controller.start()
+    # RQ installs signal handlers, so the worker has to run in the main thread
+    w.work(burst=True)
+    if control is not None:
+        controller.join()
+    if errors:
+        raise errors[0]
+    return queue, w
+
+
+def test_threaded_worker_runs_jobs_in_parallel(redis, tmp_path, monkeypatch):
+    global job_barrier
+    job_barrier = Barrier(2, timeout=5)
+    queue, _ = run_worker(redis, tmp_path, monkeypatch, 2, [(wait_for_other_job, ()), (wait_for_other_job, ())])
+    # with one job at a time, the barrier would time out and the jobs would fail
+    assert queue.failed_job_registry.count == 0
+    assert queue.finished_job_registry.count == 2
+
+
+def test_threaded_worker_reloads_the_context_after_running_jobs_finish(redis, tmp_path, monkeypatch):
+    job_events.update(started=Event(), release=Event())
+    job_records.clear()
+    # the queue is kept open, so the worker keeps waiting for more jobs
+    redis.set(FEEDING_KEY, 1)
+
+    def control(queue, w):
+        assert job_events["started"].wait(10)
+        original_token = redis.get(config_token_key)
+        redis.set(config_token_key, "changed")
+        queue.enqueue(record_context)
+        deadline = monotonic() + 10
+        while len(job_records) < 1 and monotonic() < deadline:
+            sleep(0.05)
+        sleep(0.3)
+        # the second job finished, but the first one is still running with the original context
+        assert context.get_crawl_context(redis).config_token == original_token
+        job_events["release"].set()
+        redis.delete(FEEDING_KEY)
+
+    run_worker(redis, tmp_path, monkeypatch, 2, [(hold_context, ())], control)
+    original_token = job_records[0][0]
+    assert job_records == [(original_token, None), (original_token, False)]
+    assert context.get_crawl_context(redis).config_token == b"changed"
+
+
+def get_worker_pid():
+    job_records.append(os.getpid())
+    return os.getpid()
+
+
+def test_in_process_worker_runs_jobs_without_forking(redis, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(context, "crawl_context", None)
+    job_records.clear()
+    load_config(redis=redis, save=True)
+    queue = Queue(connection=redis)
+    job = queue.enqueue(get_worker_pid)
+    worker.InProcessCrawlerWorker([queue], connection=redis).work(burst=True)
+    assert job.return_value() == os.getpid()
+    # the job ran in this very process, so it could change its memory
+    assert job_records == [os.getpid()]
+
+
+# RQ can't run jobs from __main__, so the stuck job has a module of its own
+STUCK_JOB_MODULE = """
+from time import sleep
+
+
+def hang():
+    while True:
+        try:
+            sleep(10)
+        except BaseException:  # including the job's timeout
+            pass
+"""
+
+WATCHDOG_SCRIPT = """
+import fakeredis
+from rq import Queue
+
+from dns_crawler import worker
+from dns_crawler.config_loader import load_config
+from stuck_job import hang
+
+worker.WATCHDOG_INTERVAL = 0.1
+worker.WATCHDOG_GRACE_PERIOD = 0
+worker.push_failed_job = lambda job, error, redis: print(f"{job.id} failed: {error}", flush=True)
+redis = fakeredis.FakeStrictRedis()
+load_config(redis=redis, save=True)
+queue = Queue(connection=redis)
+queue.enqueue(hang, job_id="hanging-job", job_timeout=1)
+worker.InProcessCrawlerWorker([queue], connection=redis).work(burst=True)
+print("the worker finished", flush=True)
+"""
+
+
+def test_watchdog_kills_worker_with_a_stuck_job(tmp_path):
+    (tmp_path / "stuck_job.py").write_text(STUCK_JOB_MODULE, encoding="utf-8")
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(Path(__file__).parent.parent),
+                                                       os.environ.get("PYTHONPATH", "")]))
+    process = subprocess.run([sys.executable, "-c", WATCHDOG_SCRIPT], cwd=tmp_path, env=env, capture_output=True,
+                             text=True, timeout=60, check=False)
+    assert process.returncode == worker.WATCHDOG_EXIT_CODE, process.stderr
+    output = process.stdout.splitlines()
+    assert "hanging-job failed: Job got stuck and its worker was killed." in output
+    assert "the worker finished" not in output